@@ -1,56 +1,126 @@
+'''
+Converts the ortolang segment-wise annotation (Dicta-Sign-LSF_Annotation.csv)
+to the framewise annotation file data/processed/DictaSign/annotations.npz.
+
+The CSV is streamed in chunks and segments are grouped by video (video name -> index dict).
+Framewise values of each category are written into a single preallocated flat array
+(uint8 for binary categories, int32 for fls IDs), each video being a (nFrames, 1) view of it.
+A hash of the segments of each video is kept in annotations_hashes.json, with the video order of annotations.npz:
+on re-runs, videos whose segments did not change are copied (by name) from the previous annotations.npz.
+'''
+
 import numpy as np
 import os, os.path
+import csv
+import hashlib
+import itertools
+import json
+import argparse
+
+parser = argparse.ArgumentParser(description='Converts ortolang CSV annotation to framewise annotation')
+parser.add_argument('--csv',
+                    type=str,
+                    default='Dicta-Sign-LSF_Annotation.csv',
+                    help='Ortolang annotation file')
+parser.add_argument('--force',
+                    type=int,
+                    default=0,
+                    help='Regenerate all videos, even if their segments did not change',
+                    choices=[0, 1])
+parser.add_argument('--chunkSize',
+                    type=int,
+                    default=100000,
+                    help='Number of CSV rows read at once')
+args = parser.parse_args()
 
-list_videos   = np.load('data/processed/DictaSign/list_videos.npy')
-length_videos = np.load('data/processed/DictaSign/length_videos.npy')
+path_processed = 'data/processed/DictaSign/'
+path_annotations = path_processed + 'annotations.npz'
+path_hashes = path_processed + 'annotations_hashes.json'
+
+list_videos   = np.load(path_processed + 'list_videos.npy')
+length_videos = np.load(path_processed + 'length_videos.npy').astype(int)
 nVideos = list_videos.size
+video_index = {str(list_videos[iV]): iV for iV in range(nVideos)}
 
 available_categories     = ['DS', 'FBUOY', 'PT', 'N', 'FS', 'G', 'ID']
 available_categories_mod = ['DS', 'FBUOY', 'PT', 'N', 'FS', 'G', 'fls']
-nCategories = len(available_categories)
+category_mod = dict(zip(available_categories, available_categories_mod))
+# fls IDs go beyond the int16 range
+category_dtype = {c: np.uint8 for c in available_categories_mod}
+category_dtype['fls'] = np.int32
 
+# lecture du csv par blocs, regroupement des segments par video
+segments = [[] for iV in range(nVideos)]
+with open(args.csv, newline='') as f:
+    reader = csv.reader(f)
+    next(reader) # header
+    while True:
+        chunk = list(itertools.islice(reader, args.chunkSize))
+        if len(chunk) == 0:
+            break
+        for row in chunk:
+            if row[5] not in category_mod:
+                continue
+            iV = video_index.get(row[0][14:-10])
+            if iV is not None:
+                segments[iV].append((int(row[3]), int(row[4]), category_mod[row[5]], row[6]))
 
-annot_csv = np.genfromtxt('Dicta-Sign-LSF_Annotation.csv',delimiter=',',dtype=None)
-annot_csv_video = annot_csv[1:, 0]
-annot_csv_start = annot_csv[1:, 3].astype(int)
-annot_csv_end   = annot_csv[1:, 4].astype(int)
-annot_csv_cat   = annot_csv[1:, 5]
-annot_csv_value = annot_csv[1:, 6]
-nSegments = annot_csv_video.size
+# hash des segments de chaque video, pour ne regenerer que les videos modifiees
+hashes = {}
+for iV in range(nVideos):
+    h = hashlib.sha1(str(length_videos[iV]).encode())
+    for s in segments[iV]:
+        h.update(repr(s).encode())
+    hashes[str(list_videos[iV])] = h.hexdigest()
 
-# creation d'une liste par type d'annotation
-framewise_annotation = {}
-for c in available_categories_mod:
-    framewise_annotation['dataBrut_'+c] = []
+previous_hashes = {}
+previous_video_index = {}
+previous_annotation = None
+if not args.force and os.path.isfile(path_hashes) and os.path.isfile(path_annotations):
+    with open(path_hashes) as f:
+        previous = json.load(f)
+    # files without the video order (older format) are not reused
+    if 'list_videos' in previous:
+        previous_hashes = previous['hashes']
+        previous_video_index = {name: iV for iV, name in enumerate(previous['list_videos'])}
+        previous_annotation = np.load(path_annotations, encoding='latin1', allow_pickle=True)
 
-# initialisation de tableaux à 0, pour chaque video dans chaque type de categorie
+# tableaux plats preallocation, une vue (nFrames, 1) par video
+offsets = np.zeros(nVideos+1, dtype=int)
+offsets[1:] = np.cumsum(length_videos)
+flat_annotation = {}
+framewise_annotation = {}
 for c in available_categories_mod:
+    flat_annotation[c] = np.zeros((offsets[-1], 1), dtype=category_dtype[c])
+    framewise_annotation['dataBrut_'+c] = np.empty(nVideos, dtype=object)
     for iV in range(nVideos):
-        vidName = list_videos[iV]
-        nFrames = int(length_videos[iV])#len([name for name in os.listdir(DIR) if os.path.isfile(os.path.join(DIR, name))])
-        framewise_annotation['dataBrut_'+c].append(np.zeros(nFrames))
-
-# lecture de chaque segment du csv, et assignation des valeurs d'annotation dans le tableau
-for iS in range(nSegments):
-    videoS = annot_csv_video[iS][14:-10]
-    startS = annot_csv_start[iS]
-    endS   = annot_csv_end[iS]
-    catS   = annot_csv_cat[iS]
-    valueS = annot_csv_value[iS]
-
-    indexVideoS = np.where(list_videos==videoS)[0]
-    if indexVideoS.size > 0:
-        indexVideoS = indexVideoS[0]
-        if catS in available_categories:
-            if catS == 'ID':
-                framewise_annotation['dataBrut_fls'][indexVideoS][startS:endS+1] = int(valueS)
-            else:
-                framewise_annotation['dataBrut_'+catS][indexVideoS][startS:endS+1] = 1
-
-np.savez('data/processed/DictaSign/annotations.npz', dataBrut_fls=framewise_annotation['dataBrut_fls'],
-                                                     dataBrut_DS=framewise_annotation['dataBrut_DS'],
-                                                     dataBrut_FBUOY=framewise_annotation['dataBrut_FBUOY'],
-                                                     dataBrut_PT=framewise_annotation['dataBrut_PT'],
-                                                     dataBrut_N=framewise_annotation['dataBrut_N'],
-                                                     dataBrut_FS=framewise_annotation['dataBrut_FS'],
-                                                     dataBrut_G=framewise_annotation['dataBrut_G'])
+        framewise_annotation['dataBrut_'+c][iV] = flat_annotation[c][offsets[iV]:offsets[iV+1]]
+
+nReused = 0
+for iV in range(nVideos):
+    vidName = str(list_videos[iV])
+    if previous_annotation is not None and previous_hashes.get(vidName) == hashes[vidName]:
+        try:
+            for c in available_categories_mod:
+                previous = previous_annotation['dataBrut_'+c][previous_video_index[vidName]]
+                framewise_annotation['dataBrut_'+c][iV][:, 0] = np.reshape(previous, -1)
+            nReused += 1
+            continue
+        except (KeyError, IndexError, ValueError):
+            for c in available_categories_mod:
+                framewise_annotation['dataBrut_'+c][iV][:] = 0
+    # assignation des valeurs d'annotation de chaque segment
+    for startS, endS, c, valueS in segments[iV]:
+        if c == 'fls':
+            framewise_annotation['dataBrut_fls'][iV][startS:endS+1] = int(valueS)
+        else:
+            framewise_annotation['dataBrut_'+c][iV][startS:endS+1] = 1
+
+if previous_annotation is not None:
+    previous_annotation.close()
+
+np.savez(path_annotations, **framewise_annotation)
+with open(path_hashes, 'w') as f:
+    json.dump({'list_videos': [str(v) for v in list_videos], 'hashes': hashes}, f, indent=0, sort_keys=True)
+
+print(str(nVideos - nReused) + ' videos converted, ' + str(nReused) + ' unchanged')
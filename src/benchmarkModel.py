@@ -0,0 +1,71 @@
+'''
+This script measures the time of train and predict steps of get_model,
+with the default settings and with performance_mode (mixed precision, XLA, fused LSTM kernel).
+Inputs are random features, so no data is needed.
+By default it runs on CPU, where float16 is emulated: the gain of mixed precision is expected on recent GPUs.
+'''
+
+import argparse
+import os
+
+parser = argparse.ArgumentParser(description='Step time of get_model, default and performance mode')
+parser.add_argument('--batchSize',
+                    type=int,
+                    default=200,
+                    help='Batch size')
+parser.add_argument('--seqLength',
+                    type=int,
+                    default=100,
+                    help='Length of sequences')
+parser.add_argument('--featuresNumber',
+                    type=int,
+                    default=420,
+                    help='Number of features')
+parser.add_argument('--classes',
+                    type=int,
+                    default=2,
+                    help='Number of classes of the output')
+parser.add_argument('--steps',
+                    type=int,
+                    default=20,
+                    help='Number of timed steps (after one warm-up step)')
+parser.add_argument('--cpu',
+                    type=int,
+                    default=1,
+                    help='Whether GPUs are hidden',
+                    choices=[0, 1])
+
+args = parser.parse_args()
+
+if args.cpu:
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+from models.model_utils import *
+
+import numpy as np
+import time
+
+X = np.random.randn(args.batchSize, args.seqLength, args.featuresNumber).astype(np.float32)
+Y = np.eye(args.classes, dtype=np.float32)[np.random.randint(0, args.classes, (args.batchSize, args.seqLength))]
+W = np.ones((args.batchSize, args.seqLength), dtype=np.float32)
+
+for performance_mode in [False, True]:
+    model = get_model(output_names=['output'],
+                      output_classes=[args.classes],
+                      time_steps=args.seqLength,
+                      features_number=args.featuresNumber,
+                      performance_mode=performance_mode,
+                      print_summary=False)
+    model.train_on_batch(X, Y, sample_weight=W)
+    t0 = time.time()
+    for i_step in range(args.steps):
+        model.train_on_batch(X, Y, sample_weight=W)
+    train_time = (time.time() - t0)/args.steps
+    model.predict_on_batch(X)
+    t0 = time.time()
+    for i_step in range(args.steps):
+        model.predict_on_batch(X)
+    predict_time = (time.time() - t0)/args.steps
+    print('performance_mode=' + str(performance_mode)
+          + ': train step ' + '{:.1f}'.format(1000*train_time) + ' ms'
+          + ', predict step ' + '{:.1f}'.format(1000*predict_time) + ' ms')
@@ -0,0 +1,60 @@
+'''
+This script decodes and resizes the video frames once, into one uint8 array per video
+in data/processed/<corpus>/frames_<imgWidth>x<imgHeight>/.
+Cached frames are then memory-mapped by get_data_concatenated (frames_cache=True),
+instead of decoding JPEG files at each batch.
+'''
+
+from models.data_utils import *
+
+import argparse
+
+parser = argparse.ArgumentParser(description='Decodes video frames into memory-mappable uint8 arrays')
+parser.add_argument('--corpus',
+                    type=str,
+                    default='DictaSign',
+                    choices=['DictaSign', 'NCSLGR'],
+                    help='Corpus')
+parser.add_argument('--imgWidth',
+                    type=int,
+                    default=224,
+                    help='Width of CNN input')
+parser.add_argument('--imgHeight',
+                    type=int,
+                    default=224,
+                    help='Height of CNN input')
+parser.add_argument('--framesPathBeforeVideo',
+                    type=str,
+                    default='/localHD/DictaSign/convert/img/DictaSign_lsf_',
+                    help='Path of the frame folders, before the video name')
+parser.add_argument('--videos',
+                    type=int,
+                    default=[],
+                    help='Indices of the videos to cache (default: all)',
+                    nargs='*')
+parser.add_argument('--overwrite',
+                    type=int,
+                    default=0,
+                    help='Whether videos already cached are decoded again',
+                    choices=[0, 1])
+parser.add_argument('--fromNotebook',
+                    type=int,
+                    default=0,
+                    help='When the script is run from a jupyter notebook',
+                    choices=[0, 1])
+
+args = parser.parse_args()
+
+if len(args.videos) > 0:
+    video_indices = np.array(args.videos)
+else:
+    video_indices = np.arange(get_annotation_cache(args.corpus, bool(args.fromNotebook)).video_lengths.size)
+
+cached = build_frame_cache(args.corpus,
+                           video_indices,
+                           args.imgWidth,
+                           args.imgHeight,
+                           args.framesPathBeforeVideo,
+                           bool(args.fromNotebook),
+                           bool(args.overwrite))
+print('Cached frames of ' + str(len(cached)) + ' videos of ' + args.corpus)
@@ -1,42 +1,315 @@
 import numpy as np
 import sys
 import math
-from sklearn.utils.class_weight import compute_class_weight
 
 
 import os
+import hashlib
+from models.rle_utils import RunLengthAnnotation, RunLengthLabels
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import tensorflow as tf
 v0 = tf.__version__[0]
 if v0 == '2':
     from tensorflow.keras.utils import to_categorical # For tensorflow 2, keras is included in tf
+    from tensorflow.keras.preprocessing.image import load_img, img_to_array
 elif v0 == '1':
     from keras.utils import to_categorical # For tensorflow 1.2.0
+    from keras.preprocessing.image import load_img, img_to_array
 else:
     sys.exit('Tensorflow version should be 1.X or 2.X')
 
 # 16 signers:
 signerRefsDictaSign = np.array(['A11','B15','A2','B0','A1','B14','A9','B17','A6','B13','A10','B16','A7','B4','A3','B5'])
 
-def get_raw_annotation_from_file(corpus, from_notebook=False):
+# Feature families of the 'old' input format (one big object array per family)
+featureFamilies = ['features_HS', 'features_HS_norm', 'raw', 'raw_norm', '2Dfeatures', '2Dfeatures_norm']
+
+# Memory-mapped packed feature families, keyed by (corpus, path, family)
+_packed_features_store = {}
+
+class PackedFeatures(object):
+    """
+        Per-video access to a packed feature family (or packed annotation type):
+        one contiguous matrix [total_time_steps, ...] (memory-mapped)
+        and an offsets table, video i being rows offsets[i]:offsets[i+1].
+        packed[i] returns a view, so only the pages that are actually used are read.
+    """
+    def __init__(self, matrix, offsets):
+        self.matrix = matrix
+        self.offsets = offsets
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def __getitem__(self, vid_idx):
+        return self.matrix[self.offsets[vid_idx]:self.offsets[vid_idx+1]]
+
+def pack_features(corpus, key, from_notebook=False):
     """
-        Gets raw annotation from data file
+        Converts a whole-corpus object array of features (e.g. features_HS.npy)
+        to the packed format: key_packed.npy (float32 matrix) and key_offsets.npy
 
         Inputs:
             corpus: 'DictaSign' or 'NCSLGR'
+            key: feature family (one of featureFamilies)
             from_notebook: True if used in Jupyter notebook
 
         Outputs:
-            Annotation data
+            offsets: numpy array of size N_videos+1
+    """
+    if from_notebook:
+        parent = '../'
+    else:
+        parent = ''
+
+    path = parent + 'data/processed/' + corpus + '/' + key
+
+    key_features = np.load(path + '.npy', encoding='latin1', allow_pickle=True)
+    N_videos = len(key_features)
+    offsets = np.zeros(N_videos+1, dtype=np.int64)
+    for i_v in range(N_videos):
+        offsets[i_v+1] = offsets[i_v] + key_features[i_v].shape[0]
+
+    # written to temporary files first, so that processes reading the previous packed matrix are not affected
+    tmp_suffix = '.tmp' + str(os.getpid()) + '.npy'
+    packed = np.lib.format.open_memmap(path + '_packed' + tmp_suffix, mode='w+', dtype=np.float32, shape=(int(offsets[-1]), key_features[0].shape[1]))
+    for i_v in range(N_videos):
+        packed[offsets[i_v]:offsets[i_v+1], :] = key_features[i_v]
+    packed.flush()
+    del packed
+
+    # offsets are written last: their presence means the packed matrix is complete
+    # (previous offsets are removed before the matrix is replaced)
+    np.save(path + '_offsets' + tmp_suffix, offsets)
+    if os.path.exists(path + '_offsets.npy'):
+        os.remove(path + '_offsets.npy')
+    os.replace(path + '_packed' + tmp_suffix, path + '_packed.npy')
+    os.replace(path + '_offsets' + tmp_suffix, path + '_offsets.npy')
+    _packed_features_store.pop((corpus, parent, key), None)
+
+    return offsets
+
+def get_packed_features(corpus, key, from_notebook=False):
+    """
+        Gets a packed feature family, memory-mapped (read only).
+        Memory maps are kept for the whole process, and several processes
+        reading the same files share the page cache.
+
+        Inputs:
+            corpus: 'DictaSign' or 'NCSLGR'
+            key: feature family (one of featureFamilies)
+            from_notebook: True if used in Jupyter notebook
+
+        Outputs:
+            PackedFeatures object, or None if the family has not been packed
     """
     if from_notebook:
         parent = '../'
     else:
         parent = ''
 
-    annotation_raw = np.load(parent + 'data/processed/' + corpus + '/annotations.npz', encoding='latin1', allow_pickle=True)
+    path = parent + 'data/processed/' + corpus + '/' + key
+
+    if not os.path.exists(path + '_offsets.npy'):
+        return None
+
+    mtime = os.path.getmtime(path + '_offsets.npy')
+    cached = _packed_features_store.get((corpus, parent, key))
+    if cached is None or cached[0] != mtime:
+        packed = PackedFeatures(np.load(path + '_packed.npy', mmap_mode='r'),
+                                np.load(path + '_offsets.npy'))
+        cached = (mtime, packed)
+        _packed_features_store[(corpus, parent, key)] = cached
 
-    return annotation_raw
+    return cached[1]
+
+def get_features_family(corpus, key, from_notebook=False):
+    """
+        Gets a feature family of the 'old' input format, indexable by video.
+        The packed memory-mapped version is used when it exists,
+        otherwise the (pickled) object array is fully loaded.
+
+        Inputs:
+            corpus: 'DictaSign' or 'NCSLGR'
+            key: feature family (one of featureFamilies)
+            from_notebook: True if used in Jupyter notebook
+
+        Outputs:
+            features, such that features[vid_idx] is a [time_steps, features_number] array
+    """
+    if from_notebook:
+        parent = '../'
+    else:
+        parent = ''
+
+    packed = get_packed_features(corpus, key, from_notebook)
+    if packed is not None:
+        return packed
+
+    return np.load(parent + 'data/processed/' + corpus + '/' + key + '.npy', encoding='latin1', allow_pickle=True)
+
+# Per-process annotation caches, keyed by (corpus, path)
+_annotation_caches = {}
+
+def get_annotation_file(path):
+    """
+        Annotation file of a corpus folder: the packed format (annotations/video_offsets.npy,
+        see pack_annotations) if it exists and is not older than annotations.npz,
+        annotations.npz otherwise.
+    """
+    packed_file = path + 'annotations/video_offsets.npy'
+    if os.path.isfile(packed_file):
+        if not os.path.isfile(path + 'annotations.npz') or os.path.getmtime(packed_file) >= os.path.getmtime(path + 'annotations.npz'):
+            return packed_file
+    return path + 'annotations.npz'
+
+class AnnotationCache(object):
+    """
+        Corpus-level annotation data, loaded once:
+            annotation: dict of raw annotation arrays (one entry per annotation type)
+            list_videos: video names
+            video_lengths: number of frames of each video
+        With the packed format, annotation types are memory-mapped PackedFeatures (no pickle).
+        The file modification time is kept, so that a modified file is reloaded.
+    """
+    def __init__(self, corpus, path):
+        self.corpus = corpus
+        self.path = path
+        annotation_file = get_annotation_file(path)
+        self.mtime = os.path.getmtime(annotation_file)
+
+        if annotation_file.endswith('video_offsets.npy'):
+            offsets = np.load(annotation_file)
+            self.annotation = {}
+            for fileName in sorted(os.listdir(path + 'annotations/')):
+                if fileName.endswith('.npy') and fileName != 'video_offsets.npy':
+                    self.annotation[fileName[:-4]] = PackedFeatures(np.load(path + 'annotations/' + fileName, mmap_mode='r'), offsets)
+            self.video_lengths = np.diff(offsets).astype(int)
+        else:
+            annotation_npz = np.load(annotation_file, encoding='latin1', allow_pickle=True)
+            self.annotation = {key: annotation_npz[key] for key in annotation_npz.files}
+            annotation_npz.close()
+
+            if corpus == 'DictaSign':
+                annotation_length = self.annotation['dataBrut_DS'] # for counting nb of images
+            elif corpus == 'NCSLGR':
+                annotation_length = self.annotation['lexical_with_ns_not_fs'] # for counting nb of images
+            else:
+                sys.exit('Invalid corpus name')
+            self.video_lengths = np.array([annotation_length[i_v].shape[0] for i_v in range(len(annotation_length))], dtype=int)
+
+        self.list_videos = np.load(path + 'list_videos.npy')
+
+def get_annotation_cache(corpus, from_notebook=False):
+    """
+        Gets the annotation cache of a corpus, (re)loading it
+        if needed (first call, or annotation file modified since)
+
+        Inputs:
+            corpus: 'DictaSign' or 'NCSLGR'
+            from_notebook: True if used in Jupyter notebook
+
+        Outputs:
+            AnnotationCache object
+    """
+    if from_notebook:
+        parent = '../'
+    else:
+        parent = ''
+
+    path = parent + 'data/processed/' + corpus + '/'
+
+    cache = _annotation_caches.get((corpus, path))
+    if cache is None or cache.mtime != os.path.getmtime(get_annotation_file(path)):
+        cache = AnnotationCache(corpus, path)
+        _annotation_caches[(corpus, path)] = cache
+
+    return cache
+
+def invalidate_annotation_cache(corpus=None):
+    """
+        Drops cached annotations, for one corpus or for all corpora (corpus=None)
+    """
+    for key in list(_annotation_caches.keys()):
+        if corpus is None or key[0] == corpus:
+            del _annotation_caches[key]
+
+def pack_annotations(corpus, from_notebook=False):
+    """
+        Converts annotations.npz (per-video pickled arrays) to the packed format:
+        one flat array per annotation type in data/processed/<corpus>/annotations/<type>.npy
+        (smallest integer type holding the values) and a shared video_offsets.npy,
+        video i being rows video_offsets[i]:video_offsets[i+1].
+        Arrays are written to temporary files, the previous video_offsets.npy is removed before they replace
+        the previous ones, and video_offsets.npy is written last, so that a partially written folder is never used.
+
+        Inputs:
+            corpus: 'DictaSign' or 'NCSLGR'
+            from_notebook: True if used in Jupyter notebook
+
+        Outputs:
+            video offsets (numpy array)
+    """
+    if from_notebook:
+        parent = '../'
+    else:
+        parent = ''
+
+    path = parent + 'data/processed/' + corpus + '/'
+    annotation_npz = np.load(path + 'annotations.npz', encoding='latin1', allow_pickle=True)
+
+    if not os.path.isdir(path + 'annotations/'):
+        os.makedirs(path + 'annotations/')
+
+    # temporary files do not end with .npy, so that they are never listed as annotation types
+    tmp_suffix = '.npy.tmp' + str(os.getpid())
+    offsets = None
+    flat_keys = []
+    for key in annotation_npz.files:
+        key_annotation = annotation_npz[key]
+        video_lengths = np.array([key_annotation[i_v].shape[0] for i_v in range(len(key_annotation))], dtype=int)
+        if offsets is None:
+            offsets = np.zeros(video_lengths.size+1, dtype=np.int64)
+            offsets[1:] = np.cumsum(video_lengths)
+        elif video_lengths.size != offsets.size-1 or np.any(video_lengths != np.diff(offsets)):
+            sys.exit('Annotation ' + key + ' does not have the same video lengths as the other annotation types')
+
+        flat = np.concatenate([np.asarray(key_annotation[i_v]) for i_v in range(len(key_annotation))], axis=0)
+        if flat.size > 0:
+            if not np.all(np.mod(flat, 1) == 0):
+                sys.exit('Annotation ' + key + ' has non-integer values')
+            flat = flat.astype(np.result_type(np.min_scalar_type(int(flat.min())), np.min_scalar_type(int(flat.max()))))
+        else:
+            flat = flat.astype(np.uint8)
+        with open(path + 'annotations/' + key + tmp_suffix, 'wb') as f:
+            np.save(f, flat)
+        flat_keys.append(key)
+    annotation_npz.close()
+
+    # the folder is seen as not packed while arrays are replaced
+    if os.path.exists(path + 'annotations/video_offsets.npy'):
+        os.remove(path + 'annotations/video_offsets.npy')
+    for key in flat_keys:
+        os.replace(path + 'annotations/' + key + tmp_suffix, path + 'annotations/' + key + '.npy')
+    with open(path + 'annotations/video_offsets' + tmp_suffix, 'wb') as f:
+        np.save(f, offsets)
+    os.replace(path + 'annotations/video_offsets' + tmp_suffix, path + 'annotations/video_offsets.npy')
+    invalidate_annotation_cache(corpus)
+
+    return offsets
+
+def get_raw_annotation_from_file(corpus, from_notebook=False):
+    """
+        Gets raw annotation from data file (loaded once per process, see get_annotation_cache)
+
+        Inputs:
+            corpus: 'DictaSign' or 'NCSLGR'
+            from_notebook: True if used in Jupyter notebook
+
+        Outputs:
+            Annotation data (dict)
+    """
+    return get_annotation_cache(corpus, from_notebook).annotation
 
 def get_raw_annotation_type_video(corpus, type, video_index, provided_annotation=None, from_notebook=False):
     """
@@ -70,7 +343,7 @@ def get_raw_annotation_type_video(corpus, type, video_index, provided_annotation
 
     return provided_annotation[string_prefix+type][video_index]
 
-def concatenate_annotations(corpus, type, video_indices, separation=0, provided_annotation=None, from_notebook=False):
+def concatenate_annotations(corpus, type, video_indices, separation=0, provided_annotation=None, from_notebook=False, dtype=np.float32):
     """
         Concatenates annotations of one type for several videos
 
@@ -83,6 +356,7 @@ def concatenate_annotations(corpus, type, video_indices, separation=0, provided_
             separation: (integer) frames to separate videos
             provided_annotation: raw annotation data (not needed)
             from_notebook: True if used in Jupyter notebook
+            dtype: data type of the output (default float32)
 
         Outputs:
             Concatenated data, shape (1, time_steps, 1)
@@ -102,7 +376,7 @@ def concatenate_annotations(corpus, type, video_indices, separation=0, provided_
         total_time_steps += temp.shape[0]
         total_time_steps += separation
 
-    output = np.zeros((1,total_time_steps, 1))
+    output = np.zeros((1,total_time_steps, 1), dtype=dtype)
     temp_index = 0
     for i_v in video_indices:
         temp = get_raw_annotation_type_video(corpus, type, i_v, provided_annotation, from_notebook)
@@ -113,7 +387,7 @@ def concatenate_annotations(corpus, type, video_indices, separation=0, provided_
 
     return output
 
-def concatenate_fuse_annotations(corpus, types, video_indices, separation=0, provided_annotation=None, from_notebook=False):
+def concatenate_fuse_annotations(corpus, types, video_indices, separation=0, provided_annotation=None, from_notebook=False, dtype=np.float32):
     """
         Concatenates and fuse annotations of several type for several videos
         #Types are assumed to be binary
@@ -127,6 +401,7 @@ def concatenate_fuse_annotations(corpus, types, video_indices, separation=0, pro
             separation: (integer) frames to separate videos
             provided_annotation: raw annotation data (not needed)
             from_notebook: True if used in Jupyter notebook
+            dtype: data type of the output (default float32)
 
         Outputs:
             Concatenated fused data, shape (1, time_steps, 1)
@@ -145,17 +420,17 @@ def concatenate_fuse_annotations(corpus, types, video_indices, separation=0, pro
     if provided_annotation is None:
         provided_annotation = get_raw_annotation_from_file(corpus, from_notebook)
 
-    total_time_steps = concatenate_annotations(corpus, types[0], video_indices, separation, provided_annotation, from_notebook).shape[1]
+    total_time_steps = concatenate_annotations(corpus, types[0], video_indices, separation, provided_annotation, from_notebook, dtype).shape[1]
 
-    output = np.zeros((1, total_time_steps, N_types))
+    output = np.zeros((1, total_time_steps, N_types), dtype=dtype)
     for i_t in range(N_types):
         t = types[i_t]
-        temp = concatenate_annotations(corpus, t, video_indices, separation, provided_annotation, from_notebook)
+        temp = concatenate_annotations(corpus, t, video_indices, separation, provided_annotation, from_notebook, dtype)
         output[:,:,i_t] = temp[:,:,0]
 
-    return (np.sum(output,axis=2).reshape(1, total_time_steps, 1)>0).astype(float)
+    return (np.sum(output,axis=2).reshape(1, total_time_steps, 1)>0).astype(dtype)
 
-def concatenate_binarize_annotations(corpus, type, nonZero, video_indices, separation=0, provided_annotation=None, from_notebook=False):
+def concatenate_binarize_annotations(corpus, type, nonZero, video_indices, separation=0, provided_annotation=None, from_notebook=False, dtype=np.float32):
     """
         Concatenates and binarize annotations of one type for several videos
 
@@ -170,6 +445,7 @@ def concatenate_binarize_annotations(corpus, type, nonZero, video_indices, separ
             separation: (integer) frames to separate videos
             provided_annotation: raw annotation data (not needed)
             from_notebook: True if used in Jupyter notebook
+            dtype: data type of the output (default float32)
 
         Outputs:
             Concatenated binarized data, shape (1, time_steps, 1)
@@ -183,7 +459,7 @@ def concatenate_binarize_annotations(corpus, type, nonZero, video_indices, separ
     if provided_annotation is None:
         provided_annotation = get_raw_annotation_from_file(corpus, from_notebook)
 
-    output = concatenate_annotations(corpus, type, video_indices, separation, provided_annotation, from_notebook)
+    output = concatenate_annotations(corpus, type, video_indices, separation, provided_annotation, from_notebook, dtype)
 
     if nonZero!='all':
         N_nonZero = len(nonZero)
@@ -192,9 +468,9 @@ def concatenate_binarize_annotations(corpus, type, nonZero, video_indices, separ
             mask_class_garbage *= (output != nonZero[i_c])
         output[mask_class_garbage] = 0
 
-    return (output>0).astype(float)
+    return (output>0).astype(dtype)
 
-def concatenate_categorize_annotations(corpus, type, nonZero, video_indices, separation=0, provided_annotation=None, from_notebook=False):
+def concatenate_categorize_annotations(corpus, type, nonZero, video_indices, separation=0, provided_annotation=None, from_notebook=False, dtype=np.float32):
     """
         Concatenates and make categorical annotations of one type for several videos
 
@@ -208,6 +484,7 @@ def concatenate_categorize_annotations(corpus, type, nonZero, video_indices, sep
             separation: (integer) frames to separate videos
             provided_annotation: raw annotation data (not needed)
             from_notebook: True if used in Jupyter notebook
+            dtype: data type of the output (default float32)
 
         Outputs:
             Concatenated categorical data, shape (1, time_steps, C+1) where C is the number of nonZero categories
@@ -221,8 +498,8 @@ def concatenate_categorize_annotations(corpus, type, nonZero, video_indices, sep
     if provided_annotation is None:
         provided_annotation = get_raw_annotation_from_file(corpus, from_notebook)
 
-    output_raw = concatenate_annotations(corpus, type, video_indices, separation, provided_annotation, from_notebook)
-    output_binary = concatenate_binarize_annotations(corpus, type, nonZero, video_indices, separation, provided_annotation, from_notebook)
+    output_raw = concatenate_annotations(corpus, type, video_indices, separation, provided_annotation, from_notebook, dtype)
+    output_binary = concatenate_binarize_annotations(corpus, type, nonZero, video_indices, separation, provided_annotation, from_notebook, dtype)
 
     C = len(nonZero)
     if C==0:
@@ -233,69 +510,238 @@ def concatenate_categorize_annotations(corpus, type, nonZero, video_indices, sep
     for i_C in range(1,C+1):
         output_raw[output_raw==nonZero[i_C-1]] = i_C
 
-    return to_categorical(output_raw, C+1)
+    return to_categorical(output_raw, C+1).astype(dtype, copy=False)
 
-def get_concatenated_sign_types(corpus, types, nonZero, video_indices, separation=0, provided_annotation=None, from_notebook=False):
+def concatenate_rle_annotations(corpus, type, nonZero, video_indices, separation=0, provided_annotation=None, from_notebook=False):
     """
-        Concatenates and returns a matrix of sign types
+        Concatenates annotations of one type for several videos, run-length encoded
+        (same classes as the argmax of concatenate_categorize_annotations,
+        or as concatenate_binarize_annotations if nonZero is 'all').
+        Dense one-hot frames can then be obtained with to_categorical(C+1, start, end).
 
         Inputs:
             corpus: 'DictaSign' or 'NCSLGR'
-            types: a list of lists of types to regroup
-                DictaSign: subset of ['fls' (with different categories), 'PT', 'PT_PRO1', 'PT_PRO2', 'PT_PRO3', 'PT_LOC', 'PT_DET', 'PT_LBUOY', 'PT_BUOY', 'DS', 'DSA', 'DSG', 'DSL', 'DSM', 'DSS', 'DST', 'DSX', 'FBUOY', 'N', 'FS']
-                NCSLGR: subset of ['other', 'lexical_with_ns_not_fs' (only 0/1), 'fingerspelling', 'fingerspelled_loan_signs', 'IX_1p', 'IX_2p', 'IX_3p', 'IX_loc', 'POSS', 'SELF', 'gesture', 'part_indef', 'DCL', 'LCL', 'SCL', 'BCL', 'ICL', 'BPCL', 'PCL']
-            nonZero: a list lists of non-zero categories to count positively
-                     if anything other than 0 is counted positive, choose []
+            type: annotation type (see concatenate_annotations)
+            nonZero: 'all' (if anything other than 0 should be counted as 1)
+                      or a list of non-zero categories (class i+1 for nonZero[i], 0 for other values)
             video_indices: list/array of integers
             separation: (integer) frames to separate videos
             provided_annotation: raw annotation data (not needed)
             from_notebook: True if used in Jupyter notebook
 
         Outputs:
-            Concatenated categorical data, shape (1, time_steps, C+1) where C is the number of major types
-
-            e.g.1 : types = [['DS'], ['PT']], nonZeros = [[], []]
-            e.g.2 : types = [['PT_PRO1', 'PT_PRO2', 'PT_PRO3'], ['fls']], nonZeros = [[], [41891,43413,42495,42093]]
-            e.g.3 : types = [['PT_PRO1', 'PT_PRO2', 'PT_PRO3'], ['fls']], nonZeros = [[], []]
-
+            RunLengthAnnotation
     """
 
     video_indices = list(video_indices)
-    N_videos = len(video_indices)
-    if N_videos == 0:
+    if len(video_indices) == 0:
         sys.exit('At least one video index is required')
 
-    types = list(types)
-    N_types = len(types)
-    if N_types == 0:
-        sys.exit('At least one annotation type is required')
-
     if provided_annotation is None:
         provided_annotation = get_raw_annotation_from_file(corpus, from_notebook)
 
-    tmp = concatenate_annotations(corpus, types[0][0], video_indices, separation, provided_annotation, from_notebook)
+    if nonZero == 'all':
+        lut = None
+    else:
+        lut = {int(nonZero[i_C]): i_C+1 for i_C in range(len(nonZero)) if nonZero[i_C] > 0}
+
+    annotations = []
+    for i_v in video_indices:
+        temp = RunLengthAnnotation.from_dense(get_raw_annotation_type_video(corpus, type, i_v, provided_annotation, from_notebook))
+        if lut is None:
+            temp = RunLengthAnnotation(temp.starts, temp.ends, temp.values > 0, temp.length).merged()
+        else:
+            temp = temp.map_values(lut)
+        annotations.append(temp)
+
+    return RunLengthAnnotation.concatenate(annotations, separation)
+
+def get_label_heads(output_form, types, nonZero, binary=[]):
+    """
+        Checks a label specification and returns one head description per output:
+        ('fuse', types), ('binarize', type, nonZero or 'all') or ('categorize', type, nonZero)
 
-    output = np.zeros((1, tmp.shape[1], N_types+1))
+        Inputs:
+            output_form: 'mixed' or 'sign_types'
+            types, nonZero, binary: see get_concatenated_sign_types and get_concatenated_mixed
 
+        Outputs:
+            list of head descriptions, list of number of classes per head
+    """
+    N_types = len(types)
+    if N_types == 0:
+        sys.exit('At least one annotation type is required')
+
+    heads = []
+    nb_classes = []
     for i_t in range(N_types):
+        is_binary = output_form == 'sign_types' or binary[i_t]
         if len(types[i_t])==0:
             sys.exit('There should be at least one annotation category per type')
         elif len(types[i_t])>1:
-            if len(nonZero[i_t])>0:
+            if len(nonZero[i_t])>0 or not is_binary:
                 sys.exit('Grouping several annotation types with non-binary annotation is ambiguous')
-            else: # len(nonZero[i_t])==0
-                output[0,:,i_t+1] = concatenate_fuse_annotations(corpus, types[i_t], video_indices, separation, provided_annotation, from_notebook)[0,:,0]
-        else: # len(types[i_t])==1
-            if len(nonZero[i_t])>0:
-                output[0,:,i_t+1] = concatenate_binarize_annotations(corpus, types[i_t][0], nonZero[i_t], video_indices, separation, provided_annotation, from_notebook)[0,:,0]
-            else: # len(nonZero[i_t])==0:
-                output[0,:,i_t+1] = concatenate_binarize_annotations(corpus, types[i_t][0], 'all', video_indices, separation, provided_annotation, from_notebook)[0,:,0]
+            heads.append(('fuse', list(types[i_t])))
+            nb_classes.append(2)
+        elif len(nonZero[i_t])>0:
+            if is_binary:
+                heads.append(('binarize', types[i_t][0], list(nonZero[i_t])))
+                nb_classes.append(2)
+            else:
+                heads.append(('categorize', types[i_t][0], list(nonZero[i_t])))
+                nb_classes.append(len(nonZero[i_t])+1)
+        else:
+            if not is_binary:
+                sys.exit('Non-binary categorical output requires at least one nonZero value')
+            heads.append(('binarize', types[i_t][0], 'all'))
+            nb_classes.append(2)
+    return heads, nb_classes
+
+def apply_label_lut(raw, lut):
+    """
+        Maps raw annotation values to classes with a value->class dict (missing values -> 0)
+        The dict is only applied on the unique values of raw.
+    """
+    values, inverse = np.unique(raw, return_inverse=True)
+    classes = np.array([lut.get(v, 0) for v in values.tolist()], dtype=np.int64)
+    return classes[inverse.reshape(-1)]
+
+def get_labels_cache_key(corpus, heads, video_indices, separation, annotation_cache):
+    """
+        Key of compiled labels in the on-disk cache
+    """
+    return repr((corpus, heads, [int(v) for v in video_indices], separation, annotation_cache.mtime))
+
+def save_labels_cache(cache_file, data):
+    """
+        Writes an array of the labels cache (written to a temporary file first,
+        so that concurrent runs never read a partial file)
+    """
+    cache_path = os.path.dirname(cache_file)
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_path)
+    tmp_file = cache_file[:-4] + '.tmp' + str(os.getpid()) + '.npy'
+    np.save(tmp_file, data)
+    os.replace(tmp_file, cache_file)
+
+def compile_labels(corpus, output_form, types, nonZero, binary, video_indices, separation=0, provided_annotation=None, from_notebook=False, use_cache=True):
+    """
+        Compiles the labels of all output heads in a single pass over the videos:
+        each needed annotation type is read once per video and mapped to classes with lookup tables.
+        When annotations come from file, the result is cached on disk
+        (data/processed/<corpus>/labels/), keyed by the specification, the video indices,
+        the separation and the annotation file modification time.
+
+        Inputs:
+            corpus: 'DictaSign' or 'NCSLGR'
+            output_form: 'mixed' or 'sign_types'
+            types, nonZero, binary: see get_concatenated_sign_types and get_concatenated_mixed
+            video_indices: list/array of integers
+            separation: (integer) frames to separate videos
+            provided_annotation: raw annotation data (not needed)
+            from_notebook: True if used in Jupyter notebook
+            use_cache: read/write the on-disk cache
+
+        Outputs:
+            classes: int array [N_heads, time_steps] (class of each frame for each head, 0 in separations)
+            nb_classes: list of number of classes per head
+    """
+    if from_notebook:
+        parent = '../'
+    else:
+        parent = ''
+
+    video_indices = [int(v) for v in video_indices]
+    N_videos = len(video_indices)
+    if N_videos == 0:
+        sys.exit('At least one video index is required')
+
+    heads, nb_classes = get_label_heads(output_form, types, nonZero, binary)
+
+    annotation_cache = get_annotation_cache(corpus, from_notebook)
+    if provided_annotation is None:
+        provided_annotation = annotation_cache.annotation
+    use_cache = use_cache and provided_annotation is annotation_cache.annotation
+
+    if use_cache:
+        cache_key = get_labels_cache_key(corpus, heads, video_indices, separation, annotation_cache)
+        cache_path = parent + 'data/processed/' + corpus + '/labels/'
+        cache_file = cache_path + hashlib.sha1(cache_key.encode()).hexdigest() + '.npy'
+        if os.path.isfile(cache_file):
+            return np.load(cache_file), nb_classes
+
+    video_lengths = [get_raw_annotation_type_video(corpus, types[0][0], i_v, provided_annotation, from_notebook).shape[0] for i_v in video_indices]
+    total_time_steps = int(np.sum(video_lengths)) + N_videos*separation
+
+    classes = np.zeros((len(heads), total_time_steps), dtype=np.result_type(np.min_scalar_type(max(nb_classes)), np.uint8))
+    luts = []
+    for head in heads:
+        if head[0] == 'categorize':
+            luts.append({v: i_C+1 for i_C, v in enumerate(head[2]) if v > 0})
+        elif head[0] == 'binarize' and head[2] != 'all':
+            luts.append({v: 1 for v in head[2] if v > 0})
+        else:
+            luts.append(None)
+
+    img_start_idx = 0
+    for i_vid in range(N_videos):
+        raw = {}
+        for head in heads:
+            for t in (head[1] if head[0] == 'fuse' else [head[1]]):
+                if t not in raw:
+                    raw[t] = np.reshape(get_raw_annotation_type_video(corpus, t, video_indices[i_vid], provided_annotation, from_notebook), -1)
+        out = classes[:, img_start_idx:img_start_idx+video_lengths[i_vid]]
+        for i_h in range(len(heads)):
+            head = heads[i_h]
+            if head[0] == 'fuse':
+                for t in head[1]:
+                    out[i_h] |= (raw[t] > 0)
+            elif luts[i_h] is None:
+                out[i_h] = raw[head[1]] > 0
+            else:
+                out[i_h] = apply_label_lut(raw[head[1]], luts[i_h])
+        img_start_idx += video_lengths[i_vid] + separation
+
+    if use_cache:
+        save_labels_cache(cache_file, classes)
+
+    return classes, nb_classes
+
+def get_concatenated_sign_types(corpus, types, nonZero, video_indices, separation=0, provided_annotation=None, from_notebook=False, dtype=np.float32):
+    """
+        Concatenates and returns a matrix of sign types
+
+        Inputs:
+            corpus: 'DictaSign' or 'NCSLGR'
+            types: a list of lists of types to regroup
+                DictaSign: subset of ['fls' (with different categories), 'PT', 'PT_PRO1', 'PT_PRO2', 'PT_PRO3', 'PT_LOC', 'PT_DET', 'PT_LBUOY', 'PT_BUOY', 'DS', 'DSA', 'DSG', 'DSL', 'DSM', 'DSS', 'DST', 'DSX', 'FBUOY', 'N', 'FS']
+                NCSLGR: subset of ['other', 'lexical_with_ns_not_fs' (only 0/1), 'fingerspelling', 'fingerspelled_loan_signs', 'IX_1p', 'IX_2p', 'IX_3p', 'IX_loc', 'POSS', 'SELF', 'gesture', 'part_indef', 'DCL', 'LCL', 'SCL', 'BCL', 'ICL', 'BPCL', 'PCL']
+            nonZero: a list lists of non-zero categories to count positively
+                     if anything other than 0 is counted positive, choose []
+            video_indices: list/array of integers
+            separation: (integer) frames to separate videos
+            provided_annotation: raw annotation data (not needed)
+            from_notebook: True if used in Jupyter notebook
+            dtype: data type of the output (default float32)
+
+        Outputs:
+            Concatenated categorical data, shape (1, time_steps, C+1) where C is the number of major types
+
+            e.g.1 : types = [['DS'], ['PT']], nonZeros = [[], []]
+            e.g.2 : types = [['PT_PRO1', 'PT_PRO2', 'PT_PRO3'], ['fls']], nonZeros = [[], [41891,43413,42495,42093]]
+            e.g.3 : types = [['PT_PRO1', 'PT_PRO2', 'PT_PRO3'], ['fls']], nonZeros = [[], []]
+
+    """
+
+    classes, nb_classes = compile_labels(corpus, 'sign_types', types, nonZero, [], video_indices, separation, provided_annotation, from_notebook)
 
-    output[0,:,0] = (1-(np.sum(output,axis=2)>0)).astype(bool)
+    output = np.zeros((1, classes.shape[1], classes.shape[0]+1), dtype=dtype)
+    output[0,:,1:] = classes.T
+    output[0,:,0] = ~np.any(classes, axis=0)
 
     return output
 
-def get_concatenated_mixed(corpus, types, nonZero, binary, video_indices, separation=0, provided_annotation=None, from_notebook=False):
+def get_concatenated_mixed(corpus, types, nonZero, binary, video_indices, separation=0, provided_annotation=None, from_notebook=False, dtype=np.float32):
     """
         Concatenates and returns a list of outputs, binary or categorical
 
@@ -311,6 +757,7 @@ def get_concatenated_mixed(corpus, types, nonZero, binary, video_indices, separa
             separation: (integer) frames to separate videos
             provided_annotation: raw annotation data (not needed)
             from_notebook: True if used in Jupyter notebook
+            dtype: data type of the output (default float32)
 
         Outputs:
             Concatenated categorical data, shape (1, time_steps, C+1) where C is the number of major types
@@ -322,49 +769,168 @@ def get_concatenated_mixed(corpus, types, nonZero, binary, video_indices, separa
 
     """
 
-    video_indices = list(video_indices)
-    N_videos = len(video_indices)
-    if N_videos == 0:
-        sys.exit('At least one video index is required')
+    classes, nb_classes = compile_labels(corpus, 'mixed', types, nonZero, binary, video_indices, separation, provided_annotation, from_notebook)
 
-    types = list(types)
-    N_types = len(types)
-    if N_types == 0:
-        sys.exit('At least one annotation type is required')
+    output_list = []
+    for i_h in range(classes.shape[0]):
+        output_list.append(np.eye(nb_classes[i_h], dtype=dtype)[classes[i_h]][np.newaxis])
+    return output_list
+
+def get_rle_labels(corpus, output_form, types, nonZero, binary, video_indices, separation=0, provided_annotation=None, from_notebook=False, dtype=np.float32):
+    """
+        Same labels as get_concatenated_mixed or get_concatenated_sign_types, loaded as runs
+        (see concatenate_rle_annotations) and returned as RunLengthLabels,
+        dense labels being only built for the frames read (e.g. per batch)
+
+        Inputs:
+            see compile_labels
+            dtype: data type of the labels (default float32)
+
+        Outputs:
+            list of RunLengthLabels (output_form: 'mixed') or one RunLengthLabels (output_form: 'sign_types')
+    """
+    heads, nb_classes = get_label_heads(output_form, types, nonZero, binary)
 
     if provided_annotation is None:
         provided_annotation = get_raw_annotation_from_file(corpus, from_notebook)
 
-    tmp = concatenate_annotations(corpus, types[0][0], video_indices, separation, provided_annotation, from_notebook)
+    head_runs = []
+    for head in heads:
+        if head[0] == 'fuse':
+            runs = RunLengthAnnotation.combine([concatenate_rle_annotations(corpus, t, 'all', video_indices, separation, provided_annotation, from_notebook) for t in head[1]],
+                                               lambda values: np.any(values, axis=0))
+        elif head[0] == 'binarize' and head[2] != 'all':
+            runs = concatenate_rle_annotations(corpus, head[1], head[2], video_indices, separation, provided_annotation, from_notebook)
+            runs = RunLengthAnnotation(runs.starts, runs.ends, runs.values > 0, runs.length).merged()
+        else:
+            runs = concatenate_rle_annotations(corpus, head[1], head[2], video_indices, separation, provided_annotation, from_notebook)
+        head_runs.append(runs)
 
-    output_list = []
-    for i_t in range(N_types):
-        if len(types[i_t])==0:
-            sys.exit('There should be at least one annotation category per type')
-        elif len(types[i_t])>1:
-            if len(nonZero[i_t])>0 or not binary[i_t]:
-                sys.exit('Grouping several annotation types with non-binary annotation is ambiguous')
-            else: # len(nonZero[i_t])==0 and binary[i_t]:
-                output_list.append(to_categorical(concatenate_fuse_annotations(corpus, types[i_t], video_indices, separation, provided_annotation, from_notebook),2))
-        else: # len(types[i_t])==1
-            if len(nonZero[i_t])>0:
-                if binary[i_t]:
-                    output_list.append(to_categorical(concatenate_binarize_annotations(corpus, types[i_t][0], nonZero[i_t], video_indices, separation, provided_annotation, from_notebook),2))
-                else: # not binary[i_t]:
-                    output_list.append(concatenate_categorize_annotations(corpus, types[i_t][0], nonZero[i_t], video_indices, separation, provided_annotation, from_notebook))
-            else: # len(nonZero[i_t])==0
-                if binary[i_t]:
-                    output_list.append(to_categorical(concatenate_binarize_annotations(corpus, types[i_t][0], 'all', video_indices, separation, provided_annotation, from_notebook),2))
-                else: # not binary[i_t]:
-                    sys.exit('Non-binary categorical output requires at least one nonZero value')
-    return output_list
+    if output_form == 'mixed':
+        return [RunLengthLabels(head_runs[i_h], np.eye(nb_classes[i_h], dtype=dtype)) for i_h in range(len(heads))]
+    elif output_form == 'sign_types':
+        # runs of the set of present types (bit i for type i), then one code per set: [none, type 1, ..., type C]
+        runs = RunLengthAnnotation.combine(head_runs, lambda values: np.sum(values.astype(np.int64) << np.arange(len(heads))[:, np.newaxis], axis=0))
+        sets, code_values = np.unique(runs.values, return_inverse=True)
+        codes = np.zeros((sets.size, len(heads)+1), dtype=dtype)
+        codes[:, 0] = sets == 0
+        codes[:, 1:] = (sets[:, np.newaxis] >> np.arange(len(heads))) & 1
+        return RunLengthLabels(RunLengthAnnotation(runs.starts, runs.ends, code_values.reshape(-1), runs.length), codes)
+    else:
+        sys.exit('Wrong annotation format')
+
+def get_frame_classes(corpus, output_form, types, nonZero, binary, video_indices, separation=100, provided_annotation=None, from_notebook=False):
+    """
+        Class of each frame of each output, i.e. the argmax of the arrays returned by get_data_concatenated,
+        obtained from the compiled labels without building the one-hot outputs
+
+        Inputs:
+            see compile_labels (default separation is the one of get_data_concatenated)
+
+        Outputs:
+            list of int arrays [time_steps] (one per output for 'mixed', one for 'sign_types')
+            list of number of classes of each output
+    """
+    classes, nb_classes = compile_labels(corpus, output_form, types, nonZero, binary, video_indices, separation, provided_annotation, from_notebook)
+
+    if output_form == 'mixed':
+        return [classes[i_h] for i_h in range(classes.shape[0])], nb_classes
+    elif output_form == 'sign_types':
+        # argmax of [none, type 1, ..., type C]: first positive type, 0 if none
+        positive = classes > 0
+        frame_classes = np.where(positive.any(axis=0), np.argmax(positive, axis=0) + 1, 0)
+        return [frame_classes], [classes.shape[0]+1]
+    else:
+        sys.exit('Wrong annotation format')
+
+def get_labels_weight_from_classes(frame_classes, output_class_weights, dtype=np.float32):
+    """
+        Per-frame weights from class weights, with one lookup per output
+
+        Inputs:
+            frame_classes: list of int arrays [time_steps] (see get_frame_classes)
+            output_class_weights: list of vector of weights for each class of each output
+            dtype: data type of the output (default float32)
+
+        Outputs:
+            list of arrays (1, time_steps), one per output
+    """
+    return [np.asarray(output_class_weights[i_o], dtype=dtype)[frame_classes[i_o]][np.newaxis] for i_o in range(len(frame_classes))]
+
+def get_sample_weights(corpus, output_form, types, nonZero, binary, video_indices, output_class_weights, separation=100, provided_annotation=None, from_notebook=False, dtype=np.float32, use_cache=True):
+    """
+        Per-frame sample weights of a set of videos, for train_model (sample_weights_train/sample_weights_valid).
+        When annotations come from file, weights are cached on disk next to the compiled labels,
+        keyed by the label specification, the video indices, the separation and the class weights
+        (e.g. reused by runs with the same split and weightCorrection).
+
+        Inputs:
+            see get_frame_classes
+            output_class_weights: list of vector of weights for each class of each output
+            dtype: data type of the output (default float32)
+            use_cache: read/write the on-disk cache
+
+        Outputs:
+            list of arrays (1, time_steps) (output_form: 'mixed') or one array (1, time_steps) (output_form: 'sign_types')
+    """
+    if from_notebook:
+        parent = '../'
+    else:
+        parent = ''
+
+    annotation_cache = get_annotation_cache(corpus, from_notebook)
+    use_cache = use_cache and (provided_annotation is None or provided_annotation is annotation_cache.annotation)
+
+    if use_cache:
+        heads, _ = get_label_heads(output_form, types, nonZero, binary)
+        weights_key = repr([np.asarray(w, dtype=dtype).tolist() for w in output_class_weights])
+        cache_key = get_labels_cache_key(corpus, heads, video_indices, separation, annotation_cache) + output_form + weights_key + np.dtype(dtype).name
+        cache_file = parent + 'data/processed/' + corpus + '/labels/' + hashlib.sha1(cache_key.encode()).hexdigest() + '_weights.npy'
+        if os.path.isfile(cache_file):
+            labels_weight = list(np.load(cache_file))
+        else:
+            labels_weight = None
+    else:
+        labels_weight = None
+
+    if labels_weight is None:
+        frame_classes, _ = get_frame_classes(corpus, output_form, types, nonZero, binary, video_indices, separation, provided_annotation, from_notebook)
+        labels_weight = get_labels_weight_from_classes(frame_classes, output_class_weights, dtype)
+        if use_cache:
+            save_labels_cache(cache_file, np.stack(labels_weight))
+
+    if output_form == 'sign_types':
+        return labels_weight[0]
+    return labels_weight
+
+def get_features_video_file(corpus, video, input_type, from_notebook=False):
+    """
+        File of the features of one video, in the format of cslr_limsi_features
+        (input_type including the suffix of normalized features, if any)
+    """
+    if from_notebook:
+        parent = '../'
+    else:
+        parent = ''
+    if corpus == 'DictaSign':
+        vidName = 'DictaSign_lsf_' + video + '_front'
+    else:
+        vidName = video
+    return parent + 'data/processed/' + corpus + '/' + vidName + '_' + input_type + '.npy'
+
+def get_features_number_video_file(corpus, video, input_type, from_notebook=False):
+    """
+        Number of features stored in the file of one video (see get_features_video_file), without loading it
+    """
+    return np.load(get_features_video_file(corpus, video, input_type, from_notebook), mmap_mode='r').shape[1]
 
 def get_features_videos(corpus,
                         input_type='bodyFace_3D_features_hands_OP_HS',
                         input_normed=True,
                         input_type_format='old',
                         video_indices=np.arange(94),
-                        from_notebook=False):
+                        from_notebook=False,
+                        dtype=np.float32):
     """
         Gets all wanted features.
 
@@ -372,65 +938,60 @@ def get_features_videos(corpus,
             corpus (string)
             video_indices: list or numpy array of wanted videos
             from_notebook: if notebook script, data is in parent folder
+            dtype: data type of the features (default float32)
 
         Outputs:
             features (list  of numpy arrays [1, time_steps, features_number])
+            All arrays are views of a single buffer [total_time_steps, features_number]
     """
 
     features = []
 
     if input_type_format == 'old':
-        features_dict, features_number = getFeaturesDict(input_type, input_normed)
+        gather_plan, features_number = getFeaturesGatherPlan(input_type, input_normed)
     elif input_type_format == 'cslr_limsi_features':
-        features_number = getFeaturesNumberCslrLimsiFeatures(input_type)
+        features_number = None
     else:
         sys.exit('Wrong input type format')
 
 
-    if from_notebook:
-        parent = '../'
-    else:
-        parent = ''
-
     if input_normed:
         suffix='_normalized'
     else:
         suffix=''
 
-    list_videos = np.load(parent + 'data/processed/' + corpus + '/list_videos.npy')
+    annotation_cache = get_annotation_cache(corpus, from_notebook)
+    list_videos = annotation_cache.list_videos
+    video_lengths = annotation_cache.video_lengths
+    if features_number is None:
+        if input_type.startswith('cnn_'):
+            features_number = get_features_number_video_file(corpus, list_videos[video_indices[0]], input_type + suffix, from_notebook)
+        else:
+            features_number = getFeaturesNumberCslrLimsiFeatures(input_type)
 
-    if corpus == 'DictaSign':
-        annotation_raw = np.load(parent + 'data/processed/DictaSign/annotations.npz', encoding='latin1', allow_pickle=True)['dataBrut_DS'] # for counting nb of images
-    elif corpus == 'NCSLGR':
-        annotation_raw = np.load(parent + 'data/processed/NCSLGR/annotations.npz', encoding='latin1', allow_pickle=True)['lexical_with_ns_not_fs'] # for counting nb of images
-    else:
-        sys.exit('Invalid corpus name')
-
-    for vid_idx in video_indices:
-        time_steps = annotation_raw[vid_idx].shape[0]
-        features.append(np.zeros((1, time_steps, features_number)))
+    # One buffer for the whole split, each video being a slice of it
+    video_offsets = np.zeros(len(video_indices)+1, dtype=int)
+    video_offsets[1:] = np.cumsum(video_lengths[np.asarray(video_indices, dtype=int)])
+    features_buffer = np.zeros((video_offsets[-1], features_number), dtype=dtype)
+    for index_vid_tmp in range(len(video_indices)):
+        features.append(features_buffer[np.newaxis, video_offsets[index_vid_tmp]:video_offsets[index_vid_tmp+1], :])
 
     if input_type_format == 'old':
-        features_number_idx = 0
-        for key in features_dict:
-            key_features_idx = features_dict[key]
-            key_features_number = key_features_idx.size
-            if key_features_number > 0:
-                key_features = np.load(parent + 'data/processed/' + corpus + '/' + key + '.npy', encoding='latin1', allow_pickle=True)
-                index_vid_tmp = 0
-                for vid_idx in video_indices:
-                    features[index_vid_tmp][0, :, features_number_idx:features_number_idx+key_features_number] = key_features[vid_idx][:, key_features_idx]
-                    index_vid_tmp += 1
-                features_number_idx += key_features_number
+        for key, runs in gather_plan:
+            key_features = get_features_family(corpus, key, from_notebook)
+            index_vid_tmp = 0
+            for vid_idx in video_indices:
+                key_features_vid = key_features[vid_idx]
+                start = video_offsets[index_vid_tmp]
+                end   = video_offsets[index_vid_tmp+1]
+                for src_start, src_end, dst_start, dst_end in runs:
+                    features_buffer[start:end, dst_start:dst_end] = key_features_vid[:, src_start:src_end]
+                index_vid_tmp += 1
     elif input_type_format == 'cslr_limsi_features':
         index_vid_tmp = 0
         for vid_idx in video_indices:
-            if corpus == 'DictaSign':
-                vidName = 'DictaSign_lsf_' + list_videos[vid_idx] + '_front'
-            else:
-                vidName = list_videos[vid_idx]
-            loaded_features = np.load(parent + 'data/processed/' + corpus + '/' + vidName + '_' + input_type + suffix + '.npy', encoding='latin1', allow_pickle=True)
-            time_steps = annotation_raw[vid_idx].shape[0]
+            loaded_features = np.load(get_features_video_file(corpus, list_videos[vid_idx], input_type + suffix, from_notebook), encoding='latin1', allow_pickle=True)
+            time_steps = video_lengths[vid_idx]
             T_loaded_features = loaded_features.shape[0]
             if T_loaded_features > time_steps:
                 features[index_vid_tmp][0, :, :] = loaded_features[:time_steps, :]
@@ -452,7 +1013,8 @@ def get_sequence_features(corpus,
                            input_type_format='old',
                            time_steps=100,
                            preloaded_features=None,
-                           from_notebook=False):
+                           from_notebook=False,
+                           dtype=np.float32):
     """
         Function returning features for a sequence.
 
@@ -463,6 +1025,7 @@ def get_sequence_features(corpus,
             time_steps: length of sequence (int)
             preloaded_features: if features are already loaded, in the format of a list (features for each video)
             from_notebook: if notebook script, data is in parent folder
+            dtype: data type of the features (default float32)
 
         Outputs:
             X: a numpy array [1, time_steps, features_number] for features
@@ -475,28 +1038,37 @@ def get_sequence_features(corpus,
 
     if preloaded_features is None:
         if input_type_format == 'old':
-            features_dict, features_number = getFeaturesDict(input_type, input_normed)
+            gather_plan, features_number = getFeaturesGatherPlan(input_type, input_normed)
         elif input_type_format == 'cslr_limsi_features':
-            features_number = getFeaturesNumberCslrLimsiFeatures(input_type)
+            if input_type.startswith('cnn_'):
+                if input_normed:
+                    suffix='_normalized'
+                else:
+                    suffix=''
+                list_videos = get_annotation_cache(corpus, from_notebook).list_videos
+                features_number = get_features_number_video_file(corpus, list_videos[vid_idx], input_type + suffix, from_notebook)
+            else:
+                features_number = getFeaturesNumberCslrLimsiFeatures(input_type)
         else:
             sys.exit('Wrong input type format')
 
     else:
-        features_number = preloaded_features[vid_idx].shape[1]
+        features_number = preloaded_features[vid_idx].shape[2]
 
-    X = np.zeros((1, time_steps, features_number))
+    X = np.zeros((1, time_steps, features_number), dtype=dtype)
 
     if preloaded_features is None:
         if input_type_format == 'old':
-            features_number_idx = 0
-            for key in features_dict:
-                key_features_idx = features_dict[key]
-                key_features_number = key_features_idx.size
-                if key_features_number > 0:
-                    key_features = np.load(parent + 'data/processed/' + corpus + '/' + key + '.npy', encoding='latin1', allow_pickle=True)[vid_idx]
-                    X[0, :, features_number_idx:features_number_idx+key_features_number] = key_features[img_start_idx:img_start_idx + time_steps, key_features_idx]
-                    features_number_idx += key_features_number
+            for key, runs in gather_plan:
+                key_features = get_features_family(corpus, key, from_notebook)[vid_idx]
+                for src_start, src_end, dst_start, dst_end in runs:
+                    X[0, :, dst_start:dst_end] = key_features[img_start_idx:img_start_idx + time_steps, src_start:src_end]
         elif input_type_format == 'cslr_limsi_features':
+            list_videos = get_annotation_cache(corpus, from_notebook).list_videos
+            if input_normed:
+                suffix='_normalized'
+            else:
+                suffix=''
             if corpus == 'DictaSign':
                 vidName = 'DictaSign_lsf_' + list_videos[vid_idx] + '_front'
             else:
@@ -515,7 +1087,8 @@ def get_sequence_annotations_mixed(corpus,
                                    img_start_idx=0,
                                    time_steps=100,
                                    provided_annotation=None,
-                                   from_notebook=False):
+                                   from_notebook=False,
+                                   dtype=np.float32):
     """
         For returning annotations for a sequence, in the form of a list of different categories.
             e.g.: get_sequence_annotations_categories('DictaSign',
@@ -533,6 +1106,7 @@ def get_sequence_annotations_mixed(corpus,
             time_steps: length of sequences (int)
             provided_annotation: raw annotation data (not needed)
             from_notebook: if notebook script, data is in parent folder
+            dtype: data type of the output (default float32)
 
         Outputs:
             Y: a list, comprising annotations
@@ -542,7 +1116,7 @@ def get_sequence_annotations_mixed(corpus,
         provided_annotation = get_raw_annotation_from_file(corpus, from_notebook)
 
 
-    Y = get_concatenated_mixed(corpus, types, nonZero, binary, video_indices=[video_index], separation=0, provided_annotation=provided_annotation, from_notebook=from_notebook)
+    Y = get_concatenated_mixed(corpus, types, nonZero, binary, video_indices=[video_index], separation=0, provided_annotation=provided_annotation, from_notebook=from_notebook, dtype=dtype)
 
     N_types = len(types)
 
@@ -559,7 +1133,8 @@ def get_sequence_annotations_sign_types(corpus,
                                         img_start_idx=0,
                                         time_steps=100,
                                         provided_annotation=None,
-                                        from_notebook=False):
+                                        from_notebook=False,
+                                        dtype=np.float32):
     """
         For returning annotations for a sequence, in the form of a list of different categories, each of which is a list of video annotations.
             e.g.: get_sequence_annotations('DictaSign',
@@ -580,6 +1155,7 @@ def get_sequence_annotations_sign_types(corpus,
             time_steps: length of sequences (int)
             provided_annotation: raw annotation data (not needed)
             from_notebook: if notebook script, data is in parent folder
+            dtype: data type of the output (default float32)
 
         Outputs:
             Y: an annotation array
@@ -587,11 +1163,197 @@ def get_sequence_annotations_sign_types(corpus,
     if provided_annotation is None:
         provided_annotation = get_raw_annotation_from_file(corpus, from_notebook)
 
-    Y = get_concatenated_sign_types(corpus, types, nonZero, [video_index], 0, provided_annotation, from_notebook)
+    Y = get_concatenated_sign_types(corpus, types, nonZero, [video_index], 0, provided_annotation, from_notebook, dtype)
 
     return Y[:, img_start_idx:img_start_idx+time_steps, :]
 
 
+class FramePathSequence(object):
+    """
+        Frame paths of concatenated videos, computed on demand instead of being stored
+        in a fixed-width string array.
+        Frame i of video v is prefixes[v] + '%05d.jpg' % (i+1+first_frame),
+        each video being followed by separation frames pointing to empty_image_path.
+        Supports len(), integer indexing and contiguous slicing (which returns a new FramePathSequence).
+
+        Inputs:
+            prefixes: list of path prefixes (one per video), or None when frames are not used (paths are then '')
+            video_lengths: number of frames of each video
+            separation: number of empty frames after each video
+            empty_image_path: path of a white frame
+            first_frame: index of the first frame of each video (e.g. img_start_idx in get_sequence)
+    """
+    def __init__(self, prefixes, video_lengths, separation=0, empty_image_path='', first_frame=0, start=0, stop=None):
+        self.prefixes = prefixes
+        self.video_lengths = np.asarray(video_lengths, dtype=int)
+        self.separation = separation
+        self.empty_image_path = empty_image_path
+        self.first_frame = first_frame
+        self.offsets = np.zeros(self.video_lengths.size+1, dtype=int)
+        self.offsets[1:] = np.cumsum(self.video_lengths + separation)
+        self.start = start
+        self.stop = int(self.offsets[-1]) if stop is None else stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return FramePathSequence(self.prefixes, self.video_lengths, self.separation, self.empty_image_path,
+                                     self.first_frame, self.start + start, self.start + max(start, stop))
+        key = int(key)
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError('Frame index out of range')
+        if self.prefixes is None:
+            return ''
+        i_frame = self.start + key
+        i_vid = int(np.searchsorted(self.offsets, i_frame, side='right')) - 1
+        local_idx = i_frame - self.offsets[i_vid]
+        if local_idx >= self.video_lengths[i_vid]:
+            return self.empty_image_path
+        return self.prefixes[i_vid] + str(local_idx + 1 + self.first_frame).zfill(5) + '.jpg'
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def blank_mask(self, indices):
+        """
+            Boolean array, True for the separation frames among indices (no path is built)
+        """
+        i_frames = self.start + np.asarray(indices, dtype=int)
+        i_vids = np.searchsorted(self.offsets, i_frames, side='right') - 1
+        return i_frames - self.offsets[i_vids] >= self.video_lengths[i_vids]
+
+def get_frame_cache_path(corpus, img_width, img_height, from_notebook=False):
+    """
+        Folder of the decoded frame cache of a corpus at a given size
+    """
+    if from_notebook:
+        parent = '../'
+    else:
+        parent = ''
+    return parent + 'data/processed/' + corpus + '/frames_' + str(img_width) + 'x' + str(img_height) + '/'
+
+def build_frame_cache(corpus,
+                      video_indices,
+                      img_width=224,
+                      img_height=224,
+                      frames_path_before_video='/localHD/DictaSign/convert/img/DictaSign_lsf_',
+                      from_notebook=False,
+                      overwrite=False):
+    """
+        Decodes and resizes the frames of each video once, into one uint8 array [time_steps, img_width, img_height, 3]
+        per video (data/processed/<corpus>/frames_<img_width>x<img_height>/<video>.npy), read by FrameTensorSequence.
+        Frames are decoded as in training (load_img with target_size=(img_width, img_height)),
+        the CNN preprocessing is applied when batches are built.
+
+        Inputs:
+            corpus (string)
+            video_indices: numpy array for a list of videos
+            img_width, img_height: size of CNN input
+            frames_path_before_video: see get_data_concatenated
+            from_notebook: if notebook script, data is in parent folder
+            overwrite: if False, videos already cached are skipped
+
+        Outputs:
+            list of cached videos
+    """
+    annotation_cache = get_annotation_cache(corpus, from_notebook)
+    cache_path = get_frame_cache_path(corpus, img_width, img_height, from_notebook)
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_path)
+    cached = []
+    for vid_idx in video_indices:
+        video = annotation_cache.list_videos[vid_idx]
+        cache_file = cache_path + video + '.npy'
+        if os.path.isfile(cache_file) and not overwrite:
+            continue
+        video_length = int(annotation_cache.video_lengths[vid_idx])
+        prefix = frames_path_before_video + video + '_front/'
+        # written to a temporary file first, so that a partial cache is never used
+        tmp_file = cache_path + video + '.tmp' + str(os.getpid()) + '.npy'
+        frames = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=(video_length, img_width, img_height, 3))
+        for i_frame in range(video_length):
+            frames[i_frame] = img_to_array(load_img(prefix + str(i_frame + 1).zfill(5) + '.jpg', target_size=(img_width, img_height)))
+        frames.flush()
+        del frames
+        os.replace(tmp_file, cache_file)
+        cached.append(video)
+    return cached
+
+class FrameTensorSequence(object):
+    """
+        Decoded frames of concatenated videos, sliced from the memory-mapped per-video caches of build_frame_cache
+        instead of decoding JPEG files. Same layout as FramePathSequence (each video being followed by
+        separation white frames): supports len(), integer indexing (a uint8 array [img_width, img_height, 3])
+        and contiguous slicing (which returns a new FrameTensorSequence).
+        take(indices, out) copies several frames into out.
+
+        Inputs:
+            videos: list of arrays [time_steps, img_width, img_height, 3] (one per video)
+            separation: number of white frames after each video
+    """
+    def __init__(self, videos, separation=0, start=0, stop=None):
+        self.videos = videos
+        self.separation = separation
+        self.video_lengths = np.array([v.shape[0] for v in videos], dtype=int)
+        self.offsets = np.zeros(self.video_lengths.size+1, dtype=int)
+        self.offsets[1:] = np.cumsum(self.video_lengths + separation)
+        self.frame_shape = videos[0].shape[1:]
+        self.start = start
+        self.stop = int(self.offsets[-1]) if stop is None else stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return FrameTensorSequence(self.videos, self.separation, self.start + start, self.start + max(start, stop))
+        key = int(key)
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError('Frame index out of range')
+        out = np.zeros((1,) + self.frame_shape, dtype=np.uint8)
+        return self.take([key], out)[0]
+
+    def take(self, indices, out):
+        """
+            Copies frames indices into out (array [len(indices), img_width, img_height, 3], of any type)
+        """
+        i_frames = self.start + np.asarray(indices, dtype=int)
+        i_vids = np.searchsorted(self.offsets, i_frames, side='right') - 1
+        local_idx = i_frames - self.offsets[i_vids]
+        for i in range(i_frames.size):
+            if local_idx[i] < self.video_lengths[i_vids[i]]:
+                out[i] = self.videos[i_vids[i]][local_idx[i]]
+            else:
+                out[i] = 255
+        return out
+
+def get_frame_tensor_sequence(corpus, video_indices, separation=0, img_width=224, img_height=224, from_notebook=False):
+    """
+        FrameTensorSequence of a set of videos, or None if one of them is not in the frame cache
+    """
+    list_videos = get_annotation_cache(corpus, from_notebook).list_videos
+    cache_path = get_frame_cache_path(corpus, img_width, img_height, from_notebook)
+    videos = []
+    for vid_idx in video_indices:
+        cache_file = cache_path + list_videos[vid_idx] + '.npy'
+        if not os.path.isfile(cache_file):
+            return None
+        videos.append(np.load(cache_file, mmap_mode='r'))
+    return FrameTensorSequence(videos, separation)
+
 def get_sequence(corpus,
                  output_form,
                  types,
@@ -608,7 +1370,8 @@ def get_sequence(corpus,
                  features_type='features',
                  frames_path_before_video='/localHD/DictaSign/convert/img/DictaSign_lsf_',
                  empty_image_path='/localHD/DictaSign/convert/img/white.jpg',
-                 from_notebook=False):
+                 from_notebook=False,
+                 dtype=np.float32):
     """
         For returning features and annotations for a sequence.
 
@@ -626,43 +1389,36 @@ def get_sequence(corpus,
             preloaded_features: if features are already loaded, in the format of a list (features for each video)
             provided_annotation: raw annotation data (not needed)
             from_notebook: if notebook script, data is in parent folder
+            dtype: data type of features and annotations (default float32)
 
         Outputs:
             X: a numpy array [1, time_steps, features_number] for features
             Y: array or list, comprising annotations
     """
 
-    if from_notebook:
-        parent = '../'
-    else:
-        parent = ''
-
-    list_videos = np.load(parent + 'data/processed/' + corpus + '/list_videos.npy')
-
+    list_videos = get_annotation_cache(corpus, from_notebook).list_videos
 
     if provided_annotation is None:
         provided_annotation = get_raw_annotation_from_file(corpus, from_notebook)
 
     if features_type == 'features' or features_type == 'both':
         X_features = get_sequence_features(corpus=corpus,
-                              video_index=video_index,
+                              vid_idx=video_index,
                               img_start_idx=img_start_idx,
                               input_type=input_type,
                               input_normed=input_normed,
                               input_type_format=input_type_format,
                               time_steps=time_steps,
                               preloaded_features=preloaded_features,
-                              from_notebook=from_notebook)
+                              from_notebook=from_notebook,
+                              dtype=dtype)
     else:
         X_features = np.array([])
 
-    X_frames = np.repeat('',time_steps).astype('<U100')
-
     if features_type == 'frames' or features_type == 'both':
-        tmp_vid       = np.repeat(frames_path_before_video + list_videos[video_index] + '_front/', time_steps)
-        tmp_frames    = np.char.zfill((np.arange(time_steps)+1+img_start_idx).astype('<U5'),5)
-        tmp_extension = np.repeat('.jpg', time_steps)
-        X_frames = np.core.defchararray.add(np.core.defchararray.add(tmp_vid, tmp_frames), tmp_extension)
+        X_frames = FramePathSequence([frames_path_before_video + list_videos[video_index] + '_front/'], [time_steps], first_frame=img_start_idx)
+    else:
+        X_frames = FramePathSequence(None, [time_steps])
 
     if output_form == 'mixed':
         Y = get_sequence_annotations_mixed(corpus=corpus,
@@ -673,7 +1429,8 @@ def get_sequence(corpus,
                                            img_start_idx=img_start_idx,
                                            time_steps=time_steps,
                                            provided_annotation=provided_annotation,
-                                           from_notebook=from_notebook)
+                                           from_notebook=from_notebook,
+                                           dtype=dtype)
     elif output_form == 'sign_types':
         Y = get_sequence_annotations_sign_types(corpus=corpus,
                                                 types=types,
@@ -682,13 +1439,106 @@ def get_sequence(corpus,
                                                 img_start_idx=img_start_idx,
                                                 time_steps=time_steps,
                                                 provided_annotation=provided_annotation,
-                                                from_notebook=from_notebook)
+                                                from_notebook=from_notebook,
+                                                dtype=dtype)
     else:
         sys.exit('Invalid output form')
 
     return [X_features, X_frames], Y
 
 
+class ConcatenatedSequenceView(object):
+    """
+        Concatenation of per-video feature arrays, each video being followed by
+        separation zero frames, without materializing it.
+        For reading, it behaves like an array of shape (1, total_time_steps, features_number):
+        view[0, start:end, :] or view[:, start:end, :] return new arrays,
+        read(start, end, out) and read_wrap(start, length, period, out) fill a given buffer.
+
+        Inputs:
+            features: list of per-video arrays [1, time_steps, features_number] (e.g. from get_features_videos)
+            separation: number of zero frames after each video
+    """
+    def __init__(self, features, separation=0):
+        self.videos = [f[0] if f.ndim == 3 else f for f in features]
+        self.separation = separation
+        self.video_lengths = np.array([v.shape[0] for v in self.videos], dtype=int)
+        self.offsets = np.zeros(len(self.videos)+1, dtype=int)
+        self.offsets[1:] = np.cumsum(self.video_lengths + separation)
+        self.features_number = self.videos[0].shape[1]
+        self.dtype = self.videos[0].dtype
+        self.shape = (1, int(self.offsets[-1]), self.features_number)
+        self.ndim = 3
+        self._idx_trueData = None
+
+    def __len__(self):
+        return 1
+
+    @property
+    def idx_trueData(self):
+        """
+            Boolean vector, False where separations are (computed once, on first use)
+        """
+        if self._idx_trueData is None:
+            self._idx_trueData = np.zeros(self.shape[1], dtype=bool)
+            for i_v in range(len(self.videos)):
+                self._idx_trueData[self.offsets[i_v]:self.offsets[i_v]+self.video_lengths[i_v]] = True
+        return self._idx_trueData
+
+    def read(self, start, end, out=None):
+        """
+            Copies frames start:end into out ([end-start, features_number], allocated if None)
+        """
+        if out is None:
+            out = np.empty((end - start, self.features_number), dtype=self.dtype)
+        if self.separation > 0:
+            out[...] = 0
+        i_v = max(int(np.searchsorted(self.offsets, start, side='right')) - 1, 0)
+        while i_v < len(self.videos) and self.offsets[i_v] < end:
+            vid_start = self.offsets[i_v]
+            copy_start = max(start, vid_start)
+            copy_end = min(end, vid_start + self.video_lengths[i_v])
+            if copy_end > copy_start:
+                out[copy_start-start:copy_end-start, :] = self.videos[i_v][copy_start-vid_start:copy_end-vid_start, :]
+            i_v += 1
+        return out
+
+    def read_wrap(self, start, length, period=None, out=None):
+        """
+            Copies length frames from start, wrapping around at period (default: total length)
+        """
+        if period is None:
+            period = self.shape[1]
+        if out is None:
+            out = np.empty((length, self.features_number), dtype=self.dtype)
+        end = start + length
+        if end <= period:
+            self.read(start, end, out)
+        else:
+            self.read(start, period, out[:period-start])
+            self.read(0, end-period, out[period-start:])
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        if key[0] != 0 and key[0] != slice(None):
+            raise IndexError('ConcatenatedSequenceView has a single element along the first axis')
+        start, end, step = key[1].indices(self.shape[1])
+        if step != 1:
+            raise IndexError('Only contiguous time slices are supported')
+        output = self.read(start, max(start, end))[:, key[2]]
+        if key[0] == 0:
+            return output
+        return output[np.newaxis]
+
+    def __array__(self, dtype=None):
+        output = self.read(0, self.shape[1])[np.newaxis]
+        if dtype is not None:
+            output = output.astype(dtype, copy=False)
+        return output
+
 def get_data_concatenated(corpus,
                           output_form,
                           types,
@@ -705,7 +1555,13 @@ def get_data_concatenated(corpus,
                           return_idx_trueData=False,
                           features_type='features',
                           frames_path_before_video='/localHD/DictaSign/convert/img/DictaSign_lsf_',
-                          empty_image_path='/localHD/DictaSign/convert/img/white.jpg'):
+                          empty_image_path='/localHD/DictaSign/convert/img/white.jpg',
+                          dtype=np.float32,
+                          concatenate_features=True,
+                          frames_cache=False,
+                          img_width=224,
+                          img_height=224,
+                          rle_annotations=False):
     """
         For returning concatenated features and annotations for a set of videos (e.g. train set...)
             e.g. features_2_train, annot_2_train = get_data_concatenated('NCSLGR',
@@ -745,23 +1601,44 @@ def get_data_concatenated(corpus,
             input_type_format: 'old' if features are stored in big files named features_HS, raw... containing data for all videos
                                'cslr_limsi_features' if features are stored per video
             from_notebook: if notebook script, data is in parent folder
-            return_idx_trueData: if True, returns a binary vector with 0 where separations are
+            return_idx_trueData: if True, returns a boolean vector, False where separations are
             features_type: 'features', 'frames', 'both'
             frames_path_before_video: video frames are supposed to be in folders
                                       like '/localHD/DictaSign/convert/img/DictaSign_lsf_S7_T2_A10',
                                       then frames_path_before_video='/localHD/DictaSign/convert/img/DictaSign_lsf_'
             empty_image_path: path of a white frame
+            dtype: data type of features and annotations (default float32)
+            concatenate_features: if False, features are not copied into a new array,
+                                  a ConcatenatedSequenceView of the per-video arrays is returned instead
+            frames_cache: if True and all videos are in the decoded frame cache (see build_frame_cache),
+                          frames are a FrameTensorSequence instead of paths
+            img_width, img_height: size of the cached frames (with frames_cache)
+            rle_annotations: if True, annotations are loaded as runs and returned as RunLengthLabels
+                             (see get_rle_labels), expanded to dense labels only when read (e.g. per batch)
 
         Outputs:
-            X: [a numpy array [1, total_time_steps, features_number] for features,
-                a list of frame paths]
-            Y: array or list, comprising annotations
+            X: [a numpy array [1, total_time_steps, features_number] for features
+                (or a ConcatenatedSequenceView),
+                frame paths (FramePathSequence) or decoded frames (FrameTensorSequence)]
+            Y: array or list, comprising annotations (RunLengthLabels with rle_annotations)
     """
 
     if provided_annotation is None:
         provided_annotation = get_raw_annotation_from_file(corpus, from_notebook)
 
-    if output_form == 'mixed':
+    if rle_annotations:
+        Y = get_rle_labels(corpus=corpus,
+                           output_form=output_form,
+                           types=types,
+                           nonZero=nonZero,
+                           binary=binary,
+                           video_indices=video_indices,
+                           separation=separation,
+                           provided_annotation=provided_annotation,
+                           from_notebook=from_notebook,
+                           dtype=dtype)
+
+    elif output_form == 'mixed':
         Y = get_concatenated_mixed(corpus=corpus,
                                    types=types,
                                    nonZero=nonZero,
@@ -769,7 +1646,8 @@ def get_data_concatenated(corpus,
                                    video_indices=video_indices,
                                    separation=separation,
                                    provided_annotation=provided_annotation,
-                                   from_notebook=from_notebook)
+                                   from_notebook=from_notebook,
+                                   dtype=dtype)
 
     elif output_form == 'sign_types':
         Y = get_concatenated_sign_types(corpus=corpus,
@@ -778,16 +1656,12 @@ def get_data_concatenated(corpus,
                                         video_indices=video_indices,
                                         separation=separation,
                                         provided_annotation=provided_annotation,
-                                        from_notebook=from_notebook)
+                                        from_notebook=from_notebook,
+                                        dtype=dtype)
     else:
         sys.exit('Invalid output form')
 
-    if from_notebook:
-        parent = '../'
-    else:
-        parent = ''
-
-    list_videos = np.load(parent + 'data/processed/' + corpus + '/list_videos.npy')
+    list_videos = get_annotation_cache(corpus, from_notebook).list_videos
 
     # Getting video lengths:
     video_number = video_indices.size
@@ -800,30 +1674,35 @@ def get_data_concatenated(corpus,
         total_length += separation
 
     if preloaded_features is None and features_type != 'frames':
-        preloaded_features = get_features_videos(corpus, input_type, input_normed, input_type_format, video_indices, from_notebook)
+        preloaded_features = get_features_videos(corpus, input_type, input_normed, input_type_format, video_indices, from_notebook, dtype)
 
-    if features_type == 'features' or features_type == 'both':
+    if (features_type == 'features' or features_type == 'both') and not concatenate_features:
+        X_features = ConcatenatedSequenceView(preloaded_features, separation)
+    elif features_type == 'features' or features_type == 'both':
         features_number = preloaded_features[0].shape[2]
-        X_features = np.zeros((1, total_length, features_number))
+        X_features = np.zeros((1, total_length, features_number), dtype=dtype)
     else:
         X_features = np.array([])
 
-    X_frames = np.repeat('',total_length).astype('<U100')
+    X_frames = None
+    if (features_type == 'frames' or features_type == 'both') and frames_cache:
+        X_frames = get_frame_tensor_sequence(corpus, video_indices, separation, img_width, img_height, from_notebook)
+        if X_frames is None:
+            print('Some videos are not in the frame cache, frames are decoded from files')
+    if X_frames is None:
+        if features_type == 'frames' or features_type == 'both':
+            X_frames = FramePathSequence([frames_path_before_video + list_videos[vid_idx] + '_front/' for vid_idx in video_indices],
+                                         video_lengths, separation, empty_image_path)
+        else:
+            X_frames = FramePathSequence(None, video_lengths, separation)
 
-    idx_trueData = np.zeros(total_length)
+    idx_trueData = np.zeros(total_length, dtype=bool)
 
     img_start_idx = 0
     for i_vid in range(video_number):
-        vid_idx = video_indices[i_vid]
-        if features_type == 'features' or features_type == 'both':
+        if (features_type == 'features' or features_type == 'both') and concatenate_features:
             X_features[0, img_start_idx:img_start_idx+video_lengths[i_vid], :] = preloaded_features[i_vid][0, :, :]
-        if features_type == 'frames' or features_type == 'both':
-            tmp_vid       = np.repeat(frames_path_before_video + list_videos[vid_idx] + '_front/', video_lengths[i_vid])
-            tmp_frames    = np.char.zfill((np.arange(video_lengths[i_vid])+1).astype('<U5'),5)
-            tmp_extension = np.repeat('.jpg', video_lengths[i_vid])
-            X_frames[img_start_idx:img_start_idx + video_lengths[i_vid]] = np.core.defchararray.add(np.core.defchararray.add(tmp_vid, tmp_frames), tmp_extension)
-            X_frames[img_start_idx + video_lengths[i_vid]:img_start_idx + video_lengths[i_vid]+separation] = empty_image_path
-        idx_trueData[img_start_idx:img_start_idx+video_lengths[i_vid]] = 1
+        idx_trueData[img_start_idx:img_start_idx+video_lengths[i_vid]] = True
         img_start_idx += video_lengths[i_vid]
         img_start_idx += separation
 
@@ -857,13 +1736,8 @@ def getVideoIndicesSplitNCSLGR(fractionValid=0.10,
             idxTrain, idxValid, idxTest: numpy arrays
     """
 
-    if from_notebook:
-        parent = '../'
-    else:
-        parent = ''
-
-    tmpAnnot = np.load(parent+'data/processed/NCSLGR/annotations.npz', encoding='latin1', allow_pickle=True)
-    namesVideos = np.load(parent+'data/processed/NCSLGR/list_videos.npy')
+    annotation_cache = get_annotation_cache('NCSLGR', from_notebook)
+    namesVideos = annotation_cache.list_videos
     nVideos = namesVideos.shape[0]
     idxKeep = np.ones(nVideos)
     for v in videosToDelete:
@@ -873,7 +1747,7 @@ def getVideoIndicesSplitNCSLGR(fractionValid=0.10,
     idxKeepShort = np.zeros(nVideos)
     for idxV in range(nVideos):
         if idxKeep[idxV]:
-            tmpLength = tmpAnnot['lexical_with_ns_not_fs'][idxV].shape[0]
+            tmpLength = annotation_cache.video_lengths[idxV]
             if tmpLength > lengthCriterion:
                 idxKeepLong[idxV] = 1
             else:
@@ -983,12 +1857,7 @@ def getVideoIndicesSplitDictaSignManual(tasksSplit,
         Outputs:
             idxTrain, idxValid, idxTest: numpy arrays
     """
-    if from_notebook:
-        parent = '../'
-    else:
-        parent = ''
-
-    l = np.load(parent+'data/processed/DictaSign/list_videos.npy')
+    l = get_annotation_cache('DictaSign', from_notebook).list_videos
     nVideos = len(l)
     #sess = []
     task = []
@@ -1086,12 +1955,8 @@ def getVideoIndicesSplitDictaSignAuto(signerIndependent,
     np.random.shuffle(signersIdx)
     np.random.shuffle(tasksIdx)
 
-    if from_notebook:
-        parent = '../'
-    else:
-        parent = ''
-
-    l = np.load(parent+'data/processed/DictaSign/list_videos.npy')
+    annotation_cache = get_annotation_cache('DictaSign', from_notebook)
+    l = annotation_cache.list_videos
     nVideos = len(l)
     sess   = []
     task   = []
@@ -1109,11 +1974,7 @@ def getVideoIndicesSplitDictaSignAuto(signerIndependent,
     idxVideos = np.arange(nVideos)
     np.random.shuffle(idxVideos)
 
-    annotation_raw = np.load(parent + 'data/processed/DictaSign/annotations.npz', encoding='latin1', allow_pickle=True)['dataBrut_DS'] # for counting nb of images
-
-    frames = np.zeros(nVideos)
-    for iV in range(nVideos):
-        frames[iV] = annotation_raw[iV].shape[0]
+    frames = annotation_cache.video_lengths.astype(float)
     totalFrames = np.sum(frames)
 
     minFramesTest  = fractionTest * totalFrames
@@ -1195,12 +2056,19 @@ def getVideoIndicesSplitDictaSignAuto(signerIndependent,
 
     return np.array(idxTrain).astype(int), np.array(idxValid).astype(int), np.array(idxTest).astype(int)
 
+def weightVectorImbalancedData(dataIntegers):
+    # [samples] (class of each sample)
+    # returns vector and dictionary
+    # 'balanced' weights of present classes: n_samples / (n_classes * count)
+    counts = np.bincount(np.asarray(dataIntegers).reshape(-1))
+    counts = counts[counts > 0]
+    class_weights = np.asarray(dataIntegers).size / (counts.size * counts.astype(np.float64))
+    return class_weights, dict(enumerate(class_weights))
+
 def weightVectorImbalancedDataOneHot(data):
     # [samples, classes]
     # returns vector and dictionary
-    dataIntegers = np.argmax(data, axis=1)
-    class_weights = compute_class_weight('balanced', np.unique(dataIntegers), dataIntegers)
-    return class_weights, dict(enumerate(class_weights))
+    return weightVectorImbalancedData(np.argmax(data, axis=1))
 
 def verifSets(idxTrain, idxValid, idxTest):
     interTrainValid = np.intersect1d(idxTrain, idxValid)
@@ -1303,6 +2171,44 @@ def getFeaturesDict(inputType, inputNormed):
 
     return features_dict, features_number
 
+def getFeaturesGatherPlan(inputType, inputNormed):
+    """
+        Column gather plan for the 'old' input format, built from getFeaturesDict.
+        Selected columns of each feature family are grouped in contiguous runs,
+        so that they can be copied with slices instead of index arrays.
+
+        Inputs:
+            inputType, inputNormed: see getFeaturesDict
+
+        Outputs:
+            gather_plan: list of (key, runs) for non-empty feature families,
+                         runs being a list of (src_start, src_end, dst_start, dst_end)
+            features_number
+    """
+    features_dict, features_number = getFeaturesDict(inputType, inputNormed)
+
+    gather_plan = []
+    dst_start = 0
+    for key in features_dict:
+        key_features_idx = features_dict[key]
+        if key_features_idx.size == 0:
+            continue
+        runs = []
+        for run in np.split(key_features_idx, np.where(np.diff(key_features_idx) != 1)[0] + 1):
+            runs.append((int(run[0]), int(run[-1]) + 1, dst_start, dst_start + run.size))
+            dst_start += run.size
+        gather_plan.append((key, runs))
+
+    return gather_plan, features_number
+
+def getCnnEmbeddingInputType(cnnType, imgWidth, imgHeight, cnnFirstTrainedLayer=None):
+    # input type of the frame embeddings of the frozen head of a CNN backbone (see model_utils.build_cnn_embeddings),
+    # stored in the format of cslr_limsi_features; their size depends on the split layer, see get_features_number_video_file
+    inputType = 'cnn_' + cnnType + '_' + str(imgWidth) + 'x' + str(imgHeight)
+    if cnnFirstTrainedLayer is not None:
+        inputType += '_' + str(cnnFirstTrainedLayer)
+    return inputType
+
 def getFeaturesNumberCslrLimsiFeatures(inputType):
 
     N_features = {
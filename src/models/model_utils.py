@@ -1,4 +1,9 @@
+import numpy as np
 import sys
+import hashlib
+import time
+import threading
+import concurrent.futures
 
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
@@ -17,9 +22,6 @@ if v0 == '2':
     from tensorflow.keras.applications.vgg16 import VGG16
     from tensorflow.keras.applications.mobilenet_v2 import MobileNetV2
     from tensorflow.keras.preprocessing.image import load_img, img_to_array
-    from tensorflow.keras.applications.resnet50 import preprocess_input as preprocess_input_ResNet50
-    from tensorflow.keras.applications.vgg16 import preprocess_input as preprocess_input_VGG16
-    from tensorflow.keras.applications.mobilenet import preprocess_input as preprocess_input_MobileNet
 
 elif v0 == '1':
     #For tensorflow 1.2.0
@@ -34,14 +36,13 @@ elif v0 == '1':
     from keras.applications.vgg16 import VGG16
     from keras.applications.mobilenet import MobileNet
     from keras.preprocessing.image import load_img, img_to_array
-    from keras.applications.resnet50 import preprocess_input as preprocess_input_ResNet50
-    from keras.applications.vgg16 import preprocess_input as preprocess_input_VGG16
-    from keras.applications.mobilenet import preprocess_input as preprocess_input_MobileNet
 
 
 else:
     sys.exit('Tensorflow version should be 1.X or 2.X')
 
+from models.data_utils import get_annotation_cache, get_features_video_file, get_frame_tensor_sequence, FramePathSequence, getCnnEmbeddingInputType, get_features_number_video_file
+
 def recallK(y_true, y_pred):
     # works with non binary data as well as binary
     y_true_class = K.argmax(y_true, axis=-1)
@@ -151,6 +152,88 @@ def attention_featurewise(inputs, single=False, attention_layer_descriptor=''):
         output_attention_mul = merge([inputs, a], name='attention_mul_featurewise_'+attention_layer_descriptor, mode='mul')
     return output_attention_mul
 
+def get_cnn_backbone(cnnType, img_width, img_height):
+    """
+        Pretrained (ImageNet) CNN without its classification layers, max pooled output
+    """
+    if cnnType=='resnet':
+        return ResNet50(include_top=False, weights="imagenet", pooling='max', input_shape=(img_height,img_width,3))
+    elif cnnType=='vgg':
+        return VGG16(include_top=False, weights="imagenet", pooling='max', input_shape=(img_height,img_width,3))
+    elif cnnType=='mobilenet':
+        return MobileNet(include_top=False, weights="imagenet", pooling='max', input_shape=(img_height,img_width,3))
+    else:
+        sys.exit('Invalid CNN network model')
+
+def set_cnn_trainable_layers(backbone, cnnFirstTrainedLayer):
+    """
+        Freezes the layers of backbone before cnnFirstTrainedLayer (if greater than 0), the following ones being trainable
+    """
+    if cnnFirstTrainedLayer > 0:
+        for layer in backbone.layers[:cnnFirstTrainedLayer]:
+           layer.trainable = False
+        for layer in backbone.layers[cnnFirstTrainedLayer:]:
+           layer.trainable = True
+
+def get_inbound_layer_names(layer):
+    """
+        Names of the layers whose outputs are the inputs of layer (in the graph where it was built)
+    """
+    inbound_layers = layer._inbound_nodes[0].inbound_layers
+    if not isinstance(inbound_layers, (list, tuple)):
+        inbound_layers = [inbound_layers]
+    return [inbound_layer.name for inbound_layer in inbound_layers]
+
+def split_cnn_backbone(backbone, cnnFirstTrainedLayer=None):
+    """
+        Splits backbone in a frozen head and a trainable tail, at the last layer before cnnFirstTrainedLayer
+        whose output is the only input of the following layers (e.g. the output of a residual block).
+        The tail reuses the layers (and weights) of backbone, with their trainable flags.
+
+        Inputs:
+            backbone: a Keras model (see get_cnn_backbone)
+            cnnFirstTrainedLayer: index of first trainable layer (None: whole backbone frozen)
+
+        Outputs:
+            head: model from the frames to the output of the split layer
+            tail: model from the output of the split layer to the output of backbone (None if the whole backbone is frozen)
+            split_layer: index of the split layer
+    """
+    layers_number = len(backbone.layers)
+    if cnnFirstTrainedLayer is None or cnnFirstTrainedLayer >= layers_number:
+        return backbone, None, layers_number - 1
+    layer_index = {layer.name: i_layer for i_layer, layer in enumerate(backbone.layers)}
+    inbound_names = [get_inbound_layer_names(layer) for layer in backbone.layers]
+    split_layer = cnnFirstTrainedLayer - 1
+    while split_layer > 0 and any(layer_index[name] < split_layer for names in inbound_names[split_layer+1:] for name in names):
+        split_layer -= 1
+    if split_layer <= 0:
+        sys.exit('No frozen block of the CNN before layer ' + str(cnnFirstTrainedLayer))
+    split_output = backbone.layers[split_layer].output
+    head = Model(inputs=backbone.input, outputs=split_output)
+    tail_input = Input(shape=K.int_shape(split_output)[1:])
+    outputs = {backbone.layers[split_layer].name: tail_input}
+    for i_layer in range(split_layer+1, layers_number):
+        layer_inputs = [outputs[name] for name in inbound_names[i_layer]]
+        if len(layer_inputs) == 1:
+            layer_inputs = layer_inputs[0]
+        outputs[backbone.layers[i_layer].name] = backbone.layers[i_layer](layer_inputs)
+    tail = Model(inputs=tail_input, outputs=outputs[backbone.layers[-1].name])
+    return head, tail, split_layer
+
+def set_precision_policy(policy):
+    """
+    Sets the global keras mixed precision policy (tensorflow 2), returns the previous one
+    """
+    if hasattr(tf.keras.mixed_precision, 'set_global_policy'):
+        previous_policy = tf.keras.mixed_precision.global_policy()
+        tf.keras.mixed_precision.set_global_policy(policy)
+    else:
+        # tensorflow < 2.4
+        previous_policy = tf.keras.mixed_precision.experimental.global_policy()
+        tf.keras.mixed_precision.experimental.set_policy(policy)
+    return previous_policy
+
 def get_model(output_names,
               output_classes,
               output_weights=[],
@@ -183,6 +266,11 @@ def get_model(output_names,
               cnnType='resnet',
               cnnFirstTrainedLayer=165,
               cnnReduceDim=0,
+              masking=False,
+              frames_embedded=False,
+              recurrent_dropout=None,
+              performance_mode=False,
+              cache_path=None,
               print_summary=True):
     """
         Keras recurrent neural network model builder.
@@ -200,6 +288,11 @@ def get_model(output_names,
             rnn_type: type of recurrent layers (string)
             rnn_hidden_units: number of hidden units
             dropout: how much dropout (0 to 1)
+            frames_embedded (bool): with features_type 'features', features are embeddings of the frames by the frozen head
+                                    of the CNN (see build_cnn_embeddings, same cnnType, img_height, img_width and cnnFirstTrainedLayer):
+                                    the model is then the 'frames' model after the frozen head (trainable tail of the CNN,
+                                    see split_cnn_backbone, no convolution or attention on input, cnnReduceDim applies)
+            recurrent_dropout: how much dropout on recurrent connections (default: dropout, or 0 if performance_mode)
             att_in_rnn: if True, applies attention layer before recurrent layers
             att_in_rnn_single: single (shared) attention layer or not
             att_in_rnn_type (string): timewise or featurewise attention layer
@@ -219,11 +312,37 @@ def get_model(output_names,
             cnnType: 'resnet', 'vgg' or 'mobilenet'
             cnnFirstTrainedLayer: index of first trainable layer in CNN (int)
             cnnReduceDim: if greater than 0, size of CNN flattened output is reduced to cnnReduceDim
+            masking (bool): all-zero input frames (padding) are masked in recurrent layers,
+                            time_steps can then be None (variable length batches, see VideoBucketSequence)
+            performance_mode (bool): tensorflow 2 only, mixed precision (float16 computations, float32 variables
+                                     and softmax outputs) and XLA-compiled train/predict steps;
+                                     recurrent_dropout defaults to 0, so that LSTM layers use the fused (cuDNN) kernel
+            cache_path: if given, folder of the model cache (see load_cached_model), e.g. 'models/cache/'
             print_summary (bool)
 
         Output: A Keras model
     """
 
+    if cache_path is not None:
+        cache_key = get_model_cache_key(dict(locals()))
+        model = load_cached_model(cache_path, cache_key)
+        if model is not None:
+            return compile_model(model, optimizer, learning_rate, metrics, output_weights, classif_local, performance_mode, print_summary)
+
+    if recurrent_dropout is None:
+        if performance_mode:
+            recurrent_dropout = 0
+        else:
+            recurrent_dropout = dropout
+    # dtype of output layers
+    if performance_mode:
+        if v0 != '2':
+            sys.exit('Performance mode requires tensorflow 2')
+        previous_policy = set_precision_policy('mixed_float16')
+        output_dtype = 'float32'
+    else:
+        output_dtype = None
+
     # input
     if features_type == 'features' or features_type == 'both':
         main_input_features    = Input(shape=(time_steps, features_number))
@@ -234,7 +353,31 @@ def get_model(output_names,
     if features_type != 'features' and features_type != 'frames' and features_type != 'both':
         sys.exit('Invalid features type')
 
-    if features_type != 'frames':
+    # mask of non-padding frames, given to the first recurrent layer (and propagated by the following ones)
+    if masking:
+        if features_type == 'frames':
+            rnn_mask = Lambda(lambda x: K.any(K.not_equal(x, 0), axis=[2, 3, 4]))(main_input_frames)
+        else:
+            rnn_mask = Lambda(lambda x: K.any(K.not_equal(x, 0), axis=-1))(main_input_features)
+        rnn_args = {'mask': rnn_mask}
+    else:
+        rnn_args = {}
+    if time_steps is None and ((att_in_rnn and att_in_rnn_type == 'timewise') or (att_out_rnn and att_out_rnn_type == 'timewise')):
+        sys.exit('Timewise attention requires a fixed number of time steps')
+
+    if features_type == 'features' and frames_embedded:
+        cnnBackbone = get_cnn_backbone(cnnType, img_width, img_height)
+        set_cnn_trainable_layers(cnnBackbone, cnnFirstTrainedLayer)
+        cnnHead, cnnBackbone, cnnSplitLayer = split_cnn_backbone(cnnBackbone, cnnFirstTrainedLayer)
+        # embeddings are stored flattened
+        embedding_shape = K.int_shape(cnnHead.output)[1:]
+        if len(embedding_shape) > 1:
+            input_transfo_features = TimeDistributed(Reshape(embedding_shape))(input_transfo_features)
+        if cnnBackbone is not None:
+            input_transfo_features = TimeDistributed(cnnBackbone)(input_transfo_features)
+        if cnnReduceDim > 0:
+            input_transfo_features = TimeDistributed(Dense(cnnReduceDim, activation='relu'))(input_transfo_features)
+    elif features_type != 'frames':
         # convolution input
         if conv:
             input_transfo_features = Conv1D(filters=conv_filt, kernel_size=conv_ker, strides=conv_strides, padding='same', activation='relu')(input_transfo_features)
@@ -250,14 +393,7 @@ def get_model(output_names,
 
 
     if features_type != 'features':
-        if cnnType=='resnet':
-            cnnBackbone = ResNet50(include_top=False, weights="imagenet", pooling='max', input_shape=(img_height,img_width,3))
-        elif cnnType=='vgg':
-            cnnBackbone = VGG16(include_top=False, weights="imagenet", pooling='max', input_shape=(img_height,img_width,3))
-        elif cnnType=='mobilenet':
-            cnnBackbone = MobileNet(include_top=False, weights="imagenet", pooling='max', input_shape=(img_height,img_width,3))
-        else:
-            sys.exit('Invalid CNN network model')
+        cnnBackbone = get_cnn_backbone(cnnType, img_width, img_height)
 
         input_transfo_frames = TimeDistributed(cnnBackbone)(input_transfo_frames)
 
@@ -269,11 +405,7 @@ def get_model(output_names,
 
         #input_transfo = TimeDistributed(Flatten())(input_transfo)
 
-        if cnnFirstTrainedLayer > 0:
-            for layer in cnnBackbone.layers[:cnnFirstTrainedLayer]:
-               layer.trainable = False
-            for layer in cnnBackbone.layers[cnnFirstTrainedLayer:]:
-               layer.trainable = True
+        set_cnn_trainable_layers(cnnBackbone, cnnFirstTrainedLayer)
 
         #for i, layer in enumerate(cnnBackbone.layers):
         #    print(i, layer.name, layer.trainable)
@@ -294,27 +426,27 @@ def get_model(output_names,
     # recurrent layers
     if rnn_number == 1:
         if rnn_type == 'lstm':
-            rnn_n = Bidirectional(LSTM(rnn_hidden_units, return_sequences=rnn_return_sequences, dropout=dropout, recurrent_dropout=dropout))(input_transfo)
+            rnn_n = Bidirectional(LSTM(rnn_hidden_units, return_sequences=rnn_return_sequences, dropout=dropout, recurrent_dropout=recurrent_dropout))(input_transfo, **rnn_args)
         else:
             sys.exit('Invalid RNN type')
     elif rnn_number == 2:
         if rnn_type == 'lstm':
-            rnn_1 = Bidirectional(LSTM(rnn_hidden_units, return_sequences=True, dropout=dropout, recurrent_dropout=dropout))(input_transfo)
-            rnn_n = Bidirectional(LSTM(rnn_hidden_units, return_sequences=rnn_return_sequences, dropout=dropout, recurrent_dropout=dropout))(rnn_1)
+            rnn_1 = Bidirectional(LSTM(rnn_hidden_units, return_sequences=True, dropout=dropout, recurrent_dropout=recurrent_dropout))(input_transfo, **rnn_args)
+            rnn_n = Bidirectional(LSTM(rnn_hidden_units, return_sequences=rnn_return_sequences, dropout=dropout, recurrent_dropout=recurrent_dropout))(rnn_1)
         else:
             sys.exit('Invalid RNN type')
     elif rnn_number >= 3:
         if rnn_type == 'lstm':
-            rnn_i = Bidirectional(LSTM(rnn_hidden_units, return_sequences=True, dropout=dropout, recurrent_dropout=dropout))(input_transfo)
+            rnn_i = Bidirectional(LSTM(rnn_hidden_units, return_sequences=True, dropout=dropout, recurrent_dropout=recurrent_dropout))(input_transfo, **rnn_args)
         else:
             sys.exit('Invalid RNN type')
         for i_rnn in range(1, rnn_number - 1):
             if rnn_type == 'lstm':
-                rnn_i = Bidirectional(LSTM(rnn_hidden_units, return_sequences=True, dropout=dropout, recurrent_dropout=dropout))(rnn_i)
+                rnn_i = Bidirectional(LSTM(rnn_hidden_units, return_sequences=True, dropout=dropout, recurrent_dropout=recurrent_dropout))(rnn_i)
             else:
                 sys.exit('Invalid RNN type')
         if rnn_type == 'lstm':
-            rnn_n = Bidirectional(LSTM(rnn_hidden_units, return_sequences=rnn_return_sequences, dropout=dropout, recurrent_dropout=dropout))(rnn_i)
+            rnn_n = Bidirectional(LSTM(rnn_hidden_units, return_sequences=rnn_return_sequences, dropout=dropout, recurrent_dropout=recurrent_dropout))(rnn_i)
         else:
             sys.exit('Invalid RNN type')
     else:
@@ -354,7 +486,7 @@ def get_model(output_names,
                     for i_output in range(output_number):
                         output_intermed_list[i_output] = TimeDistributed(Dropout(dropout))(output_intermed_list[i_output])
         for i_output in range(output_number):
-            output_list.append(TimeDistributed(Dense(output_classes[i_output], activation='softmax', name='output_' + output_names[i_output]))(output_intermed_list[i_output]))
+            output_list.append(TimeDistributed(Dense(output_classes[i_output], activation='softmax', name='output_' + output_names[i_output], dtype=output_dtype), dtype=output_dtype)(output_intermed_list[i_output]))
     else:
         if mlp_layers_number > 0:
             for i_add in range(mlp_layers_number):
@@ -364,7 +496,7 @@ def get_model(output_names,
                     for i_output in range(output_number):
                         output_intermed_list[i_output] = Dropout(dropout)(output_intermed_list[i_output])
         for i_output in range(output_number):
-            output_list.append(Dense(output_classes[i_output], activation='softmax', name='output_' + output_names[i_output])(output_intermed_list[i_output]))
+            output_list.append(Dense(output_classes[i_output], activation='softmax', name='output_' + output_names[i_output], dtype=output_dtype)(output_intermed_list[i_output]))
 
     # Create model
     if features_type == 'features':
@@ -376,6 +508,20 @@ def get_model(output_names,
     else:
         sys.exit('Invalid features type')
 
+    if performance_mode:
+        # layers keep the policy they were built with
+        set_precision_policy(previous_policy)
+    if cache_path is not None:
+        if features_type == 'features' and not frames_embedded:
+            cnnBackbone = None
+        save_cached_model(cache_path, cache_key, model, cnnBackbone)
+
+    return compile_model(model, optimizer, learning_rate, metrics, output_weights, classif_local, performance_mode, print_summary)
+
+def compile_model(model, optimizer, learning_rate, metrics, output_weights, classif_local, performance_mode=False, print_summary=True):
+    """
+        Compiles a model built by get_model (see get_model for the inputs)
+    """
     # framewise weights:
     if classif_local:
         weight_mode_sequence = 'temporal'
@@ -389,14 +535,406 @@ def get_model(output_names,
         opt = optimizers.Adagrad(lr=learning_rate, epsilon=None, decay=0.0)
     else:
         sys.exit('Invalid gradient optimizer')
-    if output_weights == []:
-        model.compile(loss='categorical_crossentropy', optimizer=opt, metrics=metrics, sample_weight_mode=weight_mode_sequence)
-    else:
-        model.compile(loss='categorical_crossentropy', optimizer=opt, metrics=metrics, loss_weights=output_weights, sample_weight_mode=weight_mode_sequence)
+    compile_args = {}
+    if output_weights != []:
+        compile_args['loss_weights'] = output_weights
+    if performance_mode:
+        if tuple(int(v) for v in tf.__version__.split('.')[:2]) >= (2, 5):
+            compile_args['jit_compile'] = True
+        else:
+            # no per-model compilation before tensorflow 2.5, XLA auto-clustering instead
+            tf.config.optimizer.set_jit(True)
+    model.compile(loss='categorical_crossentropy', optimizer=opt, metrics=metrics, sample_weight_mode=weight_mode_sequence, **compile_args)
     if print_summary:
         model.summary()
     return model
 
+# arguments of get_model that do not change the architecture (given to compile_model)
+compileArguments = ['output_weights', 'optimizer', 'metrics', 'learning_rate', 'cache_path', 'print_summary']
+
+def get_model_cache_key(model_args):
+    """
+        Key of a model in the cache: hash of the architecture arguments of get_model and of the versions
+    """
+    key = repr(sorted((k, v) for k, v in model_args.items() if k not in compileArguments))
+    key += tf.__version__ + sys.version
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def load_cached_model(cache_path, cache_key):
+    """
+        Rebuilds a model from the cache (uncompiled), or returns None if it is not cached.
+        The cache holds the architecture (json) and the weights of the pretrained CNN backbone (if any):
+        the graph is rebuilt without running get_model and without loading ImageNet weights,
+        other layers are randomly initialized, as with get_model.
+    """
+    json_file = cache_path + cache_key + '.json'
+    if not os.path.isfile(json_file):
+        return None
+    with open(json_file) as f:
+        model = model_from_json(f.read(), custom_objects={'K': K})
+    backbone_file = cache_path + cache_key + '_backbone.h5'
+    if os.path.isfile(backbone_file):
+        for layer in model.layers:
+            if isinstance(layer, TimeDistributed) and isinstance(layer.layer, Model):
+                layer.layer.load_weights(backbone_file)
+    return model
+
+def save_cached_model(cache_path, cache_key, model, backbone=None):
+    """
+        Stores the architecture of model and the weights of its CNN backbone in the cache
+        (temporary files first, so that concurrent runs never read a partial file)
+    """
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_path)
+    tmp_suffix = '.tmp' + str(os.getpid())
+    if backbone is not None:
+        backbone_file = cache_path + cache_key + '_backbone.h5'
+        backbone.save_weights(backbone_file + tmp_suffix + '.h5')
+        os.replace(backbone_file + tmp_suffix + '.h5', backbone_file)
+    json_file = cache_path + cache_key + '.json'
+    with open(json_file + tmp_suffix, 'w') as f:
+        f.write(model.to_json())
+    os.replace(json_file + tmp_suffix, json_file)
+
+def preprocess_caffe(frames):
+    """
+    In place 'caffe' preprocessing of float frames [..., 3] (ResNet50, VGG16): RGB to BGR, ImageNet mean subtracted
+    """
+    red = frames[..., 0].copy()
+    frames[..., 0] = frames[..., 2]
+    frames[..., 2] = red
+    frames -= np.array([103.939, 116.779, 123.68], dtype=frames.dtype)
+    return frames
+
+def preprocess_tf(frames):
+    """
+    In place 'tf' preprocessing of float frames [..., 3] (MobileNet): scaled to [-1, 1]
+    """
+    frames /= 127.5
+    frames -= 1.
+    return frames
+
+# same results as preprocess_input of keras applications, without copies
+framePreprocessings = {'resnet': preprocess_caffe, 'vgg': preprocess_caffe, 'mobilenet': preprocess_tf}
+
+def get_frame_preprocessing(cnnType):
+    """
+    Preprocessing function of the CNN (applied in place to float arrays of frames [..., img_width, img_height, 3])
+    """
+    if cnnType not in framePreprocessings:
+        sys.exit('Invalid CNN network model')
+    return framePreprocessings[cnnType]
+
+def preprocess_frames(frames, cnnType):
+    """
+    Preprocessing of the CNN applied in place to a float array of frames [..., img_width, img_height, 3]
+    """
+    return get_frame_preprocessing(cnnType)(frames)
+
+class FrameDecoder(object):
+    """
+    Decodes frame files (JPEG decode and resize), serially or with a pool of workers
+    (threads, as PIL releases the GIL while decoding, or processes), and counts decoded frames and decoding time.
+    A shared decoder is used by load_frames, see set_frame_decoder.
+
+    Inputs:
+        workers: number of decoding workers (0: serial decoding in the calling thread)
+        use_processes: processes instead of threads
+    """
+    def __init__(self, workers=0, use_processes=False):
+        self.workers = workers
+        if workers == 0:
+            self.executor = None
+        elif use_processes:
+            self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        # pools do not survive fork (e.g. batch workers with use_multiprocessing): decoding is then serial
+        self.pid = os.getpid()
+        self.frames_number = 0
+        self.decoding_time = 0.
+        self.blank_frames = {}
+        self.lock = threading.Lock()
+
+    def decode(self, paths, img_width, img_height, out, rows=None):
+        """
+        Fills out (array [len(paths), img_width, img_height, 3]) with the decoded frames (not preprocessed)
+        rows: if given, frame i is written in out[rows[i]]
+        """
+        if rows is None:
+            rows = range(len(paths))
+        t0 = time.time()
+        if self.executor is None or os.getpid() != self.pid:
+            for i_frame in range(len(paths)):
+                out[rows[i_frame]] = decode_frame(paths[i_frame], img_width, img_height)
+        else:
+            chunksize = max(1, len(paths)//(4*self.workers))
+            frames = self.executor.map(decode_frame, paths, [img_width]*len(paths), [img_height]*len(paths), chunksize=chunksize)
+            for i_frame, frame in enumerate(frames):
+                out[rows[i_frame]] = frame
+        with self.lock:
+            self.frames_number += len(paths)
+            self.decoding_time += time.time() - t0
+        return out
+
+    def decode_blank(self, path, img_width, img_height):
+        """
+        Decoded blank (separation) frame, decoded once and then served from memory
+        """
+        key = (path, img_width, img_height)
+        if key not in self.blank_frames:
+            frame = decode_frame(path, img_width, img_height)
+            with self.lock:
+                self.blank_frames[key] = frame
+        return self.blank_frames[key]
+
+    def frames_per_second(self):
+        """
+        Decoding throughput since the creation of the decoder, in frames per second of decode calls
+        (0 if nothing was decoded; times of concurrent calls are added up)
+        """
+        if self.decoding_time == 0:
+            return 0.
+        return self.frames_number/self.decoding_time
+
+def decode_frame(path, img_width, img_height):
+    """
+    Decodes and resizes one frame file (array [img_width, img_height, 3])
+    """
+    return img_to_array(load_img(path, target_size=(img_width, img_height)))
+
+_frame_decoder = FrameDecoder()
+
+def set_frame_decoder(workers=0, use_processes=False):
+    """
+    Replaces the shared FrameDecoder used by load_frames (e.g. by the training and inference of a script)
+    """
+    global _frame_decoder
+    _frame_decoder = FrameDecoder(workers, use_processes)
+    return _frame_decoder
+
+def get_frame_decoder():
+    """
+    Shared FrameDecoder used by load_frames
+    """
+    return _frame_decoder
+
+def load_frames(frames, indices, img_width, img_height, cnnType, out):
+    """
+    Fills out (float array [len(indices), img_width, img_height, 3]) with the preprocessed frames indices of frames:
+    a FrameTensorSequence (frames sliced from the decoded frame cache)
+    or frame paths (list of strings or FramePathSequence, frames decoded by the shared FrameDecoder,
+    separation frames of a FramePathSequence being copied from a single decoded blank frame),
+    the preprocessing of the CNN being applied to all frames at once
+    """
+    if hasattr(frames, 'take'):
+        frames.take(indices, out)
+    elif hasattr(frames, 'blank_mask'):
+        blank = frames.blank_mask(indices)
+        if blank.any():
+            out[blank] = _frame_decoder.decode_blank(frames.empty_image_path, img_width, img_height)
+        rows = np.flatnonzero(~blank)
+        _frame_decoder.decode([frames[indices[i]] for i in rows], img_width, img_height, out, rows)
+    else:
+        _frame_decoder.decode([frames[i] for i in indices], img_width, img_height, out)
+    preprocess_frames(out, cnnType)
+    return out
+
+def build_cnn_embeddings(corpus,
+                         video_indices,
+                         cnnType='resnet',
+                         img_width=224,
+                         img_height=224,
+                         cnnFirstTrainedLayer=None,
+                         frames_path_before_video='/localHD/DictaSign/convert/img/DictaSign_lsf_',
+                         frames_cache=False,
+                         batch_size=256,
+                         from_notebook=False,
+                         dtype=np.float32):
+    """
+        Runs the frozen head of the CNN backbone (see split_cnn_backbone) once over the frames of each video,
+        and stores the flattened per-frame embeddings in the format of cslr_limsi_features
+        (one [time_steps, embedding_size] file per video), read by get_features_videos.
+        A model trained on them (features_type 'features', get_model with frames_embedded=True) is the 'frames' model,
+        without computing the frozen head at each epoch.
+
+        Inputs:
+            corpus (string)
+            video_indices: numpy array for a list of videos (videos already embedded are skipped)
+            cnnType, img_width, img_height, cnnFirstTrainedLayer: see get_model (None: whole backbone frozen)
+            frames_path_before_video: see get_data_concatenated
+            frames_cache: frames read from the decoded frame cache when available (see build_frame_cache)
+            batch_size: number of frames per head prediction
+            from_notebook: if notebook script, data is in parent folder
+
+        Outputs:
+            input type of the embeddings (see getCnnEmbeddingInputType)
+            embedding size (features number)
+    """
+    input_type = getCnnEmbeddingInputType(cnnType, img_width, img_height, cnnFirstTrainedLayer)
+    list_videos = get_annotation_cache(corpus, from_notebook).list_videos
+    video_lengths = get_annotation_cache(corpus, from_notebook).video_lengths
+    missing = [vid_idx for vid_idx in video_indices if not os.path.isfile(get_features_video_file(corpus, list_videos[vid_idx], input_type, from_notebook))]
+    if len(missing) == 0:
+        return input_type, get_features_number_video_file(corpus, list_videos[video_indices[0]], input_type, from_notebook)
+
+    backbone = get_cnn_backbone(cnnType, img_width, img_height)
+    head = split_cnn_backbone(backbone, cnnFirstTrainedLayer)[0]
+    embedding_size = int(np.prod(K.int_shape(head.output)[1:]))
+    batch = np.zeros((batch_size, img_width, img_height, 3), dtype=dtype)
+    for vid_idx in missing:
+        frames = None
+        if frames_cache:
+            frames = get_frame_tensor_sequence(corpus, [vid_idx], 0, img_width, img_height, from_notebook)
+        if frames is None:
+            frames = FramePathSequence([frames_path_before_video + list_videos[vid_idx] + '_front/'], [video_lengths[vid_idx]])
+        video_file = get_features_video_file(corpus, list_videos[vid_idx], input_type, from_notebook)
+        # written to a temporary file first, so that a partial file is never used
+        tmp_file = video_file[:-4] + '.tmp' + str(os.getpid()) + '.npy'
+        embeddings = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(len(frames), embedding_size))
+        for start in range(0, len(frames), batch_size):
+            end = min(start + batch_size, len(frames))
+            load_frames(frames, np.arange(start, end), img_width, img_height, cnnType, batch[:end-start])
+            embeddings[start:end] = head.predict(batch[:end-start]).reshape(end-start, embedding_size)
+        embeddings.flush()
+        del embeddings
+        os.replace(tmp_file, video_file)
+    return input_type, embedding_size
+
+stitchingModes = ['center', 'overlap_add']
+
+def get_window_starts(total_length, seq_length, stride):
+    """
+    Starts of windows of seq_length frames every stride frames,
+    the last window ending at total_length (so that tail frames are covered)
+    """
+    if total_length < seq_length:
+        sys.exit('Sequence shorter than seq_length')
+    starts = np.arange(0, total_length-seq_length+1, stride)
+    if starts[-1] + seq_length < total_length:
+        starts = np.append(starts, total_length-seq_length)
+    return starts
+
+def get_strided_windows(data, seq_length, stride):
+    """
+    View (windows_number, seq_length, ...) of windows of data (array (time_steps, ...)) every stride frames,
+    from frame 0 (no copy, see np.lib.stride_tricks.as_strided)
+    """
+    windows_number = (data.shape[0]-seq_length)//stride + 1
+    return np.lib.stride_tricks.as_strided(data,
+                                           shape=(windows_number, seq_length) + data.shape[1:],
+                                           strides=(data.strides[0]*stride,) + data.strides,
+                                           writeable=False)
+
+def stitch_predictions(pred, starts, total_length, stitching='center', out=None):
+    """
+    Stitches predictions of overlapping windows into one sequence
+
+    Inputs:
+        pred: predictions [windows_number, seq_length, categories] of windows starting at starts (increasing)
+        total_length: number of frames of the sequence
+        stitching: 'center': each frame is predicted by the window whose center is the closest
+                   'overlap_add': predictions of all windows containing the frame are averaged
+        out: array [total_length, categories] to fill (allocated if None)
+
+    Outputs:
+        out
+    """
+    seq_length = pred.shape[1]
+    if out is None:
+        out = np.zeros((total_length, pred.shape[2]), dtype=pred.dtype)
+    if stitching == 'center':
+        # boundaries between consecutive windows: middle of their centers
+        bounds = np.concatenate([[0], (starts[:-1] + starts[1:] + seq_length)//2, [total_length]])
+        for i_w in range(len(starts)):
+            out[bounds[i_w]:bounds[i_w+1]] = pred[i_w, bounds[i_w]-starts[i_w]:bounds[i_w+1]-starts[i_w]]
+    elif stitching == 'overlap_add':
+        out[...] = 0
+        counts = np.zeros(total_length, dtype=pred.dtype)
+        for i_w in range(len(starts)):
+            out[starts[i_w]:starts[i_w]+seq_length] += pred[i_w]
+            counts[starts[i_w]:starts[i_w]+seq_length] += 1
+        out /= counts[:, np.newaxis]
+    else:
+        sys.exit('Invalid stitching mode')
+    return out
+
+# number of windows per batch of model_predictions_strided when batch_size is 0
+stridedBatchSize = 32
+
+def model_predictions_strided(model,
+                              features,
+                              features_type,
+                              seq_length,
+                              categories_per_output,
+                              stride,
+                              stitching='center',
+                              img_width=224,
+                              img_height=224,
+                              cnnType='resnet',
+                              batch_size=0,
+                              dtype=np.float32):
+    '''
+    Predictions on overlapping windows every stride frames (stride <= seq_length),
+    stitched back into one sequence (see stitch_predictions). All frames are predicted, including the tail.
+    Inputs are read batch by batch: only the frames spanned by the windows of a batch are loaded,
+    windows being strided views of them (see get_strided_windows), so that overlaps are not copied.
+
+    Inputs: see model_predictions (batch_size: number of windows per batch, stridedBatchSize if 0)
+
+    Outputs:
+        predictions [1, total_time_steps, categories] (a list of them if there are several outputs)
+    '''
+    if stride > seq_length:
+        sys.exit('Stride should not exceed seq_length')
+    if features_type == 'features' or features_type == 'both':
+        total_length = features[0].shape[1]
+    elif features_type == 'frames':
+        total_length = len(features[1])
+    else:
+        sys.exit('Wrong features type')
+
+    N_outputs = len(categories_per_output)
+    starts = get_window_starts(total_length, seq_length, stride)
+    # the last window may be off the stride grid (see get_window_starts)
+    grid_number = (total_length-seq_length)//stride + 1
+    if batch_size == 0:
+        batch_size = stridedBatchSize
+    max_span = min(total_length, (batch_size-1)*stride + seq_length)
+    if features_type == 'frames' or features_type == 'both':
+        span_frames = np.zeros((max_span, img_width, img_height, 3), dtype=dtype)
+
+    pred = [np.zeros((len(starts), seq_length, categories_per_output[i]), dtype=dtype) for i in range(N_outputs)]
+    for i_start in range(0, len(starts), batch_size):
+        i_end = min(i_start+batch_size, len(starts))
+        i_grid_end = min(i_end, grid_number)
+        span_start = starts[i_start]
+        span_end = starts[i_end-1] + seq_length
+        spans = []
+        if features_type == 'features' or features_type == 'both':
+            spans.append(np.asarray(features[0][0, span_start:span_end], dtype=dtype))
+        if features_type == 'frames' or features_type == 'both':
+            load_frames(features[1], np.arange(span_start, span_end), img_width, img_height, cnnType, span_frames[:span_end-span_start])
+            spans.append(span_frames[:span_end-span_start])
+        X_windows = []
+        if i_grid_end > i_start:
+            X_windows.append((i_start, i_grid_end, [get_strided_windows(span, seq_length, stride)[:i_grid_end-i_start] for span in spans]))
+        if i_end > i_grid_end:
+            X_windows.append((i_grid_end, i_end, [span[np.newaxis, -seq_length:] for span in spans]))
+        for i_first, i_last, X_batch in X_windows:
+            if len(X_batch) == 1:
+                X_batch = X_batch[0]
+            pred_batch = model.predict(X_batch)
+            if N_outputs == 1:
+                pred_batch = [pred_batch]
+            for i_out in range(N_outputs):
+                pred[i_out][i_first:i_last] = pred_batch[i_out]
+
+    output = [stitch_predictions(pred[i_out], starts, total_length, stitching)[np.newaxis] for i_out in range(N_outputs)]
+    if N_outputs == 1:
+        return output[0]
+    return output
+
 def model_predictions(model,
                       features,
                       features_type,
@@ -405,7 +943,10 @@ def model_predictions(model,
                       img_width=224,
                       img_height=224,
                       cnnType='resnet',
-                      batch_size=0):
+                      batch_size=0,
+                      dtype=np.float32,
+                      stride=None,
+                      stitching='center'):
     '''
     Used to make predictions, especially useful when input
     is mixed with both preprocessed features and frames
@@ -413,18 +954,28 @@ def model_predictions(model,
     Inputs:
         model: a Keras model
         features : [X_features, X_frames]
-                   X_features: a numpy array [1, total_time_steps, features_number]
-                   X_frames: a list of frame paths
+                   X_features: a numpy array [1, total_time_steps, features_number] (or a ConcatenatedSequenceView)
+                   X_frames: a list of frame paths (or a FramePathSequence)
         features_type: 'features', 'frames' or 'both'
         seq_length
         categories_per_output: a list of number of categories for each output
         batch_size: if  0, predictions are sequence per sequence
                     if >0, predictions are run by batches
+                    (with a stride, windows are always predicted by batches, stridedBatchSize if 0)
+        dtype: data type of model inputs and predictions (default float32)
+        stride: if None, the sequence is cut in non-overlapping blocks of seq_length frames (tail frames are dropped)
+                otherwise, overlapping windows every stride frames (see model_predictions_strided)
+        stitching: how overlapping windows are stitched, one of stitchingModes (see stitch_predictions)
 
     Outputs:
-        predictions
+        predictions [sequences, seq_length, categories] ([1, total_time_steps, categories] if stride is given)
+                    (a list of them if there are several outputs)
     '''
 
+    if stride is not None:
+        return model_predictions_strided(model, features, features_type, seq_length, categories_per_output, stride, stitching,
+                                         img_width, img_height, cnnType, batch_size, dtype)
+
     N_outputs = len(categories_per_output)
 
     if features_type == 'frames':
@@ -435,24 +986,15 @@ def model_predictions(model,
     else:
         sys.exit('Wrong features type')
 
-    if features_type == 'features' or features_type == 'both':
-        X_features = features[0][:,:total_length_round,:].reshape(-1, seq_length, feature_number)
-
     #batch_size_time = np.min([batch_size*seq_length, total_length_round])
 
 
     if batch_size == 0:
+        if features_type == 'features' or features_type == 'both':
+            X_features = features[0][:,:total_length_round,:].reshape(-1, seq_length, feature_number).astype(dtype, copy=False)
         if features_type == 'frames' or features_type == 'both':
-            X_frames = np.zeros((1, total_length_round, img_width, img_height, 3))
-            for iFrame in range(total_length_round):
-                if cnnType=='resnet':
-                    X_frames[0, iFrame, :, :, :] = preprocess_input_ResNet50(img_to_array(load_img(features[1][iFrame],  target_size=(img_width, img_height))))
-                elif cnnType=='vgg':
-                    X_frames[0, iFrame, :, :, :] = preprocess_input_VGG16(img_to_array(load_img(features[1][iFrame],     target_size=(img_width, img_height))))
-                elif cnnType=='mobilenet':
-                    X_frames[0, iFrame, :, :, :] = preprocess_input_MobileNet(img_to_array(load_img(features[1][iFrame], target_size=(img_width, img_height))))
-                else:
-                    sys.exit('Invalid CNN network model')
+            X_frames = np.zeros((1, total_length_round, img_width, img_height, 3), dtype=dtype)
+            load_frames(features[1], np.arange(total_length_round), img_width, img_height, cnnType, X_frames[0])
             X_frames = X_frames.reshape(-1, seq_length, img_width, img_height, 3)
 
         if features_type == 'features':
@@ -464,9 +1006,9 @@ def model_predictions(model,
 
     else:
         if N_outputs > 1:
-            output = [np.zeros((1, total_length_round, categories_per_output[i])) for i in range(N_outputs)]
+            output = [np.zeros((1, total_length_round, categories_per_output[i]), dtype=dtype) for i in range(N_outputs)]
         else:
-            output = np.zeros((1, total_length_round, categories_per_output[0]))
+            output = np.zeros((1, total_length_round, categories_per_output[0]), dtype=dtype)
 
         N_full_batches = total_length_round//(batch_size*seq_length)
         remainding_length = total_length_round - N_full_batches*batch_size*seq_length
@@ -477,25 +1019,19 @@ def model_predictions(model,
             i_seq_end     = (i_batch+1)*batch_size
             i_frame_start = i_seq_start*seq_length
             i_frame_end   = i_seq_end*seq_length
+            if features_type == 'features' or features_type == 'both':
+                X_features_batch = features[0][:, i_frame_start:i_frame_end, :].reshape(-1, seq_length, feature_number).astype(dtype, copy=False)
             if features_type == 'frames' or features_type == 'both':
-                X_frames_batch = np.zeros((1, batch_size*seq_length, img_width, img_height, 3))
-                for iFrame in range(i_frame_start, i_frame_end):
-                    if cnnType=='resnet':
-                        X_frames_batch[0, iFrame-i_frame_start, :, :, :] = preprocess_input_ResNet50(img_to_array(load_img(features[1][iFrame],  target_size=(img_width, img_height))))
-                    elif cnnType=='vgg':
-                        X_frames_batch[0, iFrame-i_frame_start, :, :, :] = preprocess_input_VGG16(img_to_array(load_img(features[1][iFrame],     target_size=(img_width, img_height))))
-                    elif cnnType=='mobilenet':
-                        X_frames_batch[0, iFrame-i_frame_start, :, :, :] = preprocess_input_MobileNet(img_to_array(load_img(features[1][iFrame], target_size=(img_width, img_height))))
-                    else:
-                        sys.exit('Invalid CNN network model')
+                X_frames_batch = np.zeros((1, batch_size*seq_length, img_width, img_height, 3), dtype=dtype)
+                load_frames(features[1], np.arange(i_frame_start, i_frame_end), img_width, img_height, cnnType, X_frames_batch[0])
                 X_frames_batch = X_frames_batch.reshape(-1, seq_length, img_width, img_height, 3)
 
             if features_type == 'features':
-                pred = model.predict(X_features[i_seq_start:i_seq_end, :, :])
+                pred = model.predict(X_features_batch)
             elif features_type == 'frames':
                 pred = model.predict(X_frames_batch)
             else:#features_type == 'both':
-                pred = model.predict([X_features[i_seq_start:i_seq_end, :, :],
+                pred = model.predict([X_features_batch,
                                       X_frames_batch])
             if N_outputs > 1:
                 for i_out in range(N_outputs):
@@ -509,25 +1045,19 @@ def model_predictions(model,
         i_seq_end     = total_length_round//seq_length
         i_frame_start = i_seq_start*seq_length
         i_frame_end   = i_seq_end*seq_length
+        if features_type == 'features' or features_type == 'both':
+            X_features_batch = features[0][:, i_frame_start:i_frame_end, :].reshape(-1, seq_length, feature_number).astype(dtype, copy=False)
         if features_type == 'frames' or features_type == 'both':
-            X_frames_batch = np.zeros((1, remainding_length, img_width, img_height, 3))
-            for iFrame in range(i_frame_start, i_frame_end):
-                if cnnType=='resnet':
-                    X_frames_batch[0, iFrame-i_frame_start, :, :, :] = preprocess_input_ResNet50(img_to_array(load_img(features[1][iFrame],  target_size=(img_width, img_height))))
-                elif cnnType=='vgg':
-                    X_frames_batch[0, iFrame-i_frame_start, :, :, :] = preprocess_input_VGG16(img_to_array(load_img(features[1][iFrame],     target_size=(img_width, img_height))))
-                elif cnnType=='mobilenet':
-                    X_frames_batch[0, iFrame-i_frame_start, :, :, :] = preprocess_input_MobileNet(img_to_array(load_img(features[1][iFrame], target_size=(img_width, img_height))))
-                else:
-                    sys.exit('Invalid CNN network model')
+            X_frames_batch = np.zeros((1, remainding_length, img_width, img_height, 3), dtype=dtype)
+            load_frames(features[1], np.arange(i_frame_start, i_frame_end), img_width, img_height, cnnType, X_frames_batch[0])
             X_frames_batch = X_frames_batch.reshape(-1, seq_length, img_width, img_height, 3)
 
         if features_type == 'features':
-            pred = model.predict(X_features[i_seq_start:, :, :])
+            pred = model.predict(X_features_batch)
         elif features_type == 'frames':
             pred = model.predict(X_frames_batch)
         else:#features_type == 'both':
-            pred = model.predict([X_features[i_seq_start:, :, :],
+            pred = model.predict([X_features_batch,
                                   X_frames_batch])
         if N_outputs > 1:
             for i_out in range(N_outputs):
@@ -1,6 +1,6 @@
 import numpy as np
 import sys
-import itertools as it
+from models.rle_utils import RunLengthAnnotation
 
 def framewiseAccuracy(dataTrue, dataPred, trueIsCat, predIsCatOrProb, idxNotSeparation=np.array([])):
     """
@@ -293,9 +293,9 @@ def middleUnitPRF1(dataTrue, dataPred, trueIsCat, predIsCatOrProb, margin=0):
 
         Inputs:
             dataTrue: a numpy array of annotations, shape [timeSteps] (values are classes)
-                or [timeSteps, 2] (categorical data)
+                or [timeSteps, 2] (categorical data), or a RunLengthAnnotation
             dataPred: a numpy array of predictions, shape [timeSteps] (values are classes),
-                or [timeSteps, 2] (probabilities or categorical)
+                or [timeSteps, 2] (probabilities or categorical), or a RunLengthAnnotation
             trueIsCat, predIsCatOrProb: bool (if annotations are categorical,
                 if predictions are categorical/probability values for each category)
             threshold: the half widow size
@@ -344,9 +344,9 @@ def marginUnitPRF1(dataTrue, dataPred, trueIsCat, predIsCatOrProb, margin=0):
 
         Inputs:
             dataTrue: a numpy array of annotations, shape [timeSteps] (values are classes)
-                or [timeSteps, 2] (categorical data)
+                or [timeSteps, 2] (categorical data), or a RunLengthAnnotation
             dataPred: a numpy array of predictions, shape [timeSteps] (values are classes),
-                or [timeSteps, 2] (probabilities or categorical)
+                or [timeSteps, 2] (probabilities or categorical), or a RunLengthAnnotation
             trueIsCat, predIsCatOrProb: bool (if annotations are categorical,
                 if predictions are categorical/probability values for each category)
             threshold: the half widow size
@@ -397,25 +397,18 @@ def valuesConsecutive(data, isCatOrProb):
 
         Inputs:
             data: a numpy array of annotations/predictions, shape [timeSteps] (values are classes)
-                or [timeSteps, nbClasses] (probabilities or categorical)
+                or [timeSteps, nbClasses] (probabilities or categorical),
+                or a RunLengthAnnotation (isCatOrProb is then ignored)
             isCatOrProb: bool
 
         Outputs:
             a list of lists with 4 elements
     """
 
-    if not isCatOrProb:
-        if len(data.shape) > 1:
-            if data.shape[1] > 1:
-                sys.exit('data should be a vector (not categorical or probabilities) because isCatOrProb=False')
+    if not isinstance(data, RunLengthAnnotation):
+        data = RunLengthAnnotation.from_dense(data, isCatOrProb)
 
-    if isCatOrProb:
-        data = np.argmax(data,axis=1)
-    #
-    g = it.groupby(enumerate(data), lambda x:x[1])
-    l = [(x[0], list(x[1])) for x in g if x[0] != 0]
-    #[(x[0], len(x[1]), x[1][0][0]) for x in l]
-    return [(x[0], x[1][0][0], x[1][0][0]+len(x[1]), len(x[1])) for x in l]
+    return data.consecutive()
 
 def windowUnitsPredForTrue(iTrue, nbUnitsTrue, nbUnitsPred, fractionTotal):
     """
@@ -448,11 +441,6 @@ def matrixMatch(consecTrue, consecPred, seqLength):
         Outputs:
             a matrix of match scores (Wolf measure - normalized intersection between units)
     """
-    #l = dataTrue.size
-    l = seqLength
-    tempVectorTrue = np.ones(l)
-    tempVectorPred = np.ones(l)
-    tempVector = np.ones(l)
     #consecTrue = valuesConsecutive(dataTrue)
     #consecPred = valuesConsecutive(dataPred)
     nbUnitsTrue = len(consecTrue)
@@ -472,21 +460,14 @@ def matrixMatch(consecTrue, consecPred, seqLength):
     matrixClassPred=np.tile(vectorClassPred, (nbUnitsTrue,1))
     matrixPossibleMatches=(1-(matrixStartTrue >= matrixEndPred))*(1-(matrixStartPred >= matrixEndTrue))*(matrixClassTrue==matrixClassPred)
 
+    # intersection of [start, end) intervals
+    matrixIntersect = np.minimum(matrixEndTrue, matrixEndPred) - np.maximum(matrixStartTrue, matrixStartPred)
+    vectorLengthTrue = np.array([consecTrue[i][3] for i in range(nbUnitsTrue)])
+    vectorLengthPred = np.array([consecPred[i][3] for i in range(nbUnitsPred)])
+    matrixLengthSum = np.tile(vectorLengthTrue, (nbUnitsPred,1)).transpose() + np.tile(vectorLengthPred, (nbUnitsTrue,1))
+
     matrixM = np.zeros((nbUnitsTrue,nbUnitsPred))
-    for iTrue in range(nbUnitsTrue):
-        valuesUnitTrue = consecTrue[iTrue]
-        tempVectorTrue[:valuesUnitTrue[1]] = 0
-        tempVectorTrue[valuesUnitTrue[2]:] = 0
-        possibleMatchesPred = list(np.where(matrixPossibleMatches[iTrue,:])[0])
-        #min, max = windowUnitsPredForTrue(iTrue, nbUnitsTrue, nbUnitsPred, fractionTotal)
-        for iPred in possibleMatchesPred:#range(min, max):#range(nbUnitsPred):
-            valuesUnitPred = consecPred[iPred]
-            tempVectorPred[:valuesUnitPred[1]] = 0
-            tempVectorPred[valuesUnitPred[2]:] = 0
-            tempVector = tempVectorTrue*tempVectorPred
-            matrixM[iTrue,iPred] = 2 * (valuesUnitTrue[0] == valuesUnitPred[0]) * np.sum(tempVector)/(valuesUnitTrue[3] + valuesUnitPred[3])
-            tempVectorPred[:] = 1
-        tempVectorTrue[:] = 1
+    matrixM[matrixPossibleMatches > 0] = 2 * matrixIntersect[matrixPossibleMatches > 0] / matrixLengthSum[matrixPossibleMatches > 0]
     return matrixM
 
 def idxBestMatches(dataTrue, dataPred, matMatch, trueIsCat, predIsCatOrProb):
@@ -539,17 +520,9 @@ def isMatched(idxTrue, idxPred, tp, tr, consecTrue, consecPred, seqLength):
         Outputs:
             a matrix of match scores (Wolf measure - normalized intersection between units)
     """
-    l = seqLength
-    tempVectorTrue = np.ones(l)
-    tempVectorPred = np.ones(l)
     valuesUnitTrue = consecTrue[idxTrue]
     valuesUnitPred = consecPred[idxPred]
-    tempVectorTrue[:valuesUnitTrue[1]] = 0
-    tempVectorTrue[valuesUnitTrue[2]:] = 0
-    tempVectorPred[:valuesUnitPred[1]] = 0
-    tempVectorPred[valuesUnitPred[2]:] = 0
-    tempVector = tempVectorTrue*tempVectorPred
-    intersect = np.sum(tempVectorTrue * tempVectorPred)
+    intersect = max(0, min(valuesUnitTrue[2], valuesUnitPred[2]) - max(valuesUnitTrue[1], valuesUnitPred[1]))
     if intersect/valuesUnitPred[3] > tp and intersect/valuesUnitTrue[3] > tr and valuesUnitTrue[0] == valuesUnitPred[0]:
         return 1
     else:
@@ -561,9 +534,9 @@ def prfStar(dataTrue, dataPred, trueIsCat, predIsCatOrProb, step=0.01):
 
         Inputs:
             dataTrue: a numpy array of annotations, shape [timeSteps] (values are classes)
-                or [timeSteps, 2] (categorical data)
+                or [timeSteps, 2] (categorical data), or a RunLengthAnnotation
             dataPred: a numpy array of predictions, shape [timeSteps] (values are classes),
-                or [timeSteps, 2] (probabilities or categorical)
+                or [timeSteps, 2] (probabilities or categorical), or a RunLengthAnnotation
             trueIsCat, predIsCatOrProb: bool (if annotations are categorical,
                 if predictions are categorical/probability values for each category)
             step: between tp and tr values
@@ -0,0 +1,227 @@
+import numpy as np
+import sys
+
+class RunLengthAnnotation(object):
+    """
+        Run-length encoded framewise annotation: frames starts[i]:ends[i] (end excluded)
+        all have the class values[i]. Runs cover the whole sequence (zero runs included)
+        and two consecutive runs never have the same value.
+
+        Inputs:
+            starts, ends, values: int arrays (one element per run)
+            length: number of frames
+    """
+    def __init__(self, starts, ends, values, length):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.int64)
+        self.length = int(length)
+        self.shape = (self.length,)
+
+    def __len__(self):
+        return self.length
+
+    @classmethod
+    def from_dense(cls, data, isCatOrProb=False):
+        """
+            Encodes a numpy array of shape [timeSteps] (values are classes),
+            [timeSteps, 1] or [timeSteps, nbClasses] (probabilities or categorical, if isCatOrProb)
+        """
+        data = np.asarray(data)
+        if isCatOrProb:
+            data = np.argmax(data, axis=1)
+        elif data.ndim > 1:
+            if data.shape[1] > 1:
+                sys.exit('data should be a vector (not categorical or probabilities) because isCatOrProb=False')
+            data = data[:, 0]
+        data = data.astype(np.int64)
+        length = data.size
+        if length == 0:
+            return cls([], [], [], 0)
+        starts = np.concatenate(([0], np.flatnonzero(data[1:] != data[:-1]) + 1))
+        ends = np.append(starts[1:], length)
+        return cls(starts, ends, data[starts], length)
+
+    @classmethod
+    def concatenate(cls, annotations, separation=0):
+        """
+            Concatenates several RunLengthAnnotation, each followed by separation zero frames
+        """
+        starts, ends, values = [], [], []
+        offset = 0
+        for a in annotations:
+            starts.append(a.starts + offset)
+            ends.append(a.ends + offset)
+            values.append(a.values)
+            offset += a.length
+            if separation > 0:
+                starts.append(np.array([offset]))
+                ends.append(np.array([offset + separation]))
+                values.append(np.array([0]))
+                offset += separation
+        if len(starts) == 0:
+            return cls([], [], [], 0)
+        return cls(np.concatenate(starts), np.concatenate(ends), np.concatenate(values), offset).merged()
+
+    @classmethod
+    def combine(cls, annotations, function):
+        """
+            Framewise combination of annotations of the same length, on the union of their run boundaries:
+            values are function(values) (values: int array [len(annotations), runs_number])
+        """
+        length = annotations[0].length
+        if length == 0:
+            return cls([], [], [], 0)
+        starts = np.unique(np.concatenate([a.starts for a in annotations]))
+        ends = np.append(starts[1:], length)
+        values = np.stack([a.values[np.searchsorted(a.starts, starts, side='right') - 1] for a in annotations])
+        return cls(starts, ends, function(values), length).merged()
+
+    def merged(self):
+        """
+            Returns the same annotation where consecutive runs of equal value are merged
+        """
+        if self.values.size < 2:
+            return self
+        keep = np.concatenate(([True], self.values[1:] != self.values[:-1]))
+        last = np.append(np.flatnonzero(keep)[1:] - 1, self.values.size - 1)
+        return RunLengthAnnotation(self.starts[keep], self.ends[last], self.values[keep], self.length)
+
+    def map_values(self, lut):
+        """
+            Returns the annotation with values replaced by lut[values] (lut: dict or array)
+        """
+        if isinstance(lut, dict):
+            new_values = np.array([lut.get(v, 0) for v in self.values.tolist()], dtype=np.int64)
+        else:
+            new_values = np.asarray(lut)[self.values]
+        return RunLengthAnnotation(self.starts, self.ends, new_values, self.length).merged()
+
+    def run_range(self, start, end):
+        """
+            Indices i_first:i_last of the runs overlapping frames start:end
+        """
+        return int(np.searchsorted(self.ends, start, side='right')), int(np.searchsorted(self.starts, end, side='left'))
+
+    def crop(self, start=0, end=None):
+        """
+            Annotation of frames start:end
+        """
+        if end is None:
+            end = self.length
+        i_first, i_last = self.run_range(start, end)
+        starts = np.maximum(self.starts[i_first:i_last], start) - start
+        ends = np.minimum(self.ends[i_first:i_last], end) - start
+        return RunLengthAnnotation(starts, ends, self.values[i_first:i_last], end - start)
+
+    def to_dense(self, start=0, end=None, dtype=np.int64):
+        """
+            Class of each frame start:end, shape [end-start]
+        """
+        if end is None:
+            end = self.length
+        output = np.zeros(end - start, dtype=dtype)
+        i_first, i_last = self.run_range(start, end)
+        for i_r in range(i_first, i_last):
+            output[max(self.starts[i_r], start)-start:min(self.ends[i_r], end)-start] = self.values[i_r]
+        return output
+
+    def to_categorical(self, nbClasses, start=0, end=None, dtype=np.float32):
+        """
+            One-hot frames start:end, shape [end-start, nbClasses]
+        """
+        dense = self.to_dense(start, end)
+        output = np.zeros((dense.size, nbClasses), dtype=dtype)
+        output[np.arange(dense.size), dense] = 1
+        return output
+
+    def consecutive(self):
+        """
+            List of non-zero units (value, start, end (+1), nb of values),
+            same format as perf_utils.valuesConsecutive
+        """
+        idx = np.flatnonzero(self.values != 0)
+        return [(int(self.values[i]), int(self.starts[i]), int(self.ends[i]), int(self.ends[i]-self.starts[i])) for i in idx]
+
+class RunLengthLabels(object):
+    """
+        Framewise labels (one-hot or multi-hot) stored as runs of label codes:
+        the label of a frame is codes[value of its run]. Dense labels are only built for the frames read (e.g. per batch).
+        For reading, it behaves like an array of shape (1, time_steps, categories), as ConcatenatedSequenceView:
+        labels[0, start:end, :] or labels[:, start:end, :] return new arrays,
+        read(start, end, out) and read_wrap(start, length, period, out) fill a given buffer.
+
+        Inputs:
+            runs: RunLengthAnnotation whose values are rows of codes
+            codes: array [codes_number, categories] (e.g. identity matrix for one-hot labels)
+    """
+    def __init__(self, runs, codes):
+        self.runs = runs
+        self.codes = np.asarray(codes)
+        self.dtype = self.codes.dtype
+        self.shape = (1, runs.length, self.codes.shape[1])
+        self.ndim = 3
+        # class of each code, as the argmax of dense labels
+        self.code_classes = np.argmax(self.codes, axis=1)
+
+    def __len__(self):
+        return 1
+
+    def classes(self, start=0, end=None):
+        """
+            Classes (argmax of the labels) of frames start:end, as a RunLengthAnnotation
+        """
+        return self.runs.crop(start, end).map_values(self.code_classes)
+
+    def frame_classes(self):
+        """
+            Class (argmax of the label) of each frame, int array [time_steps]
+        """
+        return self.code_classes[self.runs.to_dense()]
+
+    def read(self, start, end, out=None):
+        """
+            Fills out ([end-start, categories], allocated if None) with the labels of frames start:end, run by run
+        """
+        if out is None:
+            out = np.empty((end - start, self.shape[2]), dtype=self.dtype)
+        i_first, i_last = self.runs.run_range(start, end)
+        for i_r in range(i_first, i_last):
+            out[max(self.runs.starts[i_r], start)-start:min(self.runs.ends[i_r], end)-start] = self.codes[self.runs.values[i_r]]
+        return out
+
+    def read_wrap(self, start, length, period=None, out=None):
+        """
+            Labels of length frames from start, wrapping around at period (default: total length)
+        """
+        if period is None:
+            period = self.shape[1]
+        if out is None:
+            out = np.empty((length, self.shape[2]), dtype=self.dtype)
+        end = start + length
+        if end <= period:
+            self.read(start, end, out)
+        else:
+            self.read(start, period, out[:period-start])
+            self.read(0, end-period, out[period-start:])
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        if key[0] != 0 and key[0] != slice(None):
+            raise IndexError('RunLengthLabels has a single element along the first axis')
+        start, end, step = key[1].indices(self.shape[1])
+        if step != 1:
+            raise IndexError('Only contiguous time slices are supported')
+        output = self.read(start, max(start, end))[:, key[2]]
+        if key[0] == 0:
+            return output
+        return output[np.newaxis]
+
+    def __array__(self, dtype=None):
+        output = self.read(0, self.shape[1])[np.newaxis]
+        if dtype is not None:
+            output = output.astype(dtype, copy=False)
+        return output
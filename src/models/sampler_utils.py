@@ -0,0 +1,111 @@
+import numpy as np
+import sys
+from models.rle_utils import RunLengthAnnotation, RunLengthLabels
+
+samplingModes = ['random', 'permuted', 'stratified', 'balanced']
+
+class WindowSampler(object):
+    """
+        Chooses the training windows of each epoch, over a concatenated sequence of total_length_round frames.
+        epoch() returns one item per batch:
+            an int (start of batch_size*seq_length contiguous frames, wrapping around) for 'random',
+            an int array of batch_size sequence starts otherwise.
+
+        Modes:
+            'random': one uniform random start per batch (some frames are seen several times per epoch, others never)
+            'permuted': windows every stride frames (from a random phase), shuffled,
+                        each window is used exactly once per epoch
+            'stratified': same windows, each batch taking one window in each of batch_size parts of the sequence
+            'balanced': each window contains a frame of a class drawn uniformly among classes,
+                        the frame being drawn within the annotation runs of that class
+
+        Inputs:
+            mode: one of samplingModes
+            total_length_round: number of frames to sample from
+            seq_length: length of sequences
+            batch_size: number of sequences per batch
+            steps: number of batches per epoch ('random' and 'balanced', default: total_length_round/(batch_size*seq_length))
+            stride: distance between windows ('permuted' and 'stratified', default: seq_length)
+            annot_classes: RunLengthAnnotation of the frame classes (required for 'balanced')
+            seed: seed of the random generator (deterministic epochs)
+    """
+    def __init__(self, mode, total_length_round, seq_length, batch_size, steps=None, stride=None, annot_classes=None, seed=None):
+        if mode not in samplingModes:
+            sys.exit('Invalid sampling mode')
+        self.mode = mode
+        self.total_length_round = int(total_length_round)
+        self.seq_length = seq_length
+        self.batch_size = int(min(batch_size, self.total_length_round//seq_length))
+        if stride is None:
+            stride = seq_length
+        self.stride = stride
+        self.random_state = np.random.RandomState(seed)
+
+        if mode == 'permuted' or mode == 'stratified':
+            self.windows_number = int(np.ceil(self.total_length_round/stride))
+            self.steps = int(np.ceil(self.windows_number/self.batch_size))
+        elif steps is None:
+            self.steps = int(np.ceil(self.total_length_round/(self.batch_size*seq_length)))
+        else:
+            self.steps = int(steps)
+
+        if mode == 'balanced':
+            if annot_classes is None:
+                sys.exit('Balanced sampling requires the annotation classes')
+            self.class_runs = []
+            for c in np.unique(annot_classes.values):
+                idx = np.flatnonzero((annot_classes.values == c) & (annot_classes.starts < self.total_length_round))
+                starts = annot_classes.starts[idx]
+                ends = np.minimum(annot_classes.ends[idx], self.total_length_round)
+                cumulated_lengths = np.cumsum(ends - starts)
+                self.class_runs.append((starts, cumulated_lengths, cumulated_lengths - (ends - starts)))
+
+    def __len__(self):
+        return self.steps
+
+    def epoch(self):
+        """
+            Windows of the next epoch (list of steps items)
+        """
+        if self.mode == 'random':
+            return list(self.random_state.randint(0, self.total_length_round, self.steps))
+
+        if self.mode == 'balanced':
+            N = self.steps*self.batch_size
+            classes = self.random_state.randint(0, len(self.class_runs), N)
+            frames = np.zeros(N, dtype=np.int64)
+            for i_c in range(len(self.class_runs)):
+                idx = np.flatnonzero(classes == i_c)
+                starts, cumulated_lengths, previous_lengths = self.class_runs[i_c]
+                # frame drawn uniformly among the frames of the class
+                position = self.random_state.randint(0, cumulated_lengths[-1], idx.size)
+                i_run = np.searchsorted(cumulated_lengths, position, side='right')
+                frames[idx] = starts[i_run] + position - previous_lengths[i_run]
+            windows = np.mod(frames - self.random_state.randint(0, self.seq_length, N), self.total_length_round)
+            return list(windows.reshape(self.steps, self.batch_size))
+
+        phase = self.random_state.randint(0, self.stride)
+        windows = np.mod(phase + self.stride*np.arange(self.windows_number), self.total_length_round)
+        N = self.steps*self.batch_size
+        if self.mode == 'permuted':
+            windows = self.random_state.permutation(windows)
+            # last batch completed with windows of the beginning of the epoch
+            windows = np.resize(windows, N)
+        else: # 'stratified'
+            # windows_number split in batch_size parts, each batch takes one window of each part
+            windows = np.resize(windows, N).reshape(self.batch_size, self.steps)
+            for i_part in range(self.batch_size):
+                windows[i_part] = self.random_state.permutation(windows[i_part])
+            windows = windows.T
+        return list(windows.reshape(self.steps, self.batch_size))
+
+def get_annotation_classes(annot, total_length_round):
+    """
+        Classes of the frames (argmax of the annotation; first output if output_form is 'mixed')
+        as a RunLengthAnnotation, used by 'balanced' sampling
+    """
+    if type(annot) == list:
+        annot = annot[0]
+    if isinstance(annot, RunLengthLabels):
+        return annot.classes(0, total_length_round)
+    return RunLengthAnnotation.from_dense(annot[0, :total_length_round, :], True)
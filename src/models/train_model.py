@@ -17,11 +17,7 @@ if v0 == '2':
     from tensorflow.keras.layers import LSTM, Dense, TimeDistributed, Bidirectional, Input, Dense, Conv1D, Dropout, GlobalAveragePooling1D, multiply
     from tensorflow.python.keras.layers.core import *
     from tensorflow.keras.models import *
-    from tensorflow.keras.utils import to_categorical, plot_model
-    from tensorflow.keras.preprocessing.image import load_img, img_to_array
-    from tensorflow.keras.applications.resnet50 import preprocess_input as preprocess_input_ResNet50
-    from tensorflow.keras.applications.vgg16 import preprocess_input as preprocess_input_VGG16
-    from tensorflow.keras.applications.mobilenet import preprocess_input as preprocess_input_MobileNet
+    from tensorflow.keras.utils import to_categorical, plot_model, Sequence
 elif v0 == '1':
     #For tensorflow 1.2.0
     import keras.backend as K
@@ -30,180 +26,556 @@ elif v0 == '1':
     from keras.layers import LSTM, Dense, TimeDistributed, Bidirectional, Input, Dense, Conv1D, Dropout, GlobalAveragePooling1D, merge
     from keras.layers.core import *
     from keras.models import *
-    from keras.utils import to_categorical, plot_model
-    from keras.preprocessing.image import load_img, img_to_array
-    from keras.applications.resnet50 import preprocess_input as preprocess_input_ResNet50
-    from keras.applications.vgg16 import preprocess_input as preprocess_input_VGG16
-    from keras.applications.mobilenet import preprocess_input as preprocess_input_MobileNet
+    from keras.utils import to_categorical, plot_model, Sequence
 
 else:
     sys.exit('Tensorflow version should be 1.X or 2.X')
 
+from models.sampler_utils import WindowSampler, get_annotation_classes
+from models.rle_utils import RunLengthLabels
+from models.model_utils import load_frames
 
-def generator(features,
+
+def get_annotation_frame_classes(annot):
+    """
+    Class of each frame (argmax of annotation) of one output: array (1, time_steps, classes) or RunLengthLabels
+    """
+    if isinstance(annot, RunLengthLabels):
+        return annot.frame_classes()
+    return np.argmax(annot[0,:,:], axis=1)
+
+def get_labels_weight(annot, output_form, output_class_weights, dtype=np.float32):
+    """
+    Per-frame weights from class weights (class of each frame = argmax of annotation, looked up once per output)
+    Returns a list of arrays (1, time_steps) (output_form: 'mixed') or one array (1, time_steps) (output_form: 'sign_types')
+    """
+    if output_form == 'mixed':
+        annot_labels_weight = []
+        for i_label_cat in range(len(annot)):
+            lut = np.asarray(output_class_weights[i_label_cat], dtype=dtype)
+            annot_labels_weight.append(lut[get_annotation_frame_classes(annot[i_label_cat])][np.newaxis])
+    elif output_form == 'sign_types':
+        lut = np.asarray(output_class_weights[0], dtype=dtype)
+        annot_labels_weight = lut[get_annotation_frame_classes(annot)][np.newaxis]
+    else:
+        sys.exit('Wrong annotation format')
+    return annot_labels_weight
+
+def wrap_time_copy(data, start, length, period, out):
+    """
+    Copies data[0, start:start+length] into out, wrapping around at period
+    (data: array (1, time_steps, ...) or (1, time_steps), or ConcatenatedSequenceView)
+    At most two slice copies, no allocation.
+    """
+    if hasattr(data, 'read_wrap'):
+        return data.read_wrap(start, length, period, out)
+    end = start + length
+    if end <= period:
+        out[...] = data[0, start:end]
+    else:
+        out[:period-start] = data[0, start:period]
+        out[period-start:] = data[0, 0:end-period]
+    return out
+
+def copy_windows(data, start, batch_size_time, seq_length, period, out):
+    """
+    Fills out with batch_size_time contiguous frames from start (int),
+    or with one sequence of seq_length frames from each start (int array, see WindowSampler)
+    """
+    if np.ndim(start) == 0:
+        return wrap_time_copy(data, start, batch_size_time, period, out)
+    for i_seq in range(len(start)):
+        wrap_time_copy(data, start[i_seq], seq_length, period, out[i_seq*seq_length:(i_seq+1)*seq_length])
+    return out
+
+class BatchBuffers(object):
+    """
+    Persistent output arrays of one batch.
+    Flat arrays (batch_size_time, ...) are filled in place by get_batch,
+    batch holds reshaped views of them, in the format given to keras:
+    (inputs, labels) or (inputs, labels, weights)
+    """
+    def __init__(self,
+                 features,
+                 features_type,
+                 annot,
+                 with_weights,
+                 batch_size_time,
+                 seq_length,
+                 output_form,
+                 img_width,
+                 img_height,
+                 dtype=np.float32):
+        inputs = []
+        if features_type == 'features' or features_type == 'both':
+            feature_number = features[0].shape[2]
+            self.features = np.zeros((batch_size_time, feature_number), dtype=dtype)
+            inputs.append(self.features.reshape(-1, seq_length, feature_number))
+        if features_type == 'frames' or features_type == 'both':
+            self.frames = np.zeros((batch_size_time, img_width, img_height, 3), dtype=dtype)
+            inputs.append(self.frames.reshape(-1, seq_length, img_width, img_height, 3))
+        if len(inputs) == 0:
+            sys.exit('Wrong features type')
+        if len(inputs) == 1:
+            inputs = inputs[0]
+
+        if output_form == 'mixed':
+            self.labels = [np.zeros((batch_size_time, annot[i_label_cat].shape[2]), dtype=dtype) for i_label_cat in range(len(annot))]
+            labels = [l.reshape(-1, seq_length, l.shape[1]) for l in self.labels]
+            self.weights = [np.zeros(batch_size_time, dtype=dtype) for i_label_cat in range(len(annot))]
+            weights = [w.reshape(-1, seq_length) for w in self.weights]
+        elif output_form == 'sign_types':
+            self.labels = np.zeros((batch_size_time, annot.shape[2]), dtype=dtype)
+            labels = self.labels.reshape(-1, seq_length, annot.shape[2])
+            self.weights = np.zeros(batch_size_time, dtype=dtype)
+            weights = self.weights.reshape(-1, seq_length)
+        else:
+            sys.exit('Wrong annotation format')
+
+        if with_weights:
+            self.batch = (inputs, labels, weights)
+        else:
+            self.batch = (inputs, labels)
+
+def get_batch(features,
               features_type,
               annot,
-              batch_size,
+              annot_labels_weight,
+              start,
+              batch_size_time,
+              total_length_round,
               seq_length,
               output_form,
-              output_class_weights,
               img_width,
               img_height,
-              cnnType):
+              cnnType,
+              dtype=np.float32,
+              out=None):
     """
-    Generator function for batch training models
-    features: [preprocessed features (numpy array (1, time_steps, nb_features)), images_path (list of strings)]
+    Builds the batch of batch_size_time frames from start (wrapping around at total_length_round)
+    start: int (contiguous frames) or int array of sequence starts (see copy_windows)
+    Returns (inputs, labels) or (inputs, labels, weights) if annot_labels_weight is not None
+    out: BatchBuffers to fill (and return the batch of), allocated if None
     """
+    if out is None:
+        out = BatchBuffers(features, features_type, annot, annot_labels_weight is not None, batch_size_time,
+                           seq_length, output_form, img_width, img_height, dtype)
+
+    if features_type == 'features' or features_type == 'both':
+        copy_windows(features[0], start, batch_size_time, seq_length, total_length_round, out.features)
+    if features_type == 'frames' or features_type == 'both':
+        if np.ndim(start) == 0:
+            frame_idx = np.mod(start + np.arange(batch_size_time), total_length_round)
+        else:
+            frame_idx = np.mod((np.asarray(start)[:, np.newaxis] + np.arange(seq_length)).reshape(-1), total_length_round)
+        load_frames(features[1], frame_idx, img_width, img_height, cnnType, out.frames)
+
+    if output_form == 'mixed':
+        for i_label_cat in range(len(annot)):
+            copy_windows(annot[i_label_cat], start, batch_size_time, seq_length, total_length_round, out.labels[i_label_cat])
+            if annot_labels_weight is not None:
+                copy_windows(annot_labels_weight[i_label_cat], start, batch_size_time, seq_length, total_length_round, out.weights[i_label_cat])
+    else:
+        copy_windows(annot, start, batch_size_time, seq_length, total_length_round, out.labels)
+        if annot_labels_weight is not None:
+            copy_windows(annot_labels_weight, start, batch_size_time, seq_length, total_length_round, out.weights)
 
+    return out.batch
+
+def get_total_length_round(features, features_type, seq_length):
+    """
+    Number of frames used for batches (multiple of seq_length)
+    """
     if features_type == 'frames':
-        total_length_round = (len(features[1])//seq_length)*seq_length
+        return (len(features[1])//seq_length)*seq_length
     elif features_type == 'features' or features_type == 'both':
-        total_length_round = (features[0].shape[1]//seq_length)*seq_length
-        feature_number = features[0].shape[2]
+        return (features[0].shape[1]//seq_length)*seq_length
     else:
         sys.exit('Wrong features type')
 
+def generator(features,
+              features_type,
+              annot,
+              batch_size,
+              seq_length,
+              output_form,
+              output_class_weights,
+              img_width,
+              img_height,
+              cnnType,
+              dtype=np.float32,
+              n_buffers=12,
+              sampler=None,
+              annot_labels_weight=None):
+    """
+    Generator function for batch training models
+    features: [preprocessed features (numpy array (1, time_steps, nb_features)), images_path (list of strings or FramePathSequence)]
+    dtype: data type of the batches (default float32)
+    n_buffers: batches are written in a ring of n_buffers persistent buffers (no allocation per batch),
+               it must be larger than the number of batches held at once by the consumer
+               (max_queue_size + 2 with fit_generator)
+    sampler: WindowSampler choosing the batches of each epoch (default: uniform random start for each batch)
+    annot_labels_weight: precomputed per-frame weights (see get_labels_weight), instead of output_class_weights
+    """
+
+    total_length_round = get_total_length_round(features, features_type, seq_length)
     batch_size_time = np.min([batch_size*seq_length, total_length_round])
 
-    if features_type == 'frames' or features_type == 'both':
-        batch_frames = np.zeros((1, batch_size_time, img_width, img_height, 3))
-    if features_type == 'features' or features_type == 'both':
-        batch_features = np.zeros((1, batch_size_time, feature_number))
+    if annot_labels_weight is None and output_class_weights != []:
+        annot_labels_weight = get_labels_weight(annot, output_form, output_class_weights, dtype)
 
-    if output_class_weights != []:
-        if output_form == 'mixed':
-            annot_labels_weight = []#np.ones((1, annot[0].shape[1]))
-            batch_labels_weight = []#np.zeros((1, batch_size_time))
-            labels_number = len(annot)
-            for i_label_cat in range(labels_number):
-                annot_labels_weight_tmp = np.zeros((1, annot[i_label_cat].shape[1]))
-                nClasses = annot[i_label_cat].shape[2]
-                for iClass in range(nClasses):
-                    annot_labels_weight_tmp[0, np.argmax(annot[i_label_cat][0,:,:],axis=1)==iClass] = output_class_weights[i_label_cat][iClass]
-                annot_labels_weight.append(annot_labels_weight_tmp)# = annot_labels_weight*annot_labels_weight_tmp
-                batch_labels_weight.append(np.zeros((1, batch_size_time)))
-        elif output_form == 'sign_types':
-            nClasses = annot.shape[2]
-            annot_labels_weight=np.zeros((1, annot.shape[1]))
-            batch_labels_weight = np.zeros((1, batch_size_time))
-            for iClass in range(nClasses):
-                annot_labels_weight[0, np.argmax(annot[0,:,:],axis=1)==iClass] = output_class_weights[0][iClass]
+    ring = [BatchBuffers(features, features_type, annot, annot_labels_weight is not None, batch_size_time,
+                         seq_length, output_form, img_width, img_height, dtype) for i in range(n_buffers)]
 
-    if output_form == 'mixed':
-        batch_labels = []
-        labels_number = len(annot)
-        labels_shape = []
-        for i_label_cat in range(labels_number):
-            labels_shape.append(annot[i_label_cat].shape[2])
-            batch_labels.append(np.zeros((1, batch_size_time, labels_shape[i_label_cat])))
-    elif output_form == 'sign_types':
-        labels_shape = annot.shape[2]
-        batch_labels = np.zeros((1, batch_size_time, labels_shape))
+    i_batch = 0
+    while True:
+        if sampler is None:
+            # Random start
+            starts = [np.random.randint(0, total_length_round)]
+        else:
+            starts = sampler.epoch()
+        for start in starts:
+            yield get_batch(features, features_type, annot, annot_labels_weight, start, batch_size_time, total_length_round,
+                            seq_length, output_form, img_width, img_height, cnnType, dtype, ring[i_batch % n_buffers])
+            i_batch += 1
+
+class BatchSequence(Sequence):
+    """
+    keras Sequence equivalent of generator, for multi-worker prefetching in fit_generator
+    (workers, use_multiprocessing, max_queue_size).
+    Each epoch has steps batches, chosen by sampler at the end of the previous epoch
+    (default: WindowSampler 'random', i.e. a uniform random start per batch).
+    Batches only depend on their index, so they can be built in any order, by threads or processes.
+    With n_buffers, batch idx is written in persistent buffer idx % n_buffers
+    (threads only; n_buffers must exceed max_queue_size + workers + 1).
+    Per-frame weights are computed once from output_class_weights, or given by annot_labels_weight.
+    """
+    def __init__(self,
+                 features,
+                 features_type,
+                 annot,
+                 batch_size,
+                 seq_length,
+                 output_form,
+                 output_class_weights,
+                 img_width,
+                 img_height,
+                 cnnType,
+                 dtype=np.float32,
+                 steps=None,
+                 seed=None,
+                 n_buffers=None,
+                 sampler=None,
+                 annot_labels_weight=None):
+        self.features = features
+        self.features_type = features_type
+        self.annot = annot
+        self.seq_length = seq_length
+        self.output_form = output_form
+        self.img_width = img_width
+        self.img_height = img_height
+        self.cnnType = cnnType
+        self.dtype = dtype
+        self.total_length_round = get_total_length_round(features, features_type, seq_length)
+        self.batch_size_time = int(np.min([batch_size*seq_length, self.total_length_round]))
+        if annot_labels_weight is None and output_class_weights != []:
+            annot_labels_weight = get_labels_weight(annot, output_form, output_class_weights, dtype)
+        self.annot_labels_weight = annot_labels_weight
+        if sampler is None:
+            if steps is None:
+                if features_type == 'frames':
+                    steps = int(np.ceil(len(features[1])/self.batch_size_time))
+                else:
+                    steps = int(np.ceil(features[0].shape[1]/self.batch_size_time))
+            sampler = WindowSampler('random', self.total_length_round, seq_length, batch_size, steps=steps, seed=seed)
+        self.sampler = sampler
+        self.steps = len(sampler)
+        if n_buffers is None:
+            self.ring = None
+        else:
+            self.ring = [BatchBuffers(features, features_type, annot, self.annot_labels_weight is not None, self.batch_size_time,
+                                      seq_length, output_form, img_width, img_height, dtype) for i in range(n_buffers)]
+        self.on_epoch_end()
+
+    def __len__(self):
+        return self.steps
+
+    def __getitem__(self, idx):
+        if self.ring is None:
+            out = None
+        else:
+            out = self.ring[idx % len(self.ring)]
+        return get_batch(self.features, self.features_type, self.annot, self.annot_labels_weight, self.starts[idx],
+                         self.batch_size_time, self.total_length_round, self.seq_length, self.output_form,
+                         self.img_width, self.img_height, self.cnnType, self.dtype, out)
+
+    def on_epoch_end(self):
+        self.starts = self.sampler.epoch()
+
+class ValidationSequence(Sequence):
+    """
+    keras Sequence walking the full concatenation once per evaluation, in fixed contiguous batches
+    (batch i: frames i*batch_size*seq_length to (i+1)*batch_size*seq_length, the last one may be shorter).
+    Validation metrics are thus computed on the whole set, identically at each evaluation.
+    cache: batches are built once and kept as ready arrays across epochs
+           (default: True, except with frames, which would hold all validation images in memory)
+    """
+    def __init__(self,
+                 features,
+                 features_type,
+                 annot,
+                 batch_size,
+                 seq_length,
+                 output_form,
+                 output_class_weights,
+                 img_width,
+                 img_height,
+                 cnnType,
+                 dtype=np.float32,
+                 annot_labels_weight=None,
+                 cache=None):
+        self.features = features
+        self.features_type = features_type
+        self.annot = annot
+        self.seq_length = seq_length
+        self.output_form = output_form
+        self.img_width = img_width
+        self.img_height = img_height
+        self.cnnType = cnnType
+        self.dtype = dtype
+        self.total_length_round = get_total_length_round(features, features_type, seq_length)
+        self.batch_size_time = int(np.min([batch_size*seq_length, self.total_length_round]))
+        if annot_labels_weight is None and output_class_weights != []:
+            annot_labels_weight = get_labels_weight(annot, output_form, output_class_weights, dtype)
+        self.annot_labels_weight = annot_labels_weight
+        self.steps = int(np.ceil(self.total_length_round/self.batch_size_time))
+        if cache is None:
+            cache = features_type == 'features'
+        if cache:
+            self.batches = [self.build_batch(idx) for idx in range(self.steps)]
+        else:
+            self.batches = None
+
+    def __len__(self):
+        return self.steps
+
+    def build_batch(self, idx):
+        start = idx*self.batch_size_time
+        batch_size_time = min(self.batch_size_time, self.total_length_round - start)
+        return get_batch(self.features, self.features_type, self.annot, self.annot_labels_weight, start,
+                         batch_size_time, self.total_length_round, self.seq_length, self.output_form,
+                         self.img_width, self.img_height, self.cnnType, self.dtype)
+
+    def __getitem__(self, idx):
+        if self.batches is None:
+            return self.build_batch(idx)
+        return self.batches[idx]
+
+def get_video_segments(features, features_type, max_length=None):
+    """
+    (start, length) of each video in the concatenation (separation frames excluded),
+    videos longer than max_length being cut into segments of at most max_length frames.
+    Video bounds come from the ConcatenatedSequenceView of features or from the FramePathSequence of frames.
+    """
+    if features_type != 'frames' and hasattr(features[0], 'offsets'):
+        bounds = features[0]
+    elif features_type != 'features' and hasattr(features[1], 'offsets'):
+        bounds = features[1]
     else:
-        sys.exit('Wrong annotation format')
+        sys.exit('Per-video batching requires a ConcatenatedSequenceView or a FramePathSequence')
+    segments = []
+    for i_v in range(len(bounds.video_lengths)):
+        video_start = int(bounds.offsets[i_v])
+        video_length = int(bounds.video_lengths[i_v])
+        if max_length is None:
+            segments_number = 1
+        else:
+            segments_number = int(np.ceil(video_length/max_length))
+        # segments of (almost) equal lengths
+        cuts = np.linspace(0, video_length, segments_number+1).astype(int)
+        for i_s in range(segments_number):
+            segments.append((video_start + cuts[i_s], cuts[i_s+1] - cuts[i_s]))
+    return np.array(segments, dtype=np.int64).reshape(-1, 2)
 
-    while True:
-        # Random start
-        random_ini = np.random.randint(0, total_length_round)
-        end = random_ini + batch_size_time
-        end_modulo = np.mod(end, total_length_round)
+class VideoBucketSequence(Sequence):
+    """
+    keras Sequence of per-video batches, alternative to windows over the concatenation.
+    Videos (or segments, see get_video_segments) are sorted by length and grouped into buckets
+    of at most batch_size*seq_length padded frames, each bucket being zero-padded to its longest segment only.
+    Windows never straddle videos, and neither separation frames nor padding are seen by the model:
+    padding is masked (get_model with masking=True and time_steps=None) and its sample weights are 0.
+    The order of batches is shuffled at each epoch.
+    Batches are (inputs, labels, weights), weights being the per-frame weights (1 without class weights).
+    """
+    def __init__(self,
+                 features,
+                 features_type,
+                 annot,
+                 batch_size,
+                 seq_length,
+                 output_form,
+                 output_class_weights,
+                 img_width,
+                 img_height,
+                 cnnType,
+                 dtype=np.float32,
+                 annot_labels_weight=None,
+                 max_length=None,
+                 seed=None):
+        self.features = features
+        self.features_type = features_type
+        self.annot = annot
+        self.output_form = output_form
+        self.img_width = img_width
+        self.img_height = img_height
+        self.cnnType = cnnType
+        self.dtype = dtype
+        if annot_labels_weight is None and output_class_weights != []:
+            annot_labels_weight = get_labels_weight(annot, output_form, output_class_weights, dtype)
+        self.annot_labels_weight = annot_labels_weight
 
-        # Fill in batch features
-        if features_type == 'features' or features_type == 'both':
-            batch_features = batch_features.reshape(1, batch_size_time, feature_number)
-            if end <= total_length_round:
-                batch_features = np.copy(features[0][0, random_ini:end, :])
-            else:
-                batch_features[0, :(total_length_round - random_ini), :] = np.copy(features[0][0, random_ini:total_length_round, :])
-                batch_features[0, (total_length_round - random_ini):, :] = np.copy(features[0][0, 0:end_modulo, :])
-            batch_features = batch_features.reshape(-1, seq_length, feature_number)
-        if features_type == 'frames' or features_type == 'both':
-            batch_frames = batch_frames.reshape(1, batch_size_time, img_width, img_height, 3)
-            if end <= total_length_round:
-                for iFrame in range(random_ini, end):
-                    if cnnType=='resnet':
-                        batch_frames[0, iFrame-random_ini, :, :, :] = preprocess_input_ResNet50(img_to_array(load_img(features[1][iFrame], target_size=(img_width, img_height))))
-                    elif cnnType=='vgg':
-                        batch_frames[0, iFrame-random_ini, :, :, :] = preprocess_input_VGG16(img_to_array(load_img(features[1][iFrame], target_size=(img_width, img_height))))
-                    elif cnnType=='mobilenet':
-                        batch_frames[0, iFrame-random_ini, :, :, :] = preprocess_input_MobileNet(img_to_array(load_img(features[1][iFrame], target_size=(img_width, img_height))))
-                    else:
-                        sys.exit('Invalid CNN network model')
+        segments = get_video_segments(features, features_type, max_length)
+        segments = segments[np.argsort(segments[:, 1], kind='stable')]
+        frames_budget = max(batch_size*seq_length, int(segments[-1, 1]))
+        self.buckets = []
+        i_first = 0
+        for i_s in range(1, len(segments)+1):
+            # segments are sorted, the bucket is padded to the length of its last segment
+            if i_s == len(segments) or (i_s - i_first + 1)*segments[i_s, 1] > frames_budget:
+                self.buckets.append(segments[i_first:i_s])
+                i_first = i_s
+        self.random_state = np.random.RandomState(seed)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def get_bucket_labels(self, labels, weights, bucket, padded_length):
+        out_labels = np.zeros((len(bucket), padded_length, labels.shape[2]), dtype=self.dtype)
+        out_weights = np.zeros((len(bucket), padded_length), dtype=self.dtype)
+        for i_s, (start, length) in enumerate(bucket):
+            out_labels[i_s, :length] = labels[0, start:start+length]
+            if weights is None:
+                out_weights[i_s, :length] = 1
             else:
-                for iFrame in range(random_ini,total_length_round):
-                    if cnnType=='resnet':
-                        batch_frames[0, iFrame-random_ini, :, :, :] = preprocess_input_ResNet50(img_to_array(load_img(features[1][iFrame], target_size=(img_width, img_height))))
-                    elif cnnType=='vgg':
-                        batch_frames[0, iFrame-random_ini, :, :, :] = preprocess_input_VGG16(img_to_array(load_img(features[1][iFrame], target_size=(img_width, img_height))))
-                    elif cnnType=='mobilenet':
-                        batch_frames[0, iFrame-random_ini, :, :, :] = preprocess_input_MobileNet(img_to_array(load_img(features[1][iFrame], target_size=(img_width, img_height))))
-                    else:
-                        sys.exit('Invalid CNN network model')
-                for iFrame in range(0, end_modulo):
-                    if cnnType=='resnet':
-                        batch_frames[0, iFrame+total_length_round-random_ini, :, :, :] = preprocess_input_ResNet50(img_to_array(load_img(features[1][iFrame], target_size=(img_width, img_height))))
-                    elif cnnType=='vgg':
-                        batch_frames[0, iFrame+total_length_round-random_ini, :, :, :] = preprocess_input_VGG16(img_to_array(load_img(features[1][iFrame], target_size=(img_width, img_height))))
-                    elif cnnType=='mobilenet':
-                        batch_frames[0, iFrame+total_length_round-random_ini, :, :, :] = preprocess_input_MobileNet(img_to_array(load_img(features[1][iFrame], target_size=(img_width, img_height))))
-                    else:
-                        sys.exit('Invalid CNN network model')
-            batch_frames = batch_frames.reshape(-1, seq_length, img_width, img_height, 3)
-
-        # Fill in batch weights
-        if output_class_weights != []:
-            if output_form == 'mixed':
-                for i_label_cat in range(labels_number):
-                    batch_labels_weight[i_label_cat] = batch_labels_weight[i_label_cat].reshape(1, batch_size_time)
-                    if end <= total_length_round:
-                        batch_labels_weight[i_label_cat] = np.copy(annot_labels_weight[i_label_cat][0, random_ini:end])
-                    else:
-                        batch_labels_weight[i_label_cat][0, :(total_length_round - random_ini)] = np.copy(annot_labels_weight[i_label_cat][0, random_ini:total_length_round])
-                        batch_labels_weight[i_label_cat][0, (total_length_round - random_ini):] = np.copy(annot_labels_weight[i_label_cat][0, 0:end_modulo])
-                    batch_labels_weight[i_label_cat] = batch_labels_weight[i_label_cat].reshape(-1, seq_length)
-            elif output_form == 'sign_types':
-                batch_labels_weight = batch_labels_weight.reshape(1, batch_size_time)
-                if end <= total_length_round:
-                    batch_labels_weight = np.copy(annot_labels_weight[0, random_ini:end])
+                out_weights[i_s, :length] = weights[0, start:start+length]
+        return out_labels, out_weights
+
+    def __getitem__(self, idx):
+        bucket = self.buckets[self.order[idx]]
+        padded_length = int(bucket[-1, 1])
+
+        inputs = []
+        if self.features_type == 'features' or self.features_type == 'both':
+            X_features = np.zeros((len(bucket), padded_length, self.features[0].shape[2]), dtype=self.dtype)
+            for i_s, (start, length) in enumerate(bucket):
+                X_features[i_s, :length] = self.features[0][0, start:start+length]
+            inputs.append(X_features)
+        if self.features_type == 'frames' or self.features_type == 'both':
+            X_frames = np.zeros((len(bucket), padded_length, self.img_width, self.img_height, 3), dtype=self.dtype)
+            for i_s, (start, length) in enumerate(bucket):
+                load_frames(self.features[1], np.arange(start, start+length), self.img_width, self.img_height, self.cnnType, X_frames[i_s, :length])
+            inputs.append(X_frames)
+        if len(inputs) == 1:
+            inputs = inputs[0]
+
+        if self.output_form == 'mixed':
+            labels = []
+            weights = []
+            for i_label_cat in range(len(self.annot)):
+                if self.annot_labels_weight is None:
+                    annot_weights = None
                 else:
-                    batch_labels_weight[0, :(total_length_round - random_ini)] = np.copy(annot_labels_weight[0, random_ini:total_length_round])
-                    batch_labels_weight[0, (total_length_round - random_ini):] = np.copy(annot_labels_weight[0, 0:end_modulo])
-                batch_labels_weight = batch_labels_weight.reshape(-1, seq_length)
+                    annot_weights = self.annot_labels_weight[i_label_cat]
+                l, w = self.get_bucket_labels(self.annot[i_label_cat], annot_weights, bucket, padded_length)
+                labels.append(l)
+                weights.append(w)
+        else:
+            labels, weights = self.get_bucket_labels(self.annot, self.annot_labels_weight, bucket, padded_length)
+        return inputs, labels, weights
+
+    def on_epoch_end(self):
+        self.order = self.random_state.permutation(len(self.buckets))
+
+def get_windows_view(data, total_length_round, seq_length, dtype=np.float32):
+    """
+    Array (total_length_round/seq_length, seq_length, ...) of consecutive windows of data[0, :total_length_round]
+    (data: array (1, time_steps, ...) or (1, time_steps), or ConcatenatedSequenceView)
+    A reshaped view, without copy when data is already an array of type dtype.
+    """
+    windows = np.asarray(data[0, :total_length_round], dtype=dtype)
+    return windows.reshape((-1, seq_length) + windows.shape[1:])
+
+def get_dataset(features,
+                features_type,
+                annot,
+                batch_size,
+                seq_length,
+                output_form,
+                output_class_weights,
+                dtype=np.float32,
+                annot_labels_weight=None,
+                shuffle=True,
+                seed=None):
+    """
+    tf.data.Dataset equivalent of BatchSequence (tensorflow 2 and features only).
+    The concatenation is cut in consecutive windows of seq_length frames, held as tensors
+    [windows_number, seq_length, ...]; window indices are shuffled at each epoch (if shuffle)
+    and batched by batch_size, batches being gathered from the tensors and prefetched by tensorflow,
+    so that no python code runs in the training loop.
+    Labels given as RunLengthLabels are held as windows of label codes, expanded to dense labels per batch.
+    Elements are (inputs, labels) or (inputs, labels, weights), labels and weights being tuples for 'mixed'.
+    """
+    if v0 != '2':
+        sys.exit('tf.data pipeline requires tensorflow 2')
+    if features_type != 'features':
+        sys.exit('tf.data pipeline only supports features')
+
+    total_length_round = get_total_length_round(features, features_type, seq_length)
+    if annot_labels_weight is None and output_class_weights != []:
+        annot_labels_weight = get_labels_weight(annot, output_form, output_class_weights, dtype)
+
+    def get_label_windows(a):
+        # RunLengthLabels: windows of label codes, dense labels being gathered from the codes per batch
+        if isinstance(a, RunLengthLabels):
+            code_windows = a.runs.to_dense(0, total_length_round).reshape(-1, seq_length)
+            return (tf.convert_to_tensor(code_windows), tf.convert_to_tensor(a.codes.astype(dtype, copy=False)))
+        return tf.convert_to_tensor(get_windows_view(a, total_length_round, seq_length, dtype))
 
+    def gather_label_windows(l, indices):
+        if isinstance(l, tuple):
+            return tf.gather(l[1], tf.gather(l[0], indices))
+        return tf.gather(l, indices)
 
-        # Fill in batch annotations
+    inputs = tf.convert_to_tensor(get_windows_view(features[0], total_length_round, seq_length, dtype))
+    if output_form == 'mixed':
+        labels = [get_label_windows(a) for a in annot]
+        if annot_labels_weight is not None:
+            weights = tuple(tf.convert_to_tensor(get_windows_view(w, total_length_round, seq_length, dtype)) for w in annot_labels_weight)
+    elif output_form == 'sign_types':
+        labels = get_label_windows(annot)
+        if annot_labels_weight is not None:
+            weights = tf.convert_to_tensor(get_windows_view(annot_labels_weight, total_length_round, seq_length, dtype))
+    else:
+        sys.exit('Wrong annotation format')
+
+    def get_batch_windows(indices):
+        batch_inputs = tf.gather(inputs, indices)
         if output_form == 'mixed':
-            for i_label_cat in range(labels_number):
-                batch_labels[i_label_cat] = batch_labels[i_label_cat].reshape(1, batch_size_time, labels_shape[i_label_cat])
-                if end <= total_length_round:
-                    batch_labels[i_label_cat] = np.copy(annot[i_label_cat][0, random_ini:end, :])
-                else:
-                    batch_labels[i_label_cat][0, :(total_length_round - random_ini), :] = np.copy(annot[i_label_cat][0, random_ini:total_length_round, :])
-                    batch_labels[i_label_cat][0, (total_length_round - random_ini):, :] = np.copy(annot[i_label_cat][0, 0:end_modulo, :])
-                batch_labels[i_label_cat] = batch_labels[i_label_cat].reshape(-1, seq_length, labels_shape[i_label_cat])
-        elif output_form == 'sign_types':
-            batch_labels = batch_labels.reshape(1, batch_size_time, labels_shape)
-            if end <= total_length_round:
-                batch_labels = np.copy(annot[0, random_ini:end, :])
-            else:
-                batch_labels[0, :(total_length_round - random_ini), :] = np.copy(annot[0, random_ini:total_length_round, :])
-                batch_labels[0, (total_length_round - random_ini):, :] = np.copy(annot[0, 0:end_modulo, :])
-            batch_labels = batch_labels.reshape(-1, seq_length, labels_shape)
-
-        if output_class_weights != []:
-            if features_type == 'features':
-                yield batch_features, batch_labels, batch_labels_weight
-            elif features_type == 'frames':
-                yield batch_frames, batch_labels, batch_labels_weight
-            elif features_type == 'both':
-                yield [batch_features, batch_frames], batch_labels, batch_labels_weight
+            batch_labels = tuple(gather_label_windows(l, indices) for l in labels)
         else:
-            if features_type == 'features':
-                yield batch_features, batch_labels
-            elif features_type == 'frames':
-                yield batch_frames, batch_labels
-            elif features_type == 'both':
-                yield [batch_features, batch_frames], batch_labels
+            batch_labels = gather_label_windows(labels, indices)
+        if annot_labels_weight is None:
+            return (batch_inputs, batch_labels)
+        return (batch_inputs, batch_labels, tf.nest.map_structure(lambda w: tf.gather(w, indices), weights))
+
+    windows_number = total_length_round//seq_length
+    dataset = tf.data.Dataset.range(windows_number)
+    if shuffle:
+        dataset = dataset.shuffle(windows_number, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(get_batch_windows, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
 
 def train_model(model,
@@ -228,7 +600,21 @@ def train_model(model,
                 reduceLrFactor=0.8,
                 img_width=224,
                 img_height=224,
-                cnnType='resnet'):
+                cnnType='resnet',
+                dtype=np.float32,
+                use_sequence=True,
+                workers=1,
+                use_multiprocessing=False,
+                max_queue_size=10,
+                sampling='random',
+                sampling_stride=None,
+                seed=None,
+                sample_weights_train=None,
+                sample_weights_valid=None,
+                validation_freq=1,
+                use_dataset=False,
+                batching='windows',
+                max_video_length=None):
     """
         Trains a keras model.
 
@@ -240,17 +626,35 @@ def train_model(model,
             features_valid: [numpy array of features [1, time_steps_valid, features], list of images (if CNN is used)]
             annot_valid: either list of annotation arrays (output_form: 'mixed')
                              or one binary array (output_form: 'sign_types')
+                         annotations can also be RunLengthLabels (see get_data_concatenated with rle_annotations),
+                         expanded to dense labels batch by batch
             batch_size
             output_class_weights: list of vector of weights for each class of each output
             save: for saving the models ('no' or 'best' or 'all')
-
+            dtype: data type of the batches (default float32)
+            use_sequence: batches from a BatchSequence (can be prefetched by several workers) or from generator
+            workers: number of threads/processes building batches in the background
+            use_multiprocessing: processes instead of threads (only with use_sequence)
+            max_queue_size: maximum number of prefetched batches
+            sampling: how training windows are chosen (see WindowSampler): 'random', 'permuted', 'stratified' or 'balanced'
+            sampling_stride: distance between windows for 'permuted' and 'stratified' (default: seq_length)
+            seed: seed of the training sampler (deterministic epochs)
+            sample_weights_train, sample_weights_valid: precomputed per-frame weights (e.g. from data_utils.get_sample_weights),
+                                                        otherwise computed from output_class_weights
+            validation_freq: validation (on the whole validation set, see ValidationSequence) every validation_freq epochs
+            use_dataset: training batches from a tf.data pipeline (see get_dataset; tensorflow 2 and features only),
+                         windows are then consecutive and shuffled at each epoch, instead of chosen by sampling
+            batching: 'windows' (windows of seq_length frames over the concatenation)
+                      or 'videos' (per-video batches bucketed by length, see VideoBucketSequence;
+                      the model must be built with masking=True and time_steps=None)
+            max_video_length: with 'videos' batching, longer videos are cut into segments of at most max_video_length frames
 
         Outputs:
             ?
     """
     if type(annot_train) == list:
         output_form = 'mixed'
-    elif type(annot_train) == np.ndarray:
+    elif type(annot_train) == np.ndarray or isinstance(annot_train, RunLengthLabels):
         output_form = 'sign_types'
     else:
         sys.exit('Wrong annotation format')
@@ -294,30 +698,120 @@ def train_model(model,
                                                 epsilon=1e-4,
                                                 mode=reduceLrMonitorMode))
 
-    hist = model.fit_generator(generator(features=features_train,
-                                         features_type=features_type,
-                                         annot=annot_train,
-                                         batch_size=batch_size,
-                                         seq_length=seq_length,
-                                         output_form=output_form,
-                                         output_class_weights=output_class_weights,
-                                         img_width=img_width,
-                                         img_height=img_height,
-                                         cnnType=cnnType),
+    if sampling == 'balanced':
+        annot_classes = get_annotation_classes(annot_train, total_length_train_round)
+    else:
+        annot_classes = None
+    sampler = WindowSampler(sampling,
+                            total_length_train_round,
+                            seq_length,
+                            batch_size,
+                            steps=int(np.ceil(time_steps_train/batch_size_time)),
+                            stride=sampling_stride,
+                            annot_classes=annot_classes,
+                            seed=seed)
+
+    if use_sequence:
+        batch_source = BatchSequence
+        if use_multiprocessing:
+            buffers_args = {}
+        else:
+            buffers_args = {'n_buffers': max_queue_size + workers + 2}
+    else:
+        batch_source = generator
+        # a python generator can only be consumed by one thread
+        workers = 1
+        use_multiprocessing = False
+        buffers_args = {'n_buffers': max_queue_size + 2}
+
+    validation_sequence = ValidationSequence(features=features_valid,
+                                             features_type=features_type,
+                                             annot=annot_valid,
+                                             batch_size=batch_size,
+                                             seq_length=seq_length,
+                                             output_form=output_form,
+                                             output_class_weights=output_class_weights,
+                                             img_width=img_width,
+                                             img_height=img_height,
+                                             cnnType=cnnType,
+                                             dtype=dtype,
+                                             annot_labels_weight=sample_weights_valid)
+    if validation_freq != 1:
+        # not supported by older keras versions, only passed when needed
+        validation_args = {'validation_freq': validation_freq}
+    else:
+        validation_args = {}
+
+    if batching == 'videos':
+        bucket_sequence = VideoBucketSequence(features=features_train,
+                                              features_type=features_type,
+                                              annot=annot_train,
+                                              batch_size=batch_size,
+                                              seq_length=seq_length,
+                                              output_form=output_form,
+                                              output_class_weights=output_class_weights,
+                                              img_width=img_width,
+                                              img_height=img_height,
+                                              cnnType=cnnType,
+                                              dtype=dtype,
+                                              annot_labels_weight=sample_weights_train,
+                                              max_length=max_video_length,
+                                              seed=seed)
+        hist = model.fit_generator(bucket_sequence,
+                                   epochs=epochs,
+                                   steps_per_epoch=len(bucket_sequence),
+                                   validation_data=validation_sequence,
+                                   validation_steps=len(validation_sequence),
+                                   callbacks=callbacksPerso,
+                                   workers=workers,
+                                   use_multiprocessing=use_multiprocessing,
+                                   max_queue_size=max_queue_size,
+                                   **validation_args)
+        return hist.history
+    elif batching != 'windows':
+        sys.exit('Invalid batching mode')
+
+    if use_dataset:
+        hist = model.fit(get_dataset(features=features_train,
+                                     features_type=features_type,
+                                     annot=annot_train,
+                                     batch_size=batch_size,
+                                     seq_length=seq_length,
+                                     output_form=output_form,
+                                     output_class_weights=output_class_weights,
+                                     dtype=dtype,
+                                     annot_labels_weight=sample_weights_train,
+                                     seed=seed),
+                         epochs=epochs,
+                         validation_data=validation_sequence,
+                         validation_steps=len(validation_sequence),
+                         callbacks=callbacksPerso,
+                         **validation_args)
+        return hist.history
+
+    hist = model.fit_generator(batch_source(features=features_train,
+                                            features_type=features_type,
+                                            annot=annot_train,
+                                            batch_size=batch_size,
+                                            seq_length=seq_length,
+                                            output_form=output_form,
+                                            output_class_weights=output_class_weights,
+                                            img_width=img_width,
+                                            img_height=img_height,
+                                            cnnType=cnnType,
+                                            dtype=dtype,
+                                            sampler=sampler,
+                                            annot_labels_weight=sample_weights_train,
+                                            **buffers_args),
                                epochs=epochs,
-                               steps_per_epoch=np.ceil(time_steps_train/batch_size_time),
-                               validation_data=generator(features=features_valid,
-                                                         features_type=features_type,
-                                                         annot=annot_valid,
-                                                         batch_size=batch_size,
-                                                         seq_length=seq_length,
-                                                         output_form=output_form,
-                                                         output_class_weights=output_class_weights,
-                                                         img_width=img_width,
-                                                         img_height=img_height,
-                                                         cnnType=cnnType),
-                               validation_steps=1,
-                               callbacks=callbacksPerso)
+                               steps_per_epoch=len(sampler),
+                               validation_data=validation_sequence,
+                               validation_steps=len(validation_sequence),
+                               callbacks=callbacksPerso,
+                               workers=workers,
+                               use_multiprocessing=use_multiprocessing,
+                               max_queue_size=max_queue_size,
+                               **validation_args)
 
     return hist.history
     #print(hist)
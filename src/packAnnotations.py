@@ -0,0 +1,27 @@
+'''
+This script converts annotations.npz (pickled per-video arrays)
+to the packed annotation format: one flat integer array per annotation type
+and a shared video_offsets array, in data/processed/<corpus>/annotations/.
+Packed annotations are then memory-mapped by get_annotation_cache, without pickle.
+'''
+
+from models.data_utils import *
+
+import argparse
+
+parser = argparse.ArgumentParser(description='Packs annotations into memory-mappable flat arrays')
+parser.add_argument('--corpus',
+                    type=str,
+                    default='DictaSign',
+                    choices=['DictaSign', 'NCSLGR'],
+                    help='Corpus')
+parser.add_argument('--fromNotebook',
+                    type=int,
+                    default=0,
+                    help='When the script is run from a jupyter notebook',
+                    choices=[0, 1])
+
+args = parser.parse_args()
+
+offsets = pack_annotations(args.corpus, bool(args.fromNotebook))
+print('Packed annotations of ' + args.corpus + ': ' + str(offsets.size - 1) + ' videos, ' + str(offsets[-1]) + ' frames')
@@ -0,0 +1,43 @@
+'''
+This script converts the features of the 'old' input format
+(features_HS.npy, raw.npy, 2Dfeatures.npy... pickled object arrays with one entry per video)
+to the packed format: one contiguous float32 matrix and an offsets table per feature family.
+Packed families are then memory-mapped by get_features_videos and get_sequence_features.
+'''
+
+from models.data_utils import *
+
+import argparse
+import os.path
+
+parser = argparse.ArgumentParser(description='Packs feature families into memory-mappable float32 matrices')
+parser.add_argument('--corpus',
+                    type=str,
+                    default='DictaSign',
+                    choices=['DictaSign', 'NCSLGR'],
+                    help='Corpus')
+parser.add_argument('--families',
+                    type=str,
+                    default=featureFamilies,
+                    choices=featureFamilies,
+                    help='Feature families to pack (missing files are skipped)',
+                    nargs='*')
+parser.add_argument('--fromNotebook',
+                    type=int,
+                    default=0,
+                    help='When the script is run from a jupyter notebook',
+                    choices=[0, 1])
+
+args = parser.parse_args()
+
+if args.fromNotebook:
+    parent = '../'
+else:
+    parent = ''
+
+for key in args.families:
+    if not os.path.exists(parent + 'data/processed/' + args.corpus + '/' + key + '.npy'):
+        print('Skipping ' + key + ' (no file)')
+        continue
+    offsets = pack_features(args.corpus, key, bool(args.fromNotebook))
+    print('Packed ' + key + ': ' + str(offsets.size - 1) + ' videos, ' + str(offsets[-1]) + ' frames')
@@ -285,6 +285,88 @@ parser.add_argument('--redLrFactor',
                     type=float,
                     default=0.5,
                     help='Factor for each l_rate reduc')
+parser.add_argument('--dtype',
+                    type=str,
+                    default='float32',
+                    help='Data type of features, annotations and batches',
+                    choices=['float32', 'float64'])
+parser.add_argument('--workers',
+                    type=int,
+                    default=1,
+                    help='Number of workers building training batches in the background')
+parser.add_argument('--useMultiprocessing',
+                    type=int,
+                    default=0,
+                    help='Whether batch workers are processes (1) or threads (0)',
+                    choices=[0, 1])
+parser.add_argument('--maxQueueSize',
+                    type=int,
+                    default=10,
+                    help='Maximum number of prefetched training batches')
+parser.add_argument('--sampling',
+                    type=str,
+                    default='random',
+                    help='How training windows are chosen in each epoch',
+                    choices=['random', 'permuted', 'stratified', 'balanced'])
+parser.add_argument('--samplingStride',
+                    type=int,
+                    default=0,
+                    help='Distance between windows for permuted/stratified sampling (0: seqLength)')
+parser.add_argument('--seed',
+                    type=int,
+                    default=-1,
+                    help='Seed of the training sampler (-1: not seeded)')
+parser.add_argument('--validationFreq',
+                    type=int,
+                    default=1,
+                    help='Validation on the whole validation set every validationFreq epochs')
+parser.add_argument('--framesCache',
+                    type=int,
+                    default=0,
+                    help='Whether frames are read from the decoded frame cache (see cacheFrames.py)',
+                    choices=[0, 1])
+parser.add_argument('--decodeWorkers',
+                    type=int,
+                    default=0,
+                    help='Number of workers decoding frame files (0: serial decoding)')
+parser.add_argument('--decodeProcesses',
+                    type=int,
+                    default=0,
+                    help='Whether frame decoding workers are processes (1) or threads (0)',
+                    choices=[0, 1])
+parser.add_argument('--embedFrames',
+                    type=int,
+                    default=0,
+                    help='Whether frames are embedded once by the frozen layers of the CNN (before cnnFirstTrainedLayer), the model being trained on the embeddings (1, frames input only)',
+                    choices=[0, 1])
+parser.add_argument('--performanceMode',
+                    type=int,
+                    default=0,
+                    help='Whether the model uses mixed precision, XLA and fused LSTM kernels (1, tensorflow 2 only)',
+                    choices=[0, 1])
+parser.add_argument('--batching',
+                    type=str,
+                    default='windows',
+                    help='Training batches of windows over the concatenated videos, or of whole videos bucketed by length',
+                    choices=['windows', 'videos'])
+parser.add_argument('--maxVideoLength',
+                    type=int,
+                    default=0,
+                    help='With videos batching, longer videos are cut into segments of at most maxVideoLength frames (0: no cut)')
+parser.add_argument('--predictionStride',
+                    type=int,
+                    default=0,
+                    help='Distance between overlapping prediction windows (0: non-overlapping windows, tail frames dropped)')
+parser.add_argument('--stitching',
+                    type=str,
+                    default='center',
+                    help='How overlapping prediction windows are stitched',
+                    choices=['center', 'overlap_add'])
+parser.add_argument('--useDataset',
+                    type=int,
+                    default=0,
+                    help='Whether training batches come from a tf.data pipeline (1, tensorflow 2 and features only) or from keras (0)',
+                    choices=[0, 1])
 
 # save data and monitor best
 parser.add_argument('--saveModel',
@@ -313,6 +395,10 @@ parser.add_argument('--saveModels',
                     type=str,
                     default='models/corpora/DictaSign/recognitionUnique/',
                     help='Where to save predictions')
+parser.add_argument('--modelCache',
+                    type=str,
+                    default='',
+                    help='Where built models are cached for runs with the same architecture, e.g. models/cache/ (empty: no cache)')
 parser.add_argument('--fromNotebook',
                     type=int,
                     default=0,
@@ -388,6 +474,24 @@ reduceLrMonitor     = args.redLrMonitor
 reduceLrMonitorMode = args.redLrMonitorMode
 reduceLrPatience    = args.redLrPatience
 reduceLrFactor      = args.redLrFactor
+dtype               = args.dtype
+workers             = args.workers
+useMultiprocessing  = bool(args.useMultiprocessing)
+maxQueueSize        = args.maxQueueSize
+sampling            = args.sampling
+samplingStride      = args.samplingStride if args.samplingStride > 0 else None
+seed                = args.seed if args.seed >= 0 else None
+validationFreq      = args.validationFreq
+useDataset          = bool(args.useDataset)
+framesCache         = bool(args.framesCache)
+decodeWorkers       = args.decodeWorkers
+decodeProcesses     = bool(args.decodeProcesses)
+embedFrames         = bool(args.embedFrames)
+performanceMode     = bool(args.performanceMode)
+batching            = args.batching
+maxVideoLength      = args.maxVideoLength if args.maxVideoLength > 0 else None
+predictionStride    = args.predictionStride if args.predictionStride > 0 else None
+stitching           = args.stitching
 
 # save data and monitor best
 save                = args.saveModel
@@ -396,6 +500,7 @@ saveMonitorMode     = args.saveBestMonMode
 saveGlobalresults   = args.saveGlobalresults
 savePredictions     = args.savePredictions
 saveModels          = args.saveModels
+modelCache          = args.modelCache if args.modelCache != '' else None
 fromNotebook        = bool(args.fromNotebook)
 
 # Metrics
@@ -472,12 +577,31 @@ dataGlobal[outputName][timeString]['params']['reduceLrMonitor']      = reduceLrM
 dataGlobal[outputName][timeString]['params']['reduceLrMonitorMode']  = reduceLrMonitorMode
 dataGlobal[outputName][timeString]['params']['reduceLrPatience']     = reduceLrPatience
 dataGlobal[outputName][timeString]['params']['reduceLrFactor']       = reduceLrFactor
+dataGlobal[outputName][timeString]['params']['dtype']                = dtype
+dataGlobal[outputName][timeString]['params']['workers']              = workers
+dataGlobal[outputName][timeString]['params']['useMultiprocessing']   = useMultiprocessing
+dataGlobal[outputName][timeString]['params']['maxQueueSize']         = maxQueueSize
+dataGlobal[outputName][timeString]['params']['sampling']             = sampling
+dataGlobal[outputName][timeString]['params']['samplingStride']       = samplingStride
+dataGlobal[outputName][timeString]['params']['seed']                 = seed
+dataGlobal[outputName][timeString]['params']['validationFreq']       = validationFreq
+dataGlobal[outputName][timeString]['params']['useDataset']           = useDataset
+dataGlobal[outputName][timeString]['params']['framesCache']          = framesCache
+dataGlobal[outputName][timeString]['params']['decodeWorkers']        = decodeWorkers
+dataGlobal[outputName][timeString]['params']['decodeProcesses']      = decodeProcesses
+dataGlobal[outputName][timeString]['params']['embedFrames']          = embedFrames
+dataGlobal[outputName][timeString]['params']['performanceMode']      = performanceMode
+dataGlobal[outputName][timeString]['params']['batching']             = batching
+dataGlobal[outputName][timeString]['params']['maxVideoLength']       = maxVideoLength
+dataGlobal[outputName][timeString]['params']['predictionStride']     = predictionStride
+dataGlobal[outputName][timeString]['params']['stitching']            = stitching
 dataGlobal[outputName][timeString]['params']['save']                 = save
 dataGlobal[outputName][timeString]['params']['saveMonitor']          = saveMonitor
 dataGlobal[outputName][timeString]['params']['saveMonitorMode']      = saveMonitorMode
 dataGlobal[outputName][timeString]['params']['saveGlobalresults']    = saveGlobalresults
 dataGlobal[outputName][timeString]['params']['savePredictions']      = savePredictions
 dataGlobal[outputName][timeString]['params']['saveModels']           = saveModels
+dataGlobal[outputName][timeString]['params']['modelCache']           = modelCache
 dataGlobal[outputName][timeString]['params']['fromNotebook']         = fromNotebook
 dataGlobal[outputName][timeString]['params']['stepWolf']             = stepWolf
 
@@ -505,6 +629,23 @@ else:
                                                                 checkSets=True,
                                                                 from_notebook=fromNotebook)
 
+if embedFrames:
+    if inputFeaturesFrames != 'frames':
+        sys.exit('Frame embeddings require frames as input')
+    # frames embedded once by the frozen head of the CNN, then read as features
+    inputType, features_number = build_cnn_embeddings(corpus,
+                                                      np.concatenate([idxTrain, idxValid, idxTest]),
+                                                      cnnType=cnnType,
+                                                      img_width=imgWidth,
+                                                      img_height=imgHeight,
+                                                      cnnFirstTrainedLayer=cnnFirstTrainedLayer,
+                                                      frames_cache=framesCache,
+                                                      from_notebook=fromNotebook,
+                                                      dtype=dtype)
+    inputFeaturesFrames = 'features'
+    inputTypeFormat     = 'cslr_limsi_features'
+    inputNormed         = False
+
 
 if outputName == 'fls' :
     nKept = len(flsKeep)
@@ -533,7 +674,13 @@ features_train, annot_train = get_data_concatenated(corpus=corpus,
                                                     input_type=inputType,
                                                     input_normed=inputNormed,
                                                     input_type_format=inputTypeFormat,
-                                                    from_notebook=fromNotebook)
+                                                    from_notebook=fromNotebook,
+                                                    frames_cache=framesCache,
+                                                    img_width=imgWidth,
+                                                    img_height=imgHeight,
+                                                    dtype=dtype,
+                                                    concatenate_features=False,
+                                                    rle_annotations=True)
 features_valid, annot_valid = get_data_concatenated(corpus=corpus,
                                                     output_form='sign_types',
                                                     types=selected_outputs,
@@ -544,7 +691,12 @@ features_valid, annot_valid = get_data_concatenated(corpus=corpus,
                                                     input_type=inputType,
                                                     input_normed=inputNormed,
                                                     input_type_format=inputTypeFormat,
-                                                    from_notebook=fromNotebook)
+                                                    from_notebook=fromNotebook,
+                                                    frames_cache=framesCache,
+                                                    img_width=imgWidth,
+                                                    img_height=imgHeight,
+                                                    dtype=dtype,
+                                                    rle_annotations=True)
 features_test, annot_test   = get_data_concatenated(corpus=corpus,
                                                     output_form='sign_types',
                                                     types=selected_outputs,
@@ -555,15 +707,26 @@ features_test, annot_test   = get_data_concatenated(corpus=corpus,
                                                     input_type=inputType,
                                                     input_normed=inputNormed,
                                                     input_type_format=inputTypeFormat,
-                                                    from_notebook=fromNotebook)
+                                                    from_notebook=fromNotebook,
+                                                    frames_cache=framesCache,
+                                                    img_width=imgWidth,
+                                                    img_height=imgHeight,
+                                                    dtype=dtype,
+                                                    rle_annotations=True)
 
 
 nClasses = annot_train.shape[2]
 
-classWeightsCorrected, _ = weightVectorImbalancedDataOneHot(annot_train[0, :, :])
+labels_args = dict(corpus=corpus, output_form='sign_types', types=selected_outputs, nonZero=nonZeros, binary=[], from_notebook=fromNotebook)
+frameClassesTrain, _     = get_frame_classes(video_indices=idxTrain, **labels_args)
+classWeightsCorrected, _ = weightVectorImbalancedData(frameClassesTrain[0])
 classWeightsNotCorrected = np.ones(nClasses)
 classWeightFinal         = weightCorrection*classWeightsCorrected + (1-weightCorrection)*classWeightsNotCorrected
+sampleWeightsTrain       = get_sample_weights(video_indices=idxTrain, output_class_weights=[classWeightFinal], dtype=dtype, **labels_args)
+sampleWeightsValid       = get_sample_weights(video_indices=idxValid, output_class_weights=[classWeightFinal], dtype=dtype, **labels_args)
+
 
+frameDecoder = set_frame_decoder(decodeWorkers, decodeProcesses)
 
 model = get_model(output_names=[outputName],
                   output_classes=[nClasses],
@@ -575,7 +738,7 @@ model = get_model(output_names=[outputName],
                   conv=convolution,
                   conv_filt=convFilt,
                   conv_ker=convFiltSize,
-                  time_steps=seq_length,
+                  time_steps=seq_length if batching == 'windows' else None,
                   learning_rate=learning_rate,
                   optimizer=optimizer,
                   metrics=metrics,
@@ -585,7 +748,11 @@ model = get_model(output_names=[outputName],
                   img_height=imgHeight,
                   cnnType=cnnType,
                   cnnFirstTrainedLayer=cnnFirstTrainedLayer,
-                  cnnReduceDim=cnnReduceDim)
+                  cnnReduceDim=cnnReduceDim,
+                  masking=batching == 'videos',
+                  frames_embedded=embedFrames,
+                  performance_mode=performanceMode,
+                  cache_path=modelCache)
 
 history = train_model(model=model,
                       features_train=features_train,
@@ -593,6 +760,8 @@ history = train_model(model=model,
                       features_valid=features_valid,
                       annot_valid=annot_valid,
                       output_class_weights=[classWeightFinal],
+                      sample_weights_train=sampleWeightsTrain,
+                      sample_weights_valid=sampleWeightsValid,
                       batch_size=batch_size,
                       epochs=epochs,
                       seq_length=seq_length,
@@ -608,14 +777,28 @@ history = train_model(model=model,
                       features_type=inputFeaturesFrames,
                       img_width=imgWidth,
                       img_height=imgHeight,
-                      cnnType=cnnType)
+                      cnnType=cnnType,
+                      dtype=dtype,
+                      workers=workers,
+                      use_multiprocessing=useMultiprocessing,
+                      max_queue_size=maxQueueSize,
+                      sampling=sampling,
+                      sampling_stride=samplingStride,
+                      seed=seed,
+                      validation_freq=validationFreq,
+                      use_dataset=useDataset,
+                      batching=batching,
+                      max_video_length=maxVideoLength)
 
 
 # Results
 print('Results')
+if frameDecoder.frames_number > 0:
+    print('Frame decoding: ' + '{:.1f}'.format(frameDecoder.frames_per_second()) + ' frames/s')
 model.load_weights(saveModels+saveBestName+'-best.hdf5')
 dataGlobal[outputName][timeString]['results'] = {}
 dataGlobal[outputName][timeString]['results']['metrics'] = {}
+dataGlobal[outputName][timeString]['results']['frameDecodingFps'] = frameDecoder.frames_per_second()
 
 # Valid results
 for metricName in history.keys():
@@ -624,8 +807,11 @@ for config in ['valid', 'test']:
     dataGlobal[outputName][timeString]['results'][config] = {}
     if config == 'valid':
         print('Validation set')
-        nRound_valid = annot_valid.shape[1]//seq_length
-        timestepsRound_valid = nRound_valid*seq_length
+        if predictionStride is None:
+            timestepsRound_valid = (annot_valid.shape[1]//seq_length)*seq_length
+        else:
+            # overlapping windows cover all frames
+            timestepsRound_valid = annot_valid.shape[1]
         predict_valid = model_predictions(model=model,
                                           features=[features_valid[0][:,:timestepsRound_valid,:], features_valid[1][:timestepsRound_valid]],
                                           features_type=inputFeaturesFrames,
@@ -634,27 +820,36 @@ for config in ['valid', 'test']:
                                           img_width=imgWidth,
                                           img_height=imgHeight,
                                           cnnType=cnnType,
-                                          batch_size=0)
+                                          batch_size=0,
+                                          dtype=dtype,
+                                          stride=predictionStride,
+                                          stitching=stitching)
         predict_valid = predict_valid.reshape(1, timestepsRound_valid, nClasses)
         #predict_valid = predict_valid[0]
-        acc = framewiseAccuracy(annot_valid[0,:nRound_valid*seq_length,:],
-                                predict_valid[0,:nRound_valid*seq_length,:],
+        acc = framewiseAccuracy(annot_valid[0,:timestepsRound_valid,:],
+                                predict_valid[0,:timestepsRound_valid,:],
                                 True,
                                 True)
-        frameP, frameR, frameF1 = framewisePRF1(annot_valid[0,:nRound_valid*seq_length,:],
-                                                predict_valid[0,:nRound_valid*seq_length,:],
+        frameP, frameR, frameF1 = framewisePRF1(annot_valid[0,:timestepsRound_valid,:],
+                                                predict_valid[0,:timestepsRound_valid,:],
                                                 True,
                                                 True)
-        pStarTp, pStarTr, rStarTp, rStarTr, fStarTp, fStarTr = prfStar(annot_valid[0,:nRound_valid*seq_length,:],
-                                                                       predict_valid[0,:nRound_valid*seq_length,:],
+        # run-length encoded once, for all unit-level metrics (annotations are loaded as runs)
+        rleTrue = annot_valid.classes(0, timestepsRound_valid)
+        rlePred = RunLengthAnnotation.from_dense(predict_valid[0,:timestepsRound_valid,:], True)
+        pStarTp, pStarTr, rStarTp, rStarTr, fStarTp, fStarTr = prfStar(rleTrue,
+                                                                       rlePred,
                                                                        True,
                                                                        True,
                                                                        step=stepWolf)
         nameHistoryAppend = 'val_'
     else:
         print('Test set')
-        nRound_test = annot_test.shape[1]//seq_length
-        timestepsRound_test = nRound_test*seq_length
+        if predictionStride is None:
+            timestepsRound_test = (annot_test.shape[1]//seq_length)*seq_length
+        else:
+            # overlapping windows cover all frames
+            timestepsRound_test = annot_test.shape[1]
         predict_test = model_predictions(model=model,
                                          features=[features_test[0][:,:timestepsRound_test,:], features_test[1][:timestepsRound_test]],
                                          features_type=inputFeaturesFrames,
@@ -663,19 +858,25 @@ for config in ['valid', 'test']:
                                          img_width=imgWidth,
                                          img_height=imgHeight,
                                          cnnType=cnnType,
-                                         batch_size=batch_size)
+                                         batch_size=batch_size,
+                                         dtype=dtype,
+                                         stride=predictionStride,
+                                         stitching=stitching)
         predict_test = predict_test.reshape(1, timestepsRound_test, nClasses)
         #predict_test = predict_test[0]
-        acc = framewiseAccuracy(annot_test[0,:nRound_test*seq_length,:],
-                                predict_test[0,:nRound_test*seq_length,:],
+        acc = framewiseAccuracy(annot_test[0,:timestepsRound_test,:],
+                                predict_test[0,:timestepsRound_test,:],
                                 True,
                                 True)
-        frameP, frameR, frameF1 = framewisePRF1(annot_test[0,:nRound_test*seq_length,:],
-                                                predict_test[0,:nRound_test*seq_length,:],
+        frameP, frameR, frameF1 = framewisePRF1(annot_test[0,:timestepsRound_test,:],
+                                                predict_test[0,:timestepsRound_test,:],
                                                 True,
                                                 True)
-        pStarTp, pStarTr, rStarTp, rStarTr, fStarTp, fStarTr = prfStar(annot_test[0,:nRound_test*seq_length,:],
-                                                                       predict_test[0,:nRound_test*seq_length,:],
+        # run-length encoded once, for all unit-level metrics (annotations are loaded as runs)
+        rleTrue = annot_test.classes(0, timestepsRound_test)
+        rlePred = RunLengthAnnotation.from_dense(predict_test[0,:timestepsRound_test,:], True)
+        pStarTp, pStarTr, rStarTp, rStarTr, fStarTp, fStarTr = prfStar(rleTrue,
+                                                                       rlePred,
                                                                        True,
                                                                        True,
                                                                        step=stepWolf)
@@ -711,24 +912,24 @@ for config in ['valid', 'test']:
     for margin in [0, 12, 25, 50]:
         print('margin = ' + str(margin))
         if config == 'valid':
-            middleUnitP, middleUnitR, middleUnitF1 = middleUnitPRF1(annot_valid[0,:nRound_valid*seq_length,:],
-                                                                    predict_valid[0,:nRound_valid*seq_length,:],
+            middleUnitP, middleUnitR, middleUnitF1 = middleUnitPRF1(rleTrue,
+                                                                    rlePred,
                                                                     True,
                                                                     True,
                                                                     margin)
-            marginUnitP, marginUnitR, marginUnitF1 = marginUnitPRF1(annot_valid[0,:nRound_valid*seq_length,:],
-                                                                    predict_valid[0,:nRound_valid*seq_length,:],
+            marginUnitP, marginUnitR, marginUnitF1 = marginUnitPRF1(rleTrue,
+                                                                    rlePred,
                                                                     True,
                                                                     True,
                                                                     margin)
         else:
-            middleUnitP, middleUnitR, middleUnitF1 = middleUnitPRF1(annot_test[0,:nRound_test*seq_length,:],
-                                                                    predict_test[0,:nRound_test*seq_length,:],
+            middleUnitP, middleUnitR, middleUnitF1 = middleUnitPRF1(rleTrue,
+                                                                    rlePred,
                                                                     True,
                                                                     True,
                                                                     margin)
-            marginUnitP, marginUnitR, marginUnitF1 = marginUnitPRF1(annot_test[0,:nRound_test*seq_length,:],
-                                                                    predict_test[0,:nRound_test*seq_length,:],
+            marginUnitP, marginUnitR, marginUnitF1 = marginUnitPRF1(rleTrue,
+                                                                    rlePred,
                                                                     True,
                                                                     True,
                                                                     margin)